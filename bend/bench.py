@@ -0,0 +1,283 @@
+"""
+bench.py
+========
+Offline benchmarks of the embedders on random DNA sequences.
+
+The embedders are loaded from checkpoints with randomly initialized weights that are
+written to a local directory, so that no downloads are needed:
+
+- ``onehot``: :class:`~bend.utils.embedders.OneHotEmbedder`.
+- ``convnet``: :class:`~bend.utils.embedders.ConvNetEmbedder` with the default `ConvNetConfig`.
+- ``awdlstm``: :class:`~bend.utils.embedders.AWDLSTMEmbedder` with the default `AWDLSTMConfig`.
+- ``hyenadna``: :class:`~bend.utils.embedders.HyenaDNAEmbedder` with the configuration of ``hyenadna-tiny-1k-seqlen``.
+- ``dnabert2``: :class:`~bend.utils.embedders.DNABert2Embedder` with a small BERT configuration and a BPE tokenizer
+  trained on random sequences.
+
+For each embedder, sequence length and batch size, `embed` is timed on a number of batches.
+The results hold the throughput, percentiles of the latency of each batch and the peak memory
+use of the process, and can be saved as JSON to compare commits.
+"""
+import os
+import json
+import time
+import platform
+import resource
+import subprocess
+import tempfile
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+import numpy as np
+import torch
+
+BENCH_EMBEDDERS = ['onehot', 'convnet', 'awdlstm', 'hyenadna', 'dnabert2']
+
+_CHARACTER_VOCAB = ['[PAD]', '[UNK]', 'A', 'C', 'G', 'T', 'N']
+
+_HYENADNA_CONFIG = {'d_model': 128, 'n_layer': 2, 'd_inner': 512, 'vocab_size': 12, 'resid_dropout': 0.0,
+                    'embed_dropout': 0.1, 'fused_mlp': False, 'fused_dropout_add_ln': False, 'residual_in_fp32': True,
+                    'pad_vocab_size_multiple': 8, 'return_hidden_state': True,
+                    'layer': {'_name_': 'hyena', 'emb_dim': 5, 'filter_order': 64, 'local_order': 3, 'l_max': 1026,
+                              'modulate': True, 'w': 10, 'lr': 6e-4, 'wd': 0.0, 'lr_pos_emb': 0.0}}
+
+_DNABERT2_CONFIG = {'vocab_size': 1024, 'hidden_size': 256, 'num_hidden_layers': 4, 'num_attention_heads': 4,
+                    'intermediate_size': 1024, 'hidden_dropout_prob': 0.1, 'attention_probs_dropout_prob': 0.0,
+                    'max_position_embeddings': 512, 'alibi_starting_size': 512, 'type_vocab_size': 2}
+
+
+def random_sequences(n: int, length: int, seed: int = 0) -> list:
+    """Draw n random DNA sequences of the given length."""
+    rng = np.random.default_rng(seed)
+    return [''.join(x) for x in rng.choice(list('ACGT'), size = (n, length))]
+
+
+def _save_character_tokenizer(model_dir: str):
+    from tokenizers import Tokenizer, Regex, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+    tokenizer = Tokenizer(models.WordLevel({x: i for i, x in enumerate(_CHARACTER_VOCAB)}, unk_token = '[UNK]'))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split(Regex('.'), behavior = 'isolated')
+    PreTrainedTokenizerFast(tokenizer_object = tokenizer, unk_token = '[UNK]', pad_token = '[PAD]').save_pretrained(model_dir)
+
+
+def _save_bpe_tokenizer(model_dir: str, vocab_size: int, seed: int):
+    from tokenizers import Tokenizer, models, trainers, processors
+    from transformers import PreTrainedTokenizerFast
+    special_tokens = ['[UNK]', '[CLS]', '[SEP]', '[PAD]', '[MASK]']
+    tokenizer = Tokenizer(models.BPE(unk_token = '[UNK]'))
+    trainer = trainers.BpeTrainer(vocab_size = vocab_size, special_tokens = special_tokens, show_progress = False)
+    tokenizer.train_from_iterator(random_sequences(200, 2000, seed = seed), trainer)
+    tokenizer.post_processor = processors.TemplateProcessing(single = '[CLS] $A [SEP]', special_tokens = [('[CLS]', 1), ('[SEP]', 2)])
+    PreTrainedTokenizerFast(tokenizer_object = tokenizer, unk_token = '[UNK]', cls_token = '[CLS]', sep_token = '[SEP]',
+                            pad_token = '[PAD]', mask_token = '[MASK]').save_pretrained(model_dir)
+
+
+def build_embedder(name: str, model_dir: str, seed: int = 0):
+    """
+    Build an embedder with randomly initialized weights.
+
+    Parameters
+    ----------
+    name : str
+        One of `BENCH_EMBEDDERS`.
+    model_dir : str
+        Directory in which the checkpoint is written, in a subdirectory per embedder.
+        Existing checkpoints are reused.
+    seed : int, optional
+        Seed of the weights. The default is 0.
+
+    Returns
+    -------
+    bend.utils.embedders.BaseEmbedder
+        The embedder.
+    """
+    from bend.utils import embedders
+    if name not in BENCH_EMBEDDERS:
+        raise ValueError(f'Unknown embedder {name}, choose from {BENCH_EMBEDDERS}')
+    torch.manual_seed(seed)
+    path = os.path.join(model_dir, name)
+    exists = os.path.exists(path)
+
+    if name == 'onehot':
+        return embedders.OneHotEmbedder()
+
+    if name == 'convnet':
+        from bend.models.dilated_cnn import ConvNetConfig, ConvNetModel
+        if not exists:
+            ConvNetModel(ConvNetConfig(vocab_size = len(_CHARACTER_VOCAB))).save_pretrained(path)
+            _save_character_tokenizer(path)
+        return embedders.ConvNetEmbedder(path)
+
+    if name == 'awdlstm':
+        from bend.models.awd_lstm import AWDLSTMConfig, AWDLSTMModelForInference
+        if not exists:
+            AWDLSTMModelForInference(AWDLSTMConfig(vocab_size = len(_CHARACTER_VOCAB))).save_pretrained(path)
+            _save_character_tokenizer(path)
+        return embedders.AWDLSTMEmbedder(path)
+
+    if name == 'hyenadna':
+        from bend.models.hyena_dna import HyenaDNAModel
+        # the embedder infers the maximum sequence length from the checkpoint name
+        path = os.path.join(path, 'hyenadna-tiny-1k-seqlen')
+        if not os.path.exists(path):
+            os.makedirs(path)
+            model = HyenaDNAModel(**_HYENADNA_CONFIG)
+            # checkpoints of the original training code prefix the backbone with 'model.'
+            torch.save({'state_dict': {f'model.{k}': v for k, v in model.state_dict().items()}}, os.path.join(path, 'weights.ckpt'))
+            with open(os.path.join(path, 'config.json'), 'w') as f:
+                json.dump(_HYENADNA_CONFIG, f)
+        return embedders.HyenaDNAEmbedder(path)
+
+    if name == 'dnabert2':
+        from transformers import BertConfig
+        from bend.models.dnabert2 import BertForMaskedLM
+        if not exists:
+            BertForMaskedLM(BertConfig(**_DNABERT2_CONFIG)).save_pretrained(path)
+            _save_bpe_tokenizer(path, _DNABERT2_CONFIG['vocab_size'], seed)
+        return embedders.DNABert2Embedder(path)
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if platform.system() == 'Darwin' else peak / 2**10
+
+
+def benchmark_embedder(name: str, model_dir: str, lengths = (512, 12000, 100000), batch_sizes = (1, 8),
+                       n_batches: int = 10, warmup: int = 1, seed: int = 0, **kwargs) -> list:
+    """
+    Time `embed` of an embedder on random sequences.
+
+    Parameters
+    ----------
+    name : str
+        One of `BENCH_EMBEDDERS`.
+    model_dir : str
+        Directory of the checkpoints, see `build_embedder`.
+    lengths : Iterable[int], optional
+        Sequence lengths. The default is (512, 12000, 100000).
+    batch_sizes : Iterable[int], optional
+        Number of sequences passed to `embed` at once, which is also its `batch_size`. The default is (1, 8).
+    n_batches : int, optional
+        Number of timed batches per length and batch size. The default is 10.
+    warmup : int, optional
+        Number of untimed batches before the timed ones. The default is 1.
+    seed : int, optional
+        Seed of the weights and sequences. The default is 0.
+    **kwargs
+        Keyword arguments passed to `embed`, e.g. `upsample_embeddings`.
+
+    Returns
+    -------
+    List[dict]
+        One result per length and batch size, with the throughput in sequences and nucleotides
+        per second, the 50th, 90th and 99th percentile of the latency of a batch in milliseconds,
+        and the peak resident memory of the process so far in MiB.
+    """
+    start = time.perf_counter()
+    embedder = build_embedder(name, model_dir, seed = seed)
+    load_seconds = time.perf_counter() - start
+
+    results = []
+    for length in lengths:
+        for batch_size in batch_sizes:
+            sequences = random_sequences((warmup + n_batches) * batch_size, length, seed = seed)
+            batches = [sequences[i:i + batch_size] for i in range(0, len(sequences), batch_size)]
+            latencies = []
+            for i, batch in enumerate(batches):
+                start = time.perf_counter()
+                embedder.embed(batch, disable_tqdm = True, batch_size = batch_size, **kwargs)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                if i >= warmup:
+                    latencies.append(time.perf_counter() - start)
+            seconds = sum(latencies)
+            result = {'embedder': name, 'length': length, 'batch_size': batch_size, 'n_batches': n_batches,
+                      'load_seconds': load_seconds, 'seconds': seconds,
+                      'sequences_per_second': n_batches * batch_size / seconds,
+                      'nucleotides_per_second': n_batches * batch_size * length / seconds,
+                      'latency_ms': {f'p{q}': float(np.percentile(latencies, q)) * 1000 for q in (50, 90, 99)},
+                      'peak_rss_mb': _peak_rss_mb()}
+            if torch.cuda.is_available():
+                result['peak_gpu_mb'] = torch.cuda.max_memory_allocated() / 2**20
+            print(f'{name:<10} length {length:>7} batch {batch_size:>3}: {result["nucleotides_per_second"]:>12.0f} nt/s, '
+                  f'p50 {result["latency_ms"]["p50"]:.1f} ms, peak RSS {result["peak_rss_mb"]:.0f} MiB')
+            results.append(result)
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)),
+                              capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(embedders = BENCH_EMBEDDERS, model_dir: str = None, isolate: bool = True, **kwargs) -> dict:
+    """
+    Benchmark several embedders.
+
+    Parameters
+    ----------
+    embedders : Iterable[str], optional
+        Names of the embedders. The default is all of `BENCH_EMBEDDERS`.
+    model_dir : str, optional
+        Directory of the checkpoints. The default is a temporary directory that is removed afterwards.
+    isolate : bool, optional
+        Whether to benchmark each embedder in a fresh process, so that the peak memory of one
+        embedder does not include that of the others. The default is True.
+    **kwargs
+        Keyword arguments passed to `benchmark_embedder`.
+
+    Returns
+    -------
+    dict
+        The commit, environment and settings of the run, and the results of all embedders.
+    """
+    report = {'commit': _git_commit(), 'date': datetime.now().isoformat(timespec = 'seconds'),
+              'python': platform.python_version(), 'torch': torch.__version__, 'machine': platform.machine(),
+              'device': 'cuda' if torch.cuda.is_available() else 'cpu', 'threads': torch.get_num_threads(),
+              'settings': {k: list(v) if isinstance(v, (tuple, list)) else v for k, v in kwargs.items()},
+              'results': []}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_dir = model_dir if model_dir is not None else tmp_dir
+        for name in embedders:
+            if isolate:
+                with ProcessPoolExecutor(max_workers = 1, mp_context = mp.get_context('spawn')) as pool:
+                    results = pool.submit(benchmark_embedder, name, model_dir, **kwargs).result()
+            else:
+                results = benchmark_embedder(name, model_dir, **kwargs)
+            report['results'].extend(results)
+    return report
+
+
+def compare_reports(baseline: dict, current: dict, tolerance: float = 0.1) -> list:
+    """
+    Compare the throughput of two benchmark reports.
+
+    Parameters
+    ----------
+    baseline : dict
+        Report of `run_benchmarks`, e.g. of the previous commit.
+    current : dict
+        Report of `run_benchmarks`.
+    tolerance : float, optional
+        Relative drop in throughput that is counted as a regression. The default is 0.1.
+
+    Returns
+    -------
+    List[dict]
+        For every embedder, length and batch size in both reports, the throughput of both
+        and the relative change, and whether it is a regression.
+    """
+    key = lambda r: (r['embedder'], r['length'], r['batch_size'])
+    baseline = {key(r): r for r in baseline['results']}
+    comparison = []
+    for r in current['results']:
+        if key(r) not in baseline:
+            continue
+        before, after = baseline[key(r)]['nucleotides_per_second'], r['nucleotides_per_second']
+        change = after / before - 1
+        comparison.append({'embedder': r['embedder'], 'length': r['length'], 'batch_size': r['batch_size'],
+                           'baseline': before, 'current': after, 'change': change, 'regression': change < -tolerance})
+    return comparison
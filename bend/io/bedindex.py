@@ -0,0 +1,246 @@
+"""
+bedindex.py
+===========
+A columnar index of the samples in a bed file.
+
+The bed file is parsed once into typed numpy columns, which are saved as a sidecar
+file next to the bed file (``{bed}.index.npz``) and reused as long as the bed file
+does not change. Rows of a split or of a chunk of a split are available without
+scanning the table again.
+"""
+import os
+import numpy as np
+import pandas as pd
+
+
+class BedIndex():
+    """Columnar index of a bed file."""
+
+    _columns = ['chroms', 'chrom_codes', 'start', 'end', 'strand',
+                'label_values', 'label_offsets', 'splits', 'split_codes']
+
+    def __init__(self, chroms, chrom_codes, start, end, strand,
+                 label_values, label_offsets, splits, split_codes) -> None:
+        """
+        Build an index from its columns. Use `BedIndex.load` to index a bed file.
+
+        Parameters
+        ----------
+        chroms : np.ndarray
+            Chromosome names.
+        chrom_codes : np.ndarray
+            Index into `chroms` for each row.
+        start : np.ndarray
+            Start coordinate of each row.
+        end : np.ndarray
+            End coordinate of each row.
+        strand : np.ndarray
+            Strand of each row.
+        label_values : np.ndarray
+            Labels of all rows, concatenated.
+        label_offsets : np.ndarray
+            The labels of row i are `label_values[label_offsets[i]:label_offsets[i+1]]`.
+        splits : np.ndarray
+            Split names, in order of their first occurence.
+        split_codes : np.ndarray
+            Index into `splits` for each row.
+        """
+        self.chroms = chroms
+        self.chrom_codes = chrom_codes
+        self.start = start
+        self.end = end
+        self.strand = strand
+        self.label_values = label_values
+        self.label_offsets = label_offsets
+        self.splits = splits
+        self.split_codes = split_codes
+
+        # rows grouped by split, in file order within each split
+        self._split_order = np.argsort(split_codes, kind = 'stable')
+        self._split_offsets = np.searchsorted(split_codes[self._split_order], np.arange(len(splits) + 1))
+
+    def __len__(self):
+        return len(self.start)
+
+    @classmethod
+    def from_bed(cls, bed: str, label_column_idx: int = 6):
+        """
+        Parse a bed file. The split of each row is taken from the last column.
+
+        Parameters
+        ----------
+        bed : str
+            Path to the bed file.
+        label_column_idx : int, optional
+            Column of the labels, if the bed file has no `label` column. The default is 6.
+
+        Returns
+        -------
+        BedIndex
+            The index.
+        """
+        f = pd.read_csv(bed, header = 'infer', sep = '\t', low_memory=False, dtype = str)
+
+        chroms, chrom_codes = _factorize(f.iloc[:, 0])
+        splits, split_codes = _factorize(f.iloc[:, -1])
+
+        strand_column_idx = f.columns.get_loc('strand') if 'strand' in f.columns else 3
+        if strand_column_idx < f.shape[1] - 1:
+            strand = f.iloc[:, strand_column_idx].to_numpy(dtype = str)
+        else:
+            strand = np.full(len(f), '+')
+
+        label_column_idx = f.columns.get_loc('label') if 'label' in f.columns else label_column_idx
+        labels = f.iloc[:, label_column_idx] if label_column_idx < f.shape[1] else [None] * len(f)
+        labels = [list(map(int, x.split(','))) if isinstance(x, str) else [] for x in labels] # if no label for sample
+        label_offsets = np.zeros(len(labels) + 1, dtype = np.int64)
+        label_offsets[1:] = np.cumsum([len(x) for x in labels])
+        label_values = np.array([x for row in labels for x in row], dtype = np.int64)
+
+        return cls(chroms, chrom_codes,
+                   f.iloc[:, 1].to_numpy(dtype = np.int64), f.iloc[:, 2].to_numpy(dtype = np.int64), strand,
+                   label_values, label_offsets, splits, split_codes)
+
+    @classmethod
+    def load(cls, bed: str, label_column_idx: int = 6):
+        """
+        Get the index of a bed file. Reads the sidecar file `{bed}.index.npz` if it is up to date,
+        otherwise parses the bed file and tries to write the sidecar file.
+
+        Parameters
+        ----------
+        bed : str
+            Path to the bed file.
+        label_column_idx : int, optional
+            Column of the labels, if the bed file has no `label` column. The default is 6.
+
+        Returns
+        -------
+        BedIndex
+            The index.
+        """
+        index_path = f'{bed}.index.npz'
+        stat = os.stat(bed)
+        source = np.array([stat.st_size, stat.st_mtime_ns, label_column_idx], dtype = np.int64)
+        if os.path.exists(index_path):
+            with np.load(index_path) as columns:
+                if np.array_equal(columns['source'], source):
+                    return cls(**{k: columns[k] for k in cls._columns})
+
+        index = cls.from_bed(bed, label_column_idx = label_column_idx)
+        try:
+            tmp_path = f'{index_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, source = source, **{k: getattr(index, k) for k in cls._columns})
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            print(f'Could not save bed index to {index_path}: {e}')
+        return index
+
+    def split_rows(self, split: str = None) -> np.ndarray:
+        """
+        Get the rows of a split.
+
+        Parameters
+        ----------
+        split : str, optional
+            Name of the split. If None, all rows are returned.
+
+        Returns
+        -------
+        np.ndarray
+            Row numbers in the bed file, in file order.
+        """
+        if split is None:
+            return np.arange(len(self))
+        code = np.flatnonzero(self.splits == split)
+        if len(code) == 0:
+            return self._split_order[:0]
+        return self._split_order[self._split_offsets[code[0]]:self._split_offsets[code[0] + 1]]
+
+    def chunk_positions(self, split: str = None, chunk: int = None, chunk_size: int = None,
+                        shuffle_seed: int = None) -> np.ndarray:
+        """
+        Get the positions of the rows of a chunk within their split.
+
+        Parameters
+        ----------
+        split : str, optional
+            Name of the split. If None, all rows are used.
+        chunk : int, optional
+            Chunk id. If None, all rows of the split are returned.
+        chunk_size : int, optional
+            Number of rows per chunk.
+        shuffle_seed : int, optional
+            If given, the rows of the split are permuted with this seed before they are 
+            divided into chunks, so that every chunk holds a random sample of the split 
+            in random order. The default is None, which keeps the file order.
+
+        Returns
+        -------
+        np.ndarray
+            Positions within the split, i.e. indices into `split_rows(split)`.
+        """
+        n_rows = len(self.split_rows(split))
+        if shuffle_seed is not None:
+            positions = np.random.default_rng(shuffle_seed).permutation(n_rows)
+        else:
+            positions = np.arange(n_rows)
+        if chunk is None:
+            return positions
+        # check if chunk is valid
+        if chunk * chunk_size > n_rows:
+            raise ValueError(f'Requested chunk {chunk}, but chunk ids range from 0-{int(n_rows / chunk_size)}')
+        return positions[chunk * chunk_size:(chunk + 1) * chunk_size]
+
+    def chunk_rows(self, split: str = None, chunk: int = None, chunk_size: int = None,
+                   shuffle_seed: int = None) -> np.ndarray:
+        """
+        Get the rows of a chunk of a split.
+
+        Parameters
+        ----------
+        split : str, optional
+            Name of the split. If None, all rows are used.
+        chunk : int, optional
+            Chunk id. If None, all rows of the split are returned.
+        chunk_size : int, optional
+            Number of rows per chunk.
+        shuffle_seed : int, optional
+            If given, chunks hold a random sample of the split, see `chunk_positions`.
+            The default is None.
+
+        Returns
+        -------
+        np.ndarray
+            Row numbers in the bed file, in file order unless shuffle_seed is given.
+        """
+        return self.split_rows(split)[self.chunk_positions(split, chunk, chunk_size, shuffle_seed)]
+
+    def region(self, row: int, read_strand: bool = True):
+        """
+        Get the coordinates of a row.
+
+        Parameters
+        ----------
+        row : int
+            Row number in the bed file.
+        read_strand : bool, optional
+            Whether to return the strand of the row. If False, the strand is '+'. The default is True.
+
+        Returns
+        -------
+        Tuple[str, int, int, str]
+            Chromosome, start, end and strand.
+        """
+        strand = self.strand[row] if read_strand else '+'
+        return self.chroms[self.chrom_codes[row]], int(self.start[row]), int(self.end[row]), strand
+
+    def labels(self, row: int) -> np.ndarray:
+        """Get the labels of a row."""
+        return self.label_values[self.label_offsets[row]:self.label_offsets[row + 1]]
+
+
+def _factorize(column):
+    codes, names = pd.factorize(column)
+    return names.to_numpy(dtype = str), codes.astype(np.int32)
@@ -0,0 +1,296 @@
+"""
+flatstore.py
+============
+A flat, memory-mappable alternative to webdataset tar shards.
+
+A flat store consists of an index file and raw data files next to it:
+
+- ``{path}``: npz index with the sample keys and the offsets of each sample in the data files.
+- ``{path}.inputs``: the embeddings of all samples, concatenated along the sequence axis.
+- ``{path}.labels``: the labels of all samples, concatenated along their first axis.
+- ``{path}.scales``: per-channel scales of each sample, only for int8 storage.
+- ``{path}.lengths``: number of nucleotides of each token, only for token resolution storage.
+
+The data files are read with ``np.memmap``, so that a sample, or a window of a sample,
+can be read without decoding anything else. The index is written last, so a store is
+complete once its index exists. Like :class:`bend.io.shards.ShardWriter`, the writer can
+keep a journal and continue after the last committed sample.
+"""
+import os
+import json
+import numpy as np
+from bend.io.shards import encode_embedding, decode_embedding, STORAGE_DTYPES
+from bend.utils.timing import stage
+
+FLAT_EXTENSION = '.flat'
+_DATA_FILES = ['inputs', 'labels', 'scales', 'lengths']
+_OPTIONAL_FILES = ['scales', 'lengths']
+
+
+def find_flat_stores(directory: str) -> list:
+    """Get the index paths of all flat stores in a directory."""
+    return sorted(os.path.join(directory, x) for x in os.listdir(directory) if x.endswith(FLAT_EXTENSION))
+
+
+def _as_rows(array: np.ndarray) -> np.ndarray:
+    """Drop a leading batch axis of size 1, so that the first axis is the sequence axis."""
+    array = np.asarray(array)
+    if array.ndim == 0:
+        return array.reshape(1)
+    if array.ndim > 1 and array.shape[0] == 1:
+        return array[0]
+    return array
+
+
+class FlatStoreWriter():
+    """Write samples to a flat store. Has the same interface as `bend.io.shards.ShardWriter`."""
+    def __init__(self, path: str, journal: bool = False, commit_every: int = 1000,
+                 storage_dtype: str = 'float32') -> None:
+        """
+        Open a flat store for writing.
+
+        Parameters
+        ----------
+        path : str
+            Path of the index of the store. The data files are written next to it.
+        journal : bool, optional
+            Whether to keep a journal of committed samples in `{path}.journal`. If the journal
+            exists already, writing continues after the last committed sample. The default is False.
+        commit_every : int, optional
+            Number of samples after which the data files are synced to disk and the written samples
+            are committed to the journal. Only used if journal is True. The default is 1000.
+        storage_dtype : str, optional
+            Dtype in which the embeddings are stored. See `bend.io.shards.encode_embedding`.
+            The default is 'float32'.
+        """
+        if storage_dtype not in STORAGE_DTYPES:
+            raise ValueError(f'Unknown storage dtype {storage_dtype}, choose from {STORAGE_DTYPES}')
+        self.path = path
+        self.storage_dtype = storage_dtype
+        self.journal_path = f'{path}.journal' if journal else None
+        self.commit_every = commit_every
+        self.committed = set()
+
+        # index columns, one entry per sample
+        self._keys, self._input_lengths, self._label_lengths = [], [], []
+        self._layout = None # dtypes and trailing shapes of the arrays, set by the first sample
+        self._per_position = True # whether every sample has one label per nucleotide
+        self._n_committed = 0
+
+        if journal and os.path.exists(self.journal_path):
+            self._read_journal()
+        if self._n_committed == 0:
+            if os.path.exists(path):
+                os.remove(path) # the index of a previous run no longer matches the data files
+            if journal:
+                open(self.journal_path, 'w').close()
+
+        # drop everything written after the last commit
+        mode = 'r+b' if self._n_committed > 0 else 'wb'
+        self._files = {}
+        for name in _DATA_FILES:
+            data_path = f'{path}.{name}'
+            f = open(data_path, mode if os.path.exists(data_path) else 'wb')
+            f.truncate(self._nbytes(name))
+            f.seek(self._nbytes(name))
+            self._files[name] = f
+
+    def _read_journal(self):
+        with open(self.journal_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break # incomplete last line
+                self._layout = entry['layout']
+                self._keys.extend(entry['keys'])
+                self._input_lengths.extend(entry['input_lengths'])
+                self._label_lengths.extend(entry['label_lengths'])
+                self._per_position = self._per_position and entry.get('per_position', False)
+        self._n_committed = len(self._keys)
+        self.committed = set(self._keys)
+
+    def _nbytes(self, name: str) -> int:
+        """Size of a data file up to the last commit."""
+        if self._layout is None or not self._layout[name]:
+            return 0
+        n_rows = {'inputs': sum(self._input_lengths), 'labels': sum(self._label_lengths),
+                  'scales': len(self._keys), 'lengths': sum(self._input_lengths)}[name]
+        dtype, shape = self._layout[name]
+        return n_rows * int(np.prod(shape, dtype = np.int64)) * np.dtype(dtype).itemsize
+
+    def write(self, sample: dict):
+        """
+        Write a sample.
+
+        Parameters
+        ----------
+        sample : dict
+            The sample, with a `__key__`, the embedding as `input.npy` and the labels as `output.npy`.
+            Embeddings at token resolution come with the length of each token as `input_lengths.npy`.
+        """
+        with stage('serialization'):
+            encoded = encode_embedding(_as_rows(sample['input.npy']), self.storage_dtype)
+            arrays = {'inputs': encoded['input.npy'], 'labels': _as_rows(sample['output.npy'])}
+            if 'input_scale.npy' in encoded:
+                arrays['scales'] = encoded['input_scale.npy'][None]
+            if 'input_lengths.npy' in sample:
+                arrays['lengths'] = np.asarray(sample['input_lengths.npy']).reshape(-1)
+
+        layout = {name: [x.dtype.str, list(x.shape[1:])] for name, x in arrays.items()}
+        for name in _OPTIONAL_FILES:
+            layout.setdefault(name, False)
+        if self._layout is None:
+            self._layout = layout
+        elif layout != self._layout:
+            raise ValueError(f'Sample {sample["__key__"]} does not match the dtype and shape of the previous samples in {self.path}')
+
+        # flat stores are not compressed, only written
+        with stage('write'):
+            for name, x in arrays.items():
+                self._files[name].write(np.ascontiguousarray(x).tobytes())
+        self._keys.append(sample['__key__'])
+        self._input_lengths.append(len(arrays['inputs']))
+        self._label_lengths.append(len(arrays['labels']))
+        n_nucleotides = int(arrays['lengths'].sum()) if 'lengths' in arrays else len(arrays['inputs'])
+        self._per_position = self._per_position and len(arrays['labels']) == n_nucleotides
+
+        if self.journal_path is not None and len(self._keys) - self._n_committed >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        """Sync the data files to disk and add all samples written since the last commit to the journal."""
+        with stage('commit'):
+            for f in self._files.values():
+                f.flush()
+                os.fsync(f.fileno())
+        n = self._n_committed
+        entry = {'layout': self._layout, 'keys': self._keys[n:],
+                 'input_lengths': self._input_lengths[n:], 'label_lengths': self._label_lengths[n:],
+                 'per_position': self._per_position}
+        with open(self.journal_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.committed.update(self._keys[n:])
+        self._n_committed = len(self._keys)
+
+    def close(self):
+        """Finish the store by writing its index. With a journal, the journal is removed."""
+        for f in self._files.values():
+            f.close()
+        layout = self._layout if self._layout is not None else {'inputs': ['<f4', [0]], 'labels': ['<f4', [0]], 'scales': False, 'lengths': False}
+        index = {'keys': np.array(self._keys, dtype = str),
+                 'input_offsets': np.concatenate([[0], np.cumsum(self._input_lengths, dtype = np.int64)]),
+                 'label_offsets': np.concatenate([[0], np.cumsum(self._label_lengths, dtype = np.int64)]),
+                 'layout': np.array(json.dumps(layout)),
+                 'per_position_labels': np.array(self._per_position and len(self._keys) > 0)}
+        for name in _OPTIONAL_FILES:
+            if not layout[name]:
+                os.remove(f'{self.path}.{name}')
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **index)
+        os.replace(tmp_path, self.path)
+        if self.journal_path is not None:
+            os.remove(self.journal_path)
+
+
+class FlatStore():
+    """Read a flat store with memory mapped data files."""
+    def __init__(self, path: str) -> None:
+        """
+        Open a flat store.
+
+        Parameters
+        ----------
+        path : str
+            Path of the index of the store.
+        """
+        self.path = path
+        with np.load(path) as index:
+            self.keys = index['keys']
+            self.input_offsets = index['input_offsets']
+            self.label_offsets = index['label_offsets']
+            layout = json.loads(str(index['layout']))
+            # stores written before the flag existed tell per-position labels apart by their length
+            self.per_position_labels = bool(index['per_position_labels']) if 'per_position_labels' in index else None
+
+        self.inputs = self._memmap('inputs', *layout['inputs'], self.input_offsets[-1])
+        self.labels = self._memmap('labels', *layout['labels'], self.label_offsets[-1])
+        self.scales = self._memmap('scales', *layout['scales'], len(self.keys)) if layout['scales'] else None
+        self.token_lengths = self._memmap('lengths', *layout['lengths'], self.input_offsets[-1]) if layout.get('lengths') else None
+
+    def _memmap(self, name, dtype, shape, n_rows):
+        if n_rows == 0:
+            return np.zeros((0, *shape), dtype = dtype)
+        # copy-on-write, so that torch gets writable arrays without copying them
+        return np.memmap(f'{self.path}.{name}', dtype = dtype, mode = 'c', shape = (int(n_rows), *shape))
+
+    def __getstate__(self):
+        # reopen the memory maps instead of pickling their contents, e.g. for dataloader workers
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def length(self, i: int) -> int:
+        """Sequence length of sample i, in nucleotides."""
+        if self.token_lengths is not None:
+            return int(self.token_lengths[self.input_offsets[i]:self.input_offsets[i + 1]].sum())
+        return int(self.input_offsets[i + 1] - self.input_offsets[i])
+
+    def read(self, i: int, start: int = None, end: int = None):
+        """
+        Read a sample, or a window of it.
+
+        Parameters
+        ----------
+        i : int
+            Index of the sample.
+        start : int, optional
+            First position of the window along the sequence axis. The default is the start of the sample.
+        end : int, optional
+            End of the window along the sequence axis. The default is the end of the sample.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            The float32 embedding and the labels. If all samples of the store have one label
+            per position (`per_position_labels`), the labels are cropped to the same window. Embeddings stored as float32 at nucleotide resolution 
+            are views into the memory map. Embeddings stored at token resolution are upsampled
+            to nucleotide resolution, reading only the tokens that overlap the window.
+        """
+        input_start, input_end = self.input_offsets[i], self.input_offsets[i + 1]
+        label_start, label_end = self.label_offsets[i], self.label_offsets[i + 1]
+        length = self.length(i)
+        start, end, _ = slice(start, end).indices(length)
+        end = max(start, end)
+
+        sample = {}
+        if self.token_lengths is not None:
+            # find the tokens that overlap the window and trim their lengths to it
+            lengths = self.token_lengths[input_start:input_end]
+            token_ends = np.cumsum(lengths)
+            first = int(np.searchsorted(token_ends, start, side = 'right'))
+            last = int(np.searchsorted(token_ends, end - 1, side = 'right')) if end > start else first - 1
+            counts = np.array(lengths[first:last + 1], dtype = np.int64)
+            if len(counts) > 0:
+                counts[0] -= start - (token_ends[first] - lengths[first])
+                counts[-1] -= token_ends[last] - end
+            sample['input.npy'] = self.inputs[input_start + first:input_start + last + 1]
+            sample['input_lengths.npy'] = counts
+        else:
+            sample['input.npy'] = self.inputs[input_start + start:input_start + end]
+        if self.scales is not None:
+            sample['input_scale.npy'] = self.scales[i]
+
+        per_position = self.per_position_labels if self.per_position_labels is not None else label_end - label_start == length
+        if per_position:
+            labels = self.labels[label_start + start:label_start + end]
+        else:
+            labels = self.labels[label_start:label_end]
+        return decode_embedding(sample)['input.npy'], labels
@@ -0,0 +1,329 @@
+"""
+genomestore.py
+==============
+Embeddings of whole genomic regions, stored once per model and reference genome and
+indexed by coordinates.
+
+Tasks that share a reference genome often embed overlapping intervals, and every task embeds
+its own. A genome store embeds the merged regions of the bed files of all tasks (or whole
+chromosomes) once, and the embeddings of a task are sliced from it by the coordinates of its
+intervals, see the `genome_store` argument of :func:`bend.io.sequtils.embed_from_bed`.
+
+Regions are embedded in tiles of a fixed length that overlap their neighbours. Positions in
+the overlap of two tiles take their embedding from the tile whose center is closer, so that
+every position is embedded with context on both sides, except at the ends of a region. Note that
+slices of a store are embeddings in the context of their region, so they differ from embeddings
+of the intervals on their own.
+
+Like a flat store (see :mod:`bend.io.flatstore`), a genome store consists of an index and raw data files:
+
+- ``{path}``: npz index with the chromosome, start, end and offset of each region.
+- ``{path}.inputs``: nucleotide resolution embeddings of the forward strand of all regions.
+- ``{path}.reverse``: embeddings of the reverse complement, in forward coordinates. Optional.
+
+The index is written last, so a store is complete once its index exists. While a store is built,
+progress is kept in ``{path}.journal``, and building it again continues after the last committed region.
+"""
+import os
+import json
+import itertools
+import numpy as np
+import pysam
+from tqdm.auto import tqdm
+from bend.io.bedindex import BedIndex
+from bend.io.shards import encode_embedding, decode_embedding
+
+GENOME_EXTENSION = '.genome'
+GENOME_STORAGE_DTYPES = ['float32', 'float16', 'bfloat16']
+# as bend.io.sequtils.reverse_complement, other bases become N
+_COMPLEMENT = str.maketrans('ACGTBDHKMNRSVWY', 'TGCANNNNNNNNNNN')
+
+
+def merge_regions(beds, reference_fasta: str, flank: int = 0, whole_chromosomes: bool = False, label_column_idx: int = 6) -> list:
+    """
+    Get the regions covered by the intervals of one or more bed files.
+
+    Parameters
+    ----------
+    beds : List[str]
+        Paths to the bed files.
+    reference_fasta : str
+        Path to the reference genome, to clip regions to the length of their chromosome.
+    flank : int or List[int], optional
+        Number of bases added to both sides of each interval, for all bed files or for each of them.
+        The default is 0.
+    whole_chromosomes : bool, optional
+        Whether to return the chromosomes of the intervals in full instead. The default is False.
+    label_column_idx : int or List[int], optional
+        Column of the labels, for all bed files or for each of them, as in `bend.io.sequtils.embed_from_bed`,
+        so that both use the same index of the bed file. The default is 6.
+
+    Returns
+    -------
+    List[Tuple[str, int, int]]
+        Non-overlapping regions, sorted by chromosome and start.
+    """
+    flanks = flank if isinstance(flank, (list, tuple)) else [flank] * len(beds)
+    label_columns = label_column_idx if isinstance(label_column_idx, (list, tuple)) else [label_column_idx] * len(beds)
+    fasta = pysam.FastaFile(reference_fasta)
+    lengths = dict(zip(fasta.references, fasta.lengths))
+    intervals = {}
+    for bed, flank, label_column_idx in zip(beds, flanks, label_columns):
+        index = BedIndex.load(bed, label_column_idx = label_column_idx)
+        chroms = index.chroms[index.chrom_codes]
+        for chrom in np.unique(chroms):
+            rows = chroms == chrom
+            intervals.setdefault(str(chrom), []).append(np.stack([index.start[rows] - flank, index.end[rows] + flank], axis = 1))
+
+    regions = []
+    for chrom in sorted(intervals):
+        if chrom not in lengths:
+            raise ValueError(f'{chrom} is not in {reference_fasta}')
+        if whole_chromosomes:
+            regions.append((chrom, 0, lengths[chrom]))
+            continue
+        spans = np.concatenate(intervals[chrom])
+        spans = np.clip(spans[np.argsort(spans[:, 0], kind = 'stable')], 0, lengths[chrom])
+        start, end = spans[0]
+        for s, e in spans[1:]:
+            if s > end:
+                regions.append((chrom, int(start), int(end)))
+                start, end = s, e
+            else:
+                end = max(end, e)
+        regions.append((chrom, int(start), int(end)))
+    return regions
+
+
+def tile_region(start: int, end: int, tile_length: int, overlap: int) -> list:
+    """
+    Divide a region into overlapping tiles.
+
+    Returns
+    -------
+    List[Tuple[int, int, int, int]]
+        Start and end of each tile, and start and end of the part of the region whose embedding
+        is taken from the tile. The parts are contiguous and cover the region.
+    """
+    if end - start <= tile_length:
+        return [(start, end, start, end)]
+    starts = list(range(start, end - tile_length, tile_length - overlap)) + [end - tile_length]
+    ends = [s + tile_length for s in starts]
+    # switch tiles in the middle of their overlap
+    bounds = [start] + [(starts[i + 1] + ends[i]) // 2 for i in range(len(starts) - 1)] + [end]
+    return [(starts[i], ends[i], bounds[i], bounds[i + 1]) for i in range(len(starts))]
+
+
+def _embed_regions(fasta, embedder, regions, strand, tile_length, overlap, batch_size):
+    """
+    Embed regions tile by tile, with tiles of several regions in each batch.
+    Yields the stitched embedding of each region, in forward coordinates.
+    """
+    def tiles():
+        for chrom, start, end in regions:
+            region_tiles = tile_region(start, end, tile_length, overlap)
+            for j, tile in enumerate(region_tiles):
+                yield chrom, tile, j == len(region_tiles) - 1
+
+    parts, batch = [], []
+    for item in itertools.chain(tiles(), [None]):
+        if item is not None:
+            batch.append(item)
+        if len(batch) == 0 or (item is not None and len(batch) < batch_size):
+            continue
+        sequences = [fasta.fetch(chrom, s, e).upper() for chrom, (s, e, _, _), _ in batch]
+        if strand == '-':
+            sequences = [x[::-1].translate(_COMPLEMENT) for x in sequences]
+        embeddings = embedder.embed(sequences, upsample_embeddings = True, disable_tqdm = True, batch_size = batch_size)
+        for (chrom, (s, e, keep_start, keep_end), last), embedding in zip(batch, embeddings):
+            embedding = np.asarray(embedding)[0] # drop the batch axis
+            if len(embedding) != e - s:
+                raise ValueError(f'Embedding length does not match sequence length ({len(embedding)} != {e - s} : {chrom}:{s}-{e}{strand})')
+            if strand == '-':
+                embedding = embedding[::-1]
+            parts.append(embedding[keep_start - s:keep_end - s])
+            if last:
+                yield np.concatenate(parts)
+                parts = []
+        batch = []
+
+
+def build_genome_store(regions, reference_fasta: str, embedder, path: str, tile_length: int, overlap: int = 0,
+                       batch_size: int = 1, storage_dtype: str = 'float32', reverse_complement: bool = False,
+                       commit_every: int = 1000000):
+    """
+    Embed regions of a reference genome into a genome store.
+
+    Parameters
+    ----------
+    regions : List[Tuple[str, int, int]]
+        Non-overlapping regions, e.g. from `merge_regions`.
+    reference_fasta : str
+        Path to the reference genome fasta file.
+    embedder : bend.utils.embedders.BaseEmbedder
+        The embedder. Embeddings are upsampled to nucleotide resolution.
+    path : str
+        Path of the index of the store. If it exists, the store is complete and nothing is embedded.
+    tile_length : int
+        Length of the sequences that are embedded, e.g. the maximum input length of the model.
+    overlap : int, optional
+        Number of bases shared by neighbouring tiles. Each position is at least overlap / 2 bases
+        from the end of the tile it is taken from, unless it is near the end of a region.
+        The default is 0.
+    batch_size : int, optional
+        Number of tiles passed to `embedder.embed` at once. The default is 1.
+    storage_dtype : str, optional
+        One of 'float32', 'float16' and 'bfloat16'. The default is 'float32'.
+    reverse_complement : bool, optional
+        Whether to embed the reverse complement of the regions as well, for tasks that read
+        the strand of their intervals. The default is False.
+    commit_every : int, optional
+        Number of positions after which the data files are synced and the progress is committed
+        to the journal. The default is 1000000.
+    """
+    if storage_dtype not in GENOME_STORAGE_DTYPES:
+        raise ValueError(f'Unknown storage dtype {storage_dtype} for genome stores, choose from {GENOME_STORAGE_DTYPES}')
+    if not 0 <= overlap < tile_length:
+        raise ValueError('overlap needs to be smaller than tile_length')
+    if os.path.exists(path):
+        print(f'{path} is complete, skipping')
+        return
+
+    fasta = pysam.FastaFile(reference_fasta)
+    names = ['inputs', 'reverse'] if reverse_complement else ['inputs']
+    journal_path = f'{path}.journal'
+    done, rows, layout = 0, 0, None
+    if os.path.exists(journal_path):
+        with open(journal_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break # incomplete last line
+                done, rows, layout = entry['regions'], entry['rows'], entry['layout']
+    if done > 0:
+        print(f'Resuming {path} after {done} regions')
+    else:
+        open(journal_path, 'w').close()
+
+    # drop everything written after the last commit
+    files = {}
+    for name in names:
+        data_path = f'{path}.{name}'
+        f = open(data_path, 'r+b' if done > 0 and os.path.exists(data_path) else 'wb')
+        nbytes = rows * int(np.prod(layout[1])) * np.dtype(layout[0]).itemsize if layout is not None else 0
+        f.truncate(nbytes)
+        f.seek(nbytes)
+        files[name] = f
+
+    committed = rows
+    strands = [_embed_regions(fasta, embedder, regions[done:], strand, tile_length, overlap, batch_size) for strand in '+-'[:len(names)]]
+    embedded = tqdm(zip(range(done, len(regions)), *strands), initial = done, total = len(regions), desc = 'Embedding regions')
+    for i, *embeddings in embedded:
+        chrom, start, end = regions[i]
+        for name, embedding in zip(names, embeddings):
+            embedding = encode_embedding(embedding, storage_dtype)['input.npy']
+            layout = layout if layout is not None else [embedding.dtype.str, list(embedding.shape[1:])]
+            files[name].write(np.ascontiguousarray(embedding).tobytes())
+        rows += end - start
+        if rows - committed >= commit_every or i == len(regions) - 1:
+            for f in files.values():
+                f.flush()
+                os.fsync(f.fileno())
+            with open(journal_path, 'a') as f:
+                f.write(json.dumps({'regions': i + 1, 'rows': rows, 'layout': layout}) + '\n')
+            committed = rows
+    for f in files.values():
+        f.close()
+
+    chroms, starts, ends = zip(*regions) if len(regions) > 0 else ([], [], [])
+    index = {'chroms': np.array(chroms, dtype = str), 'starts': np.array(starts, dtype = np.int64),
+             'ends': np.array(ends, dtype = np.int64),
+             'offsets': np.concatenate([[0], np.cumsum(np.array(ends, dtype = np.int64) - np.array(starts, dtype = np.int64))]),
+             'layout': np.array(json.dumps({'inputs': layout, 'reverse': reverse_complement,
+                                            'storage_dtype': storage_dtype, 'tile_length': tile_length,
+                                            'overlap': overlap, 'reference': os.path.basename(reference_fasta)}))}
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **index)
+    os.replace(tmp_path, path)
+    os.remove(journal_path)
+
+
+class GenomeStore():
+    """Read embeddings of genomic intervals from a genome store."""
+    def __init__(self, path: str) -> None:
+        """
+        Open a genome store.
+
+        Parameters
+        ----------
+        path : str
+            Path of the index of the store.
+        """
+        self.path = path
+        with np.load(path) as index:
+            chroms, starts, ends, self.offsets = index['chroms'], index['starts'], index['ends'], index['offsets']
+            self.layout = json.loads(str(index['layout']))
+        # regions of each chromosome, sorted by start
+        self.regions = {}
+        for chrom in np.unique(chroms):
+            i = np.flatnonzero(chroms == chrom)
+            i = i[np.argsort(starts[i])]
+            self.regions[str(chrom)] = (starts[i], ends[i], self.offsets[i])
+        dtype, shape = self.layout['inputs'] if self.layout['inputs'] is not None else ('<f4', [0])
+        n_rows = int(self.offsets[-1])
+        self.inputs = self._memmap('inputs', dtype, shape, n_rows)
+        self.reverse = self._memmap('reverse', dtype, shape, n_rows) if self.layout['reverse'] else None
+
+    def _memmap(self, name, dtype, shape, n_rows):
+        if n_rows == 0:
+            return np.zeros((0, *shape), dtype = dtype)
+        return np.memmap(f'{self.path}.{name}', dtype = dtype, mode = 'r', shape = (n_rows, *shape))
+
+    def __getstate__(self):
+        # reopen the memory maps instead of pickling their contents
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def fetch(self, chrom: str, start: int, end: int, strand: str = '+', flank: int = 0) -> np.ndarray:
+        """
+        Get the embedding of an interval, like `bend.io.sequtils.Fasta.fetch` gets its sequence.
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome name.
+        start : int
+            Start coordinate.
+        end : int
+            End coordinate.
+        strand : str, optional
+            Strand. If '-', the embedding of the reverse complement is returned, which requires a
+            store built with reverse_complement=True. The default is '+'.
+        flank : int, optional
+            Number of bases to add to the start and end coordinates. The default is 0.
+
+        Returns
+        -------
+        np.ndarray
+            The embedding, with a batch axis as returned by the embedders, e.g. of shape (1, length,
+            embedding dimension). Embeddings stored with reduced precision are returned as float32.
+        """
+        start, end = start - flank, end + flank
+        starts, ends, offsets = self.regions.get(str(chrom), (np.zeros(0, dtype = np.int64),) * 3)
+        i = int(np.searchsorted(starts, start, side = 'right')) - 1
+        if i < 0 or end > ends[i]:
+            raise ValueError(f'{chrom}:{start}-{end} is not covered by {self.path}')
+        first = int(offsets[i] + start - starts[i])
+        if strand == '+':
+            embedding = self.inputs[first:first + end - start]
+        elif strand == '-':
+            if self.reverse is None:
+                raise ValueError(f'{self.path} has no reverse complement embeddings, build it with reverse_complement=True')
+            embedding = self.reverse[first:first + end - start][::-1]
+        else:
+            raise ValueError(f'Unknown strand: {strand}')
+        return decode_embedding({'input.npy': np.array(embedding)})['input.npy'][None]
@@ -0,0 +1,75 @@
+"""
+labels.py
+=========
+Reading per-sample labels from the hdf5 file of a task.
+"""
+from collections import OrderedDict
+import numpy as np
+import h5py
+
+
+class HDF5LabelReader():
+    """
+    Reads the labels of a set of rows from a hdf5 dataset. Instead of loading the whole dataset,
+    rows are read in blocks that are aligned to the chunks of the dataset, and only the range
+    of rows within a block that is actually requested is read. Of each block, only the requested 
+    rows are kept in memory, so that rows in random order, e.g. of a shuffled chunk, are read 
+    with few block reads as long as their labels fit in the cache.
+    """
+    def __init__(self, hdf5_file: str, rows, dataset: str = 'labels',
+                 block_bytes: int = 16 * 2**20, cache_blocks: int = 4) -> None:
+        """
+        Open a hdf5 file for reading the labels of the given rows.
+
+        Parameters
+        ----------
+        hdf5_file : str
+            Path to the hdf5 file. Record i of the dataset belongs to row i of the bed file.
+        rows : np.ndarray
+            The rows that will be read, in any order.
+        dataset : str, optional
+            Name of the dataset. The default is 'labels'.
+        block_bytes : int, optional
+            Approximate size of a block. Blocks are a multiple of the chunk size of the dataset
+            along the first axis. The default is 16 MiB.
+        cache_blocks : int, optional
+            Size of the cache in blocks. The cache holds the requested rows of as many blocks 
+            as fit into `cache_blocks * block_bytes`. The default is 4.
+        """
+        self._file = h5py.File(hdf5_file, mode = 'r')
+        self.dataset = self._file[dataset]
+        self.cache_bytes = cache_blocks * block_bytes
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+
+        row_bytes = max(1, int(np.prod(self.dataset.shape[1:])) * self.dataset.dtype.itemsize)
+        chunk_rows = self.dataset.chunks[0] if self.dataset.chunks is not None else 1
+        self.block_rows = chunk_rows * max(1, block_bytes // (chunk_rows * row_bytes))
+
+        # the requested rows of each block
+        rows = np.unique(np.asarray(rows))
+        blocks, first = np.unique(rows // self.block_rows, return_index = True)
+        self._rows = dict(zip(blocks.tolist(), np.split(rows, first[1:])))
+
+    def __getitem__(self, row: int) -> np.ndarray:
+        """Get the labels of a row. The row needs to be one of the rows given when opening the reader."""
+        block = int(row) // self.block_rows
+        rows = self._rows[block]
+        if block in self._cache:
+            self._cache.move_to_end(block)
+        else:
+            start, end = int(rows[0]), int(rows[-1]) + 1
+            data = self.dataset[start:end]
+            if len(rows) < end - start:
+                data = data[rows - start]
+            self._cache[block] = data
+            self._cached_bytes += data.nbytes
+            while self._cached_bytes > self.cache_bytes and len(self._cache) > 1:
+                self._cached_bytes -= self._cache.popitem(last = False)[1].nbytes
+        return self._cache[block][np.searchsorted(rows, row)].copy()
+
+    def close(self):
+        """Close the hdf5 file."""
+        self._cache.clear()
+        self._cached_bytes = 0
+        self._file.close()
@@ -0,0 +1,157 @@
+"""
+leases.py
+=========
+Coordination of several processes that embed the chunks of the same task and model.
+
+Processes that share the output directory claim a chunk by creating a lease file next to its
+output. The lease is kept alive by a heartbeat thread while the chunk is embedded. Leases of
+processes that crashed stop receiving heartbeats and are taken over once they expire.
+"""
+import os
+import json
+import time
+import socket
+import threading
+
+
+class ChunkLease():
+    """A lease file that marks a chunk as claimed by this process."""
+    def __init__(self, output_path: str, timeout: float = 3600) -> None:
+        """
+        Get a lease for the chunk that is written to output_path.
+
+        Parameters
+        ----------
+        output_path : str
+            Output path of the chunk. The lease file is `{output_path}.lease`.
+        timeout : float, optional
+            Number of seconds without heartbeat after which a lease is considered stale.
+            The default is 3600.
+        """
+        self.path = f'{output_path}.lease'
+        self.timeout = timeout
+        self.owner = f'{socket.gethostname()}.{os.getpid()}'
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def _is_stale(self, path):
+        return time.time() - os.path.getmtime(path) > self.timeout
+
+    def _break_stale(self) -> bool:
+        """Remove the lease file if it is stale. Returns whether it was removed."""
+        try:
+            if not self._is_stale(self.path):
+                return False
+            # rename first, so that only one process can break the lease
+            stale_path = f'{self.path}.{self.owner}.stale'
+            os.rename(self.path, stale_path)
+        except FileNotFoundError:
+            return True # someone else removed it, try to create a new one
+        if not self._is_stale(stale_path):
+            # a fresh lease was created in the meantime, put it back. Unlike a rename, a link fails
+            # if yet another process has created a lease since, which must not be overwritten
+            try:
+                os.link(stale_path, self.path)
+            except OSError:
+                pass
+            os.remove(stale_path)
+            return False
+        print(f'Taking over stale lease {self.path}')
+        os.remove(stale_path)
+        return True
+
+    def acquire(self) -> bool:
+        """
+        Try to claim the chunk.
+
+        Returns
+        -------
+        bool
+            Whether the lease was acquired. If True, a heartbeat thread keeps it alive until `release`.
+        """
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                if not self._break_stale():
+                    return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'owner': self.owner, 'time': time.time()}, f)
+
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target = self._beat, daemon = True)
+        self._heartbeat.start()
+        return True
+
+    def _beat(self):
+        while not self._stop.wait(self.timeout / 4):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                return
+
+    def release(self):
+        """Stop the heartbeat and remove the lease file."""
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def is_written(output_path: str) -> bool:
+    """Whether the chunk at output_path has been written completely (it exists and has no journal).
+    Unlike `bend.io.manifest.is_complete`, the settings it was written with are not checked."""
+    return os.path.exists(output_path) and not os.path.exists(f'{output_path}.journal')
+
+
+def claim_chunks(jobs, timeout: float = 3600, poll_interval: float = None):
+    """
+    Claim the chunks of a list of jobs one at a time, until all of them are complete.
+
+    Chunks that are complete are skipped. If all incomplete chunks are leased by other
+    processes, wait for them to complete or for their leases to expire.
+
+    Parameters
+    ----------
+    jobs : List[dict]
+        Keyword arguments for `bend.io.sequtils.embed_from_bed`. Need an `output_path`.
+    timeout : float, optional
+        Number of seconds without heartbeat after which a lease is considered stale.
+        The default is 3600.
+    poll_interval : float, optional
+        Number of seconds to wait before checking again when all incomplete chunks are leased.
+        The default is a quarter of the timeout, but at most 60 seconds.
+
+    Yields
+    ------
+    Tuple[dict, ChunkLease]
+        A job and its acquired lease. The caller needs to release the lease when the job is done.
+    """
+    poll_interval = poll_interval if poll_interval is not None else min(60, timeout / 4)
+    while True:
+        pending = [job for job in jobs if not is_written(job['output_path'])]
+        if len(pending) == 0:
+            return
+        claimed = False
+        for job in pending:
+            lease = ChunkLease(job['output_path'], timeout = timeout)
+            # check again, it might have been completed while we were busy
+            if lease.acquire():
+                if is_written(job['output_path']):
+                    lease.release()
+                    continue
+                claimed = True
+                yield job, lease
+        if not claimed:
+            time.sleep(poll_interval)
@@ -0,0 +1,385 @@
+"""
+manifest.py
+===========
+A manifest of the shards of an embedding directory.
+
+Each directory of embeddings gets a ``manifest.json`` with one entry per shard (or flat store).
+An entry records the split and chunk of the shard, its number of samples and the range of their
+``sample_{n}`` keys, the dtypes and the range of shapes of the stored arrays, the size and sha256
+checksum of each of its files, and the settings it was embedded with. Entries are added by
+:func:`bend.io.sequtils.embed_from_bed` once a shard is complete.
+
+Several processes can write to the same directory, so the manifest is updated under a lock file
+and replaced atomically. The manifest lets reruns skip shards that are complete (see
+:func:`is_complete`), and lets the dataloaders list the shards of each split and know the
+exact number of samples without opening them.
+"""
+import os
+import json
+import time
+import socket
+import hashlib
+import tarfile
+import numpy as np
+
+MANIFEST_NAME = 'manifest.json'
+
+
+class ShardStats():
+    """Collects the number of samples, key range, dtypes and shapes of the samples of a shard."""
+    def __init__(self) -> None:
+        self.samples = 0
+        self.keys = [None, None]
+        self.arrays = {}
+        self.nbytes = 0 # uncompressed size of the arrays
+
+    def add(self, sample: dict):
+        """
+        Add a sample.
+
+        Parameters
+        ----------
+        sample : dict
+            The sample as it is written, with its `__key__` and the arrays of its files.
+        """
+        self.samples += 1
+        n = int(sample['__key__'].split('_')[-1])
+        self.keys = [n if self.keys[0] is None else min(self.keys[0], n),
+                     n if self.keys[1] is None else max(self.keys[1], n)]
+        for name, array in sample.items():
+            if name == '__key__':
+                continue
+            self.add_array(name, np.asarray(array).dtype, np.shape(array))
+
+    def add_array(self, name: str, dtype, shape):
+        """Add the dtype and shape of one array of a sample."""
+        shape = list(shape)
+        self.nbytes += int(np.prod(shape, dtype = np.int64)) * np.dtype(dtype).itemsize
+        if name not in self.arrays:
+            self.arrays[name] = {'dtype': str(np.dtype(dtype)), 'shape_min': shape, 'shape_max': shape}
+            return
+        summary = self.arrays[name]
+        if len(shape) != len(summary['shape_min']):
+            raise ValueError(f'Samples of {name} have different numbers of dimensions')
+        summary['shape_min'] = [min(a, b) for a, b in zip(summary['shape_min'], shape)]
+        summary['shape_max'] = [max(a, b) for a, b in zip(summary['shape_max'], shape)]
+
+    def to_dict(self) -> dict:
+        return {'samples': self.samples, 'key_range': self.keys, 'nbytes': self.nbytes, 'arrays': self.arrays}
+
+
+def scan_shard(path: str) -> ShardStats:
+    """
+    Collect the statistics of a shard or flat store from its contents.
+
+    Used for shards that were not written in one go, e.g. resumed ones. Tar shards are
+    decompressed, but only the headers of the arrays are parsed. Flat stores are read from their index.
+    """
+    from bend.io.shards import open_shard, shard_codec
+    from bend.io.flatstore import FlatStore, FLAT_EXTENSION
+    stats = ShardStats()
+    if path.endswith(FLAT_EXTENSION):
+        store = FlatStore(path)
+        # the same names as the files of a tar shard
+        data = {'input.npy': (store.inputs, store.input_offsets), 'output.npy': (store.labels, store.label_offsets)}
+        if store.token_lengths is not None:
+            data['input_lengths.npy'] = (store.token_lengths, store.input_offsets)
+        for i, key in enumerate(store.keys):
+            stats.samples += 1
+            n = int(str(key).split('_')[-1])
+            stats.keys = [n if stats.keys[0] is None else min(stats.keys[0], n),
+                          n if stats.keys[1] is None else max(stats.keys[1], n)]
+            for name, (array, offsets) in data.items():
+                stats.add_array(name, array.dtype, (int(offsets[i + 1] - offsets[i]), *array.shape[1:]))
+            if store.scales is not None:
+                stats.add_array('input_scale.npy', store.scales.dtype, store.scales.shape[1:])
+        return stats
+
+    with open(path, 'rb') as f:
+        stream = open_shard(f, shard_codec(path))
+        key = None
+        with tarfile.open(fileobj = stream, mode = 'r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                prefix, name = member.name.split('.', 1)
+                if prefix != key:
+                    key = prefix
+                    n = int(key.split('_')[-1])
+                    stats.samples += 1
+                    stats.keys = [n if stats.keys[0] is None else min(stats.keys[0], n),
+                                  n if stats.keys[1] is None else max(stats.keys[1], n)]
+                array = tar.extractfile(member)
+                version = np.lib.format.read_magic(array)
+                read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+                shape, _, dtype = read_header(array)
+                stats.add_array(name, dtype, shape)
+        stream.close()
+    return stats
+
+
+def shard_files(path: str) -> list:
+    """Get the files of a shard: the tar file, or the index and data files of a flat store."""
+    from bend.io.flatstore import FLAT_EXTENSION, _DATA_FILES
+    if path.endswith(FLAT_EXTENSION):
+        return [path] + [f'{path}.{name}' for name in _DATA_FILES if os.path.exists(f'{path}.{name}')]
+    return [path]
+
+
+def checksum(path: str, block_size: int = 1 << 20) -> str:
+    """Get the sha256 checksum of a file."""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_stamp(path: str) -> list:
+    """Identify a version of a file by its size and modification time, without reading it. Returns None for no file."""
+    if path is None:
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def shard_settings(chunk_size: int = None, shuffle_seed: int = None, storage_dtype: str = 'float32',
+                   token_level: bool = False, upsample_embeddings: bool = False, flank: int = 0,
+                   read_strand: bool = False, projection: str = None, genome_store: str = None,
+                   bed: str = None, reference_fasta: str = None, hdf5_file: str = None,
+                   label_depth: int = None, label_column_idx: int = 6, **kwargs) -> dict:
+    """
+    Get the settings of `bend.io.sequtils.embed_from_bed` that determine the contents of a shard.
+
+    A shard is only considered complete if it was written with the same settings. Projections
+    and genome stores are identified by the checksum of their (index) file. The bed file, the
+    reference genome and the hdf5 file of the labels can be large, and are identified by their
+    size and modification time (see `file_stamp`). Other keyword arguments are ignored.
+    """
+    settings = {'chunk_size': chunk_size, 'shuffle_seed': shuffle_seed, 'storage_dtype': storage_dtype,
+                'token_level': token_level, 'upsample_embeddings': upsample_embeddings, 'flank': flank,
+                'read_strand': read_strand,
+                'projection': checksum(projection) if projection is not None else None,
+                'bed': file_stamp(bed), 'reference_fasta': file_stamp(reference_fasta),
+                'hdf5_file': file_stamp(hdf5_file), 'label_depth': label_depth, 'label_column_idx': label_column_idx}
+    if genome_store is not None:
+        settings['genome_store'] = checksum(genome_store)
+    return settings
+
+
+def shard_entry(path: str, stats: ShardStats, split: str = None, chunk: int = None, settings: dict = None) -> dict:
+    """
+    Make the manifest entry of a complete shard.
+
+    Parameters
+    ----------
+    path : str
+        Path of the shard.
+    stats : ShardStats
+        Statistics of its samples.
+    split : str, optional
+        Split of the samples.
+    chunk : int, optional
+        Chunk of the split.
+    settings : dict, optional
+        Settings the shard was written with, see `shard_settings`.
+
+    Returns
+    -------
+    dict
+        The entry, with the sizes and checksums of the files of the shard.
+    """
+    files = {os.path.basename(x): {'bytes': os.path.getsize(x), 'sha256': checksum(x)} for x in shard_files(path)}
+    return {'path': os.path.basename(path), 'split': split, 'chunk': chunk, 'complete': True,
+            **stats.to_dict(), 'files': files, 'settings': settings, 'created': time.time()}
+
+
+def read_manifest(directory: str) -> dict:
+    """Read the manifest of a directory. Returns None if it has none."""
+    path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _acquire_lock(path: str, timeout: float = 60, poll_interval: float = 0.05):
+    """Create a lock file. Locks older than timeout were left behind by a crashed process and are broken."""
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, 'w') as f:
+                f.write(f'{socket.gethostname()}.{os.getpid()}')
+            return
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > timeout:
+                    os.remove(path)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(poll_interval)
+
+
+def update_manifest(directory: str, entries, replace: bool = False, **fields) -> dict:
+    """
+    Add entries to the manifest of a directory, replacing the entries of the same shards.
+
+    Parameters
+    ----------
+    directory : str
+        The directory of the shards.
+    entries : List[dict]
+        Entries from `shard_entry`.
+    replace : bool, optional
+        Whether to drop all existing entries. The default is False.
+    **fields
+        Other fields of the manifest to set, e.g. `resharded`.
+
+    Returns
+    -------
+    dict
+        The updated manifest.
+    """
+    path = os.path.join(directory, MANIFEST_NAME)
+    lock = f'{path}.lock'
+    _acquire_lock(lock)
+    try:
+        manifest = read_manifest(directory) if not replace else None
+        manifest = manifest or {'shards': {}}
+        manifest.update(fields)
+        for entry in entries:
+            manifest['shards'][entry['path']] = entry
+        tmp = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent = 2)
+        os.replace(tmp, path)
+    finally:
+        os.remove(lock)
+    return manifest
+
+
+def build_manifest(directory: str) -> dict:
+    """
+    Add entries for the shards and flat stores of a directory that are not in its manifest.
+
+    Used for directories that were embedded without a manifest. The shards are scanned, and
+    their split and chunk are taken from their `{split}_{chunk}` file names. Their settings are unknown.
+
+    Returns
+    -------
+    dict
+        The updated manifest.
+    """
+    from bend.io.shards import find_shards, SHARD_CODECS
+    from bend.io.flatstore import find_flat_stores, FLAT_EXTENSION
+    manifest = read_manifest(directory) or {'shards': {}}
+    entries = []
+    for path in find_shards(directory) + find_flat_stores(directory):
+        if os.path.basename(path) in manifest['shards']:
+            continue
+        name = os.path.basename(path)
+        for extension in sorted(list(SHARD_CODECS.values()) + [FLAT_EXTENSION], key = len, reverse = True):
+            if name.endswith(extension):
+                name = name[:-len(extension)]
+                break
+        split, _, chunk = name.rpartition('_')
+        if not chunk.isdigit():
+            split, chunk = name, None
+        entries.append(shard_entry(path, scan_shard(path), split, int(chunk) if chunk is not None else None))
+    return update_manifest(directory, entries) if entries else manifest
+
+
+def is_complete(manifest: dict, path: str, settings: dict = None) -> bool:
+    """
+    Whether the manifest marks a shard as complete.
+
+    Parameters
+    ----------
+    manifest : dict
+        The manifest of the directory of the shard, or None.
+    path : str
+        Path of the shard.
+    settings : dict, optional
+        If given, the shard is only complete if it was written with the same settings.
+
+    Returns
+    -------
+    bool
+        True if the shard has a complete entry and all of its files exist with the recorded sizes.
+        The checksums are not verified, see `verify_manifest`.
+    """
+    if manifest is None or os.path.basename(path) not in manifest['shards']:
+        return False
+    entry = manifest['shards'][os.path.basename(path)]
+    if not entry['complete'] or (settings is not None and entry['settings'] != settings):
+        return False
+    directory = os.path.dirname(path)
+    for name, f in entry['files'].items():
+        file_path = os.path.join(directory, name)
+        if not os.path.exists(file_path) or os.path.getsize(file_path) != f['bytes']:
+            return False
+    return True
+
+
+def remove_stale_shard(path: str, settings: dict) -> bool:
+    """
+    Remove a shard whose manifest entry records other settings, so that it is embedded again.
+
+    Shards without an entry, or whose entry has no settings (see `build_manifest`), are kept.
+
+    Parameters
+    ----------
+    path : str
+        Path of the shard.
+    settings : dict
+        Settings the shard should have been written with, see `shard_settings`.
+
+    Returns
+    -------
+    bool
+        True if the shard was removed.
+    """
+    manifest = read_manifest(os.path.dirname(path))
+    entry = manifest['shards'].get(os.path.basename(path)) if manifest is not None else None
+    if not os.path.exists(path) or entry is None or entry['settings'] is None or entry['settings'] == settings:
+        return False
+    for file_path in shard_files(path):
+        os.remove(file_path)
+    return True
+
+
+def verify_manifest(directory: str) -> list:
+    """Check the checksums of all shards of a directory. Returns the paths of the shards that do not match."""
+    manifest = read_manifest(directory)
+    if manifest is None:
+        raise ValueError(f'{directory} has no {MANIFEST_NAME}')
+    corrupt = []
+    for name, entry in manifest['shards'].items():
+        for file_name, f in entry['files'].items():
+            file_path = os.path.join(directory, file_name)
+            if not os.path.exists(file_path) or checksum(file_path) != f['sha256']:
+                corrupt.append(os.path.join(directory, name))
+                break
+    return corrupt
+
+
+def manifest_shards(manifest: dict, directory: str) -> dict:
+    """
+    Get the complete shards of a manifest, and their numbers of samples.
+
+    Parameters
+    ----------
+    manifest : dict
+        The manifest.
+    directory : str
+        The directory of the manifest.
+
+    Returns
+    -------
+    Dict[str, Tuple[str, int]]
+        Path of each shard mapped to its split and number of samples, ordered by split and chunk.
+    """
+    entries = [x for x in manifest['shards'].values() if x['complete']]
+    entries = sorted(entries, key = lambda x: (str(x['split']), x['chunk'] if x['chunk'] is not None else -1, x['path']))
+    return {os.path.join(directory, x['path']): (x['split'], x['samples']) for x in entries}
@@ -0,0 +1,155 @@
+"""
+planner.py
+==========
+Estimates of the disk space and compute time of precomputing embeddings, before running it.
+
+The size of the embeddings of a task follows from the interval lengths in its bed file (read
+through :class:`~bend.io.bedindex.BedIndex`), the embedding dimension of the model, the number
+of nucleotides per stored embedding vector and the storage dtype. The compute time follows from
+a short timed calibration run of the model on a random sequence. Compression is not taken into
+account, so the sizes are upper bounds for compressed shards.
+"""
+import os
+import time
+import shutil
+import numpy as np
+from bend.io.bedindex import BedIndex
+from bend.io.shards import STORAGE_DTYPES
+
+_ITEMSIZE = {'float32': 4, 'float16': 2, 'bfloat16': 2, 'int8': 1}
+_TAR_MEMBER_BYTES = 1024 # tar header, npy header and padding of each file in a shard
+
+
+def calibrate(embedder, length: int, n_runs: int = 3, upsample_embeddings: bool = False,
+              token_level: bool = False, seed: int = 0) -> dict:
+    """
+    Time an embedder on a random sequence and measure the shape of its embeddings.
+
+    Parameters
+    ----------
+    embedder : bend.utils.embedders.BaseEmbedder
+        The embedder.
+    length : int
+        Length of the random sequence, e.g. the typical length of the samples of a task.
+    n_runs : int, optional
+        Number of timed runs, after one untimed warmup run. The default is 3.
+    upsample_embeddings : bool, optional
+        Passed to the embedder. The default is False.
+    token_level : bool, optional
+        Whether embeddings are stored at token resolution, see `bend.io.sequtils.embed_from_bed`.
+        The default is False.
+    seed : int, optional
+        Seed of the random sequence. The default is 0.
+
+    Returns
+    -------
+    dict
+        The median `seconds_per_nucleotide`, the `embedding_dim`, the `nucleotides_per_vector`
+        that are stored and whether `token_level` storage applies to the embedder.
+    """
+    sequence = ''.join(np.random.default_rng(seed).choice(list('ACGT'), size = length))
+    token_level = token_level and upsample_embeddings and embedder.token_lengths('ACGT') is not None
+    times = []
+    for i in range(n_runs + 1):
+        start = time.perf_counter()
+        embedding = embedder(sequence, upsample_embeddings = upsample_embeddings and not token_level)
+        if i > 0:
+            times.append(time.perf_counter() - start)
+    n_vectors = len(embedder.token_lengths(sequence)) if token_level else embedding.shape[-2]
+    return {'seconds_per_nucleotide': float(np.median(times)) / length,
+            'embedding_dim': int(embedding.shape[-1]),
+            'nucleotides_per_vector': length / n_vectors,
+            'token_level': token_level}
+
+
+def plan_task(bed: str, embedding_dim: int, chunk_size: int, splits = None, hdf5_file: str = None,
+              label_depth: int = None, label_column_idx: int = 6, flank: int = 0,
+              nucleotides_per_vector: float = 1.0, token_level: bool = False,
+              storage_dtype: str = 'float32', seconds_per_nucleotide: float = None, **kwargs) -> dict:
+    """
+    Estimate the size and compute time of the embeddings of a task.
+
+    Parameters
+    ----------
+    bed : str
+        Path to the bed file of the task.
+    embedding_dim : int
+        Dimension of the stored embedding vectors, e.g. from `conf/datadims/embedding_dims.yaml`,
+        or the number of components of a projection.
+    chunk_size : int
+        Number of samples per chunk.
+    splits : List[str], optional
+        Splits to plan. The default is all splits of the bed file.
+    hdf5_file : str, optional
+        Path to the hdf5 file of the labels. If None, labels are multi-hot encoded with label_depth.
+    label_depth : int, optional
+        Number of labels of multi-hot encoded labels.
+    label_column_idx : int, optional
+        Column of the labels, if the bed file has no `label` column. The default is 6.
+    flank : int, optional
+        Number of bases added to both sides of each sequence. The default is 0.
+    nucleotides_per_vector : float, optional
+        Number of nucleotides per stored embedding vector, e.g. from `calibrate`. The default is 1,
+        which holds for upsampled embeddings and for models that embed each nucleotide.
+    token_level : bool, optional
+        Whether the length of each token is stored as well. The default is False.
+    storage_dtype : str, optional
+        Dtype in which embeddings are stored. The default is 'float32'.
+    seconds_per_nucleotide : float, optional
+        Compute time per nucleotide, e.g. from `calibrate`. If None, no time is estimated.
+    **kwargs
+        Other options of the task configuration, ignored.
+
+    Returns
+    -------
+    dict
+        For each split, the number of samples and nucleotides, the estimated bytes of each chunk
+        and in total, and the estimated seconds. Also the totals over all splits.
+    """
+    if storage_dtype not in STORAGE_DTYPES:
+        raise ValueError(f'Unknown storage dtype {storage_dtype}, choose from {STORAGE_DTYPES}')
+    index = BedIndex.load(bed, label_column_idx = label_column_idx)
+    if hdf5_file is not None:
+        import h5py
+        with h5py.File(hdf5_file, mode = 'r') as f:
+            label_bytes = int(np.prod(f['labels'].shape[1:])) * f['labels'].dtype.itemsize
+    else:
+        label_bytes = (label_depth or 0) * np.dtype(np.int64).itemsize
+    n_files = 2 + (storage_dtype == 'int8') + token_level
+
+    plan = {'splits': {}, 'bytes': 0, 'seconds': 0.0 if seconds_per_nucleotide is not None else None}
+    splits = splits if splits is not None else list(index.splits)
+    for split in splits:
+        rows = index.split_rows(split)
+        lengths = index.end[rows] - index.start[rows] + 2 * flank
+        n_vectors = np.ceil(lengths / nucleotides_per_vector)
+        sample_bytes = n_vectors * embedding_dim * _ITEMSIZE[storage_dtype] + label_bytes + n_files * _TAR_MEMBER_BYTES
+        if storage_dtype == 'int8':
+            sample_bytes += embedding_dim * 4 # per-channel scales
+        if token_level:
+            sample_bytes += n_vectors * 2 # uint16 token lengths
+        chunk_bytes = [int(sample_bytes[i:i + chunk_size].sum()) for i in range(0, len(rows), chunk_size)]
+        split_plan = {'samples': len(rows), 'nucleotides': int(lengths.sum()), 'chunk_bytes': chunk_bytes,
+                      'bytes': int(sum(chunk_bytes)),
+                      'seconds': lengths.sum() * seconds_per_nucleotide if seconds_per_nucleotide is not None else None}
+        plan['splits'][split] = split_plan
+        plan['bytes'] += split_plan['bytes']
+        if seconds_per_nucleotide is not None:
+            plan['seconds'] += split_plan['seconds']
+    return plan
+
+
+def free_bytes(path: str) -> int:
+    """Free disk space at a path, or at its closest existing parent directory."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+def format_bytes(n: float) -> str:
+    """Format a number of bytes with a binary unit."""
+    for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
+        if abs(n) < 1024 or unit == 'TiB':
+            return f'{n:.1f} {unit}'
+        n /= 1024
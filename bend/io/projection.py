@@ -0,0 +1,104 @@
+"""
+projection.py
+=============
+Linear projections that reduce the dimension of embeddings before they are written.
+
+A projection is either a PCA fitted on embedding vectors of a sample of the training data,
+or a seeded random Gaussian projection. It is saved as ``projection.npz`` next to the shards
+of a task and model, so that all chunks use the same projection and downstream code can
+tell how the stored embeddings were made.
+"""
+import os
+import numpy as np
+
+
+class Projection():
+    """Linear projection of embedding vectors, `(x - mean) @ components.T`."""
+    def __init__(self, components: np.ndarray, mean: np.ndarray = None, method: str = 'pca') -> None:
+        """
+        Parameters
+        ----------
+        components : np.ndarray
+            Projection matrix of shape (n_components, dim).
+        mean : np.ndarray, optional
+            Mean that is subtracted before projecting. The default is no centering.
+        method : str, optional
+            How the projection was made, 'pca' or 'random'. The default is 'pca'.
+        """
+        self.components = components.astype(np.float32)
+        self.mean = mean.astype(np.float32) if mean is not None else np.zeros(components.shape[1], dtype = np.float32)
+        self.method = method
+
+    @property
+    def n_components(self) -> int:
+        return self.components.shape[0]
+
+    def __call__(self, embedding: np.ndarray) -> np.ndarray:
+        """Project an embedding along its last axis. Embeddings that are not floating point are returned unchanged."""
+        if not np.issubdtype(embedding.dtype, np.floating):
+            return embedding
+        return (embedding.astype(np.float32, copy = False) - self.mean) @ self.components.T
+
+    def save(self, path: str):
+        """Save the projection to a npz file."""
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, components = self.components, mean = self.mean, method = np.array(self.method))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        """Load a projection saved with `save`."""
+        with np.load(path) as f:
+            return cls(f['components'], f['mean'], str(f['method']))
+
+    @classmethod
+    def random(cls, dim: int, n_components: int, seed: int = 0):
+        """
+        Draw a random Gaussian projection, scaled to approximately preserve distances.
+
+        Parameters
+        ----------
+        dim : int
+            Dimension of the embeddings.
+        n_components : int
+            Dimension of the projected embeddings.
+        seed : int, optional
+            Random seed. The default is 0.
+        """
+        rng = np.random.default_rng(seed)
+        components = rng.standard_normal((n_components, dim)) / np.sqrt(n_components)
+        return cls(components, method = 'random')
+
+    @classmethod
+    def pca(cls, vectors, n_components: int, batch_size: int = 8192):
+        """
+        Fit a PCA incrementally.
+
+        Parameters
+        ----------
+        vectors : Iterable[np.ndarray]
+            Arrays of embedding vectors, of shape (n, dim).
+        n_components : int
+            Number of principal components.
+        batch_size : int, optional
+            Number of vectors per incremental fit. The default is 8192.
+        """
+        from sklearn.decomposition import IncrementalPCA
+        pca = IncrementalPCA(n_components = n_components)
+        batch_size = max(batch_size, n_components)
+        buffer, n_buffered, n_fitted = [], 0, 0
+        for x in vectors:
+            buffer.append(x.reshape(-1, x.shape[-1]))
+            n_buffered += len(buffer[-1])
+            if n_buffered >= batch_size:
+                pca.partial_fit(np.concatenate(buffer))
+                n_fitted += n_buffered
+                buffer, n_buffered = [], 0
+        # incremental fits need at least n_components vectors
+        if n_buffered >= n_components or (n_fitted == 0 and n_buffered > 0):
+            pca.partial_fit(np.concatenate(buffer))
+            n_fitted += n_buffered
+        if n_fitted == 0:
+            raise ValueError('No embedding vectors to fit the PCA on')
+        return cls(pca.components_, pca.mean_, method = 'pca')
@@ -0,0 +1,201 @@
+"""
+reshard.py
+==========
+Rewriting the shards of an embedding directory into shards of about equal size.
+
+Chunks are embedded with a fixed number of samples, so the size of their shards depends on the
+sequence lengths of the task and the embedding dimension of the model. :func:`reshard` streams
+the samples of a directory, split by split and in order, into a given number of shards (or shards
+of a given size) that hold about the same number of uncompressed bytes. On the way, the shards can
+be written with another codec, as flat stores, or with another storage dtype. The manifest of the
+directory is rewritten (see :mod:`bend.io.manifest`).
+"""
+import os
+import io
+import shutil
+import tarfile
+import numpy as np
+from bend.io.shards import ShardWriter, SHARD_CODECS, STORAGE_DTYPES, open_shard, shard_codec, decode_embedding
+from bend.io.flatstore import FlatStore, FlatStoreWriter, FLAT_EXTENSION
+from bend.io.manifest import build_manifest, update_manifest, manifest_shards, shard_entry, scan_shard, MANIFEST_NAME
+
+
+def read_shard(path: str):
+    """
+    Read the samples of a shard or flat store as they are stored.
+
+    Parameters
+    ----------
+    path : str
+        Path of the tar shard or of the index of the flat store.
+
+    Yields
+    ------
+    dict
+        Each sample, with its `__key__` and its stored arrays, without decoding reduced precision
+        or upsampling token resolution embeddings.
+    """
+    if path.endswith(FLAT_EXTENSION):
+        store = FlatStore(path)
+        for i, key in enumerate(store.keys):
+            a, b = store.input_offsets[i], store.input_offsets[i + 1]
+            sample = {'__key__': str(key), 'input.npy': np.array(store.inputs[a:b]),
+                      'output.npy': np.array(store.labels[store.label_offsets[i]:store.label_offsets[i + 1]])}
+            if store.scales is not None:
+                sample['input_scale.npy'] = np.array(store.scales[i])
+            if store.token_lengths is not None:
+                sample['input_lengths.npy'] = np.array(store.token_lengths[a:b])
+            yield sample
+        return
+
+    with open(path, 'rb') as f:
+        stream = open_shard(f, shard_codec(path))
+        sample = None
+        with tarfile.open(fileobj = stream, mode = 'r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                key, name = member.name.split('.', 1)
+                if sample is not None and sample['__key__'] != key:
+                    yield sample
+                    sample = None
+                if sample is None:
+                    sample = {'__key__': key}
+                sample[name] = np.load(io.BytesIO(tar.extractfile(member).read()))
+        if sample is not None:
+            yield sample
+        stream.close()
+
+
+def stored_dtype(sample: dict) -> str:
+    """Get the storage dtype of a sample from the dtype of its stored embedding."""
+    if 'input_scale.npy' in sample:
+        return 'int8'
+    return {np.dtype(np.uint16): 'bfloat16', np.dtype(np.float16): 'float16'}.get(sample['input.npy'].dtype, 'float32')
+
+
+def _restore_precision(sample: dict) -> dict:
+    """Convert the stored embedding of a sample to float32, keeping its token resolution."""
+    lengths = sample.pop('input_lengths.npy', None)
+    sample = decode_embedding(sample)
+    if lengths is not None:
+        sample['input_lengths.npy'] = lengths
+    return sample
+
+
+def _sample_nbytes(sample: dict) -> int:
+    return sum(x.nbytes for name, x in sample.items() if name != '__key__')
+
+
+def reshard(input_dir: str, output_dir: str = None, n_shards: int = None, shard_bytes: int = None,
+            codec: str = None, storage_dtype: str = None) -> dict:
+    """
+    Rewrite the shards of a directory into shards of about equal size.
+
+    Parameters
+    ----------
+    input_dir : str
+        Directory of the shards, e.g. `{data_dir}/{task}/{model}`. Directories without a
+        manifest are scanned first, see `bend.io.manifest.build_manifest`.
+    output_dir : str, optional
+        Directory of the new shards. The default is input_dir, in which case the new shards
+        replace the old ones once all of them are written.
+    n_shards : int, optional
+        Total number of shards. They are divided between the splits by size, with at least one
+        per split.
+    shard_bytes : int, optional
+        Uncompressed size of each shard instead of their number.
+    codec : str, optional
+        Codec of the new shards, one of 'tar', 'gz', 'zst', 'lz4', or 'flat' for flat stores.
+        The default is the codec of the old shards.
+    storage_dtype : str, optional
+        Storage dtype of the new shards. The default is the storage dtype of the old shards.
+
+    Returns
+    -------
+    dict
+        The manifest of the new shards.
+    """
+    if (n_shards is None) == (shard_bytes is None):
+        raise ValueError('Give either n_shards or shard_bytes')
+    if codec is not None and codec != 'flat' and codec not in SHARD_CODECS:
+        raise ValueError(f'Unknown codec {codec}, choose from {list(SHARD_CODECS) + ["flat"]}')
+    if storage_dtype is not None and storage_dtype not in STORAGE_DTYPES:
+        raise ValueError(f'Unknown storage dtype {storage_dtype}, choose from {STORAGE_DTYPES}')
+    output_dir = output_dir if output_dir is not None else input_dir
+    in_place = os.path.abspath(output_dir) == os.path.abspath(input_dir)
+    if not in_place and os.path.exists(os.path.join(output_dir, MANIFEST_NAME)):
+        raise ValueError(f'{output_dir} has shards already')
+
+    manifest = build_manifest(input_dir)
+    entries = list(manifest['shards'].values())
+    if len(entries) == 0:
+        raise ValueError(f'{input_dir} has no shards')
+    for entry in entries:
+        if 'nbytes' not in entry:
+            entry.update(nbytes = scan_shard(os.path.join(input_dir, entry['path'])).nbytes)
+    shards = manifest_shards(manifest, input_dir)
+    splits = list(dict.fromkeys(split for split, _ in shards.values()))
+    split_bytes = {split: sum(x['nbytes'] for x in entries if x['split'] == split) for split in splits}
+
+    # number of new shards of each split, in proportion to its size
+    if shard_bytes is not None:
+        split_shards = {split: max(1, int(np.ceil(split_bytes[split] / shard_bytes))) for split in splits}
+    else:
+        if n_shards < len(splits):
+            raise ValueError(f'n_shards needs to be at least the number of splits ({len(splits)})')
+        split_shards = {split: 1 for split in splits}
+        for _ in range(n_shards - len(splits)):
+            # give the next shard to the split with the largest shards
+            split = max(splits, key = lambda x: split_bytes[x] / split_shards[x])
+            split_shards[split] += 1
+
+    codec = codec if codec is not None else ('flat' if entries[0]['path'].endswith(FLAT_EXTENSION) else shard_codec(entries[0]['path']))
+    extension = FLAT_EXTENSION if codec == 'flat' else SHARD_CODECS[codec]
+    writer = FlatStoreWriter if codec == 'flat' else ShardWriter
+    work_dir = os.path.join(output_dir, 'reshard.tmp') if in_place else output_dir
+    os.makedirs(work_dir, exist_ok = True)
+
+    new_entries = []
+    for split in splits:
+        n, done, index, chunk, sink = split_shards[split], 0, None, -1, None
+        settings = next((x['settings'] for x in entries if x['split'] == split), None)
+        for path in [path for path, (s, _) in shards.items() if s == split]:
+            for sample in read_shard(path):
+                nbytes = _sample_nbytes(sample)
+                # the shard that holds the middle of the sample, so that shards get about equal bytes
+                shard = min(n - 1, int(n * (done + nbytes / 2) / max(split_bytes[split], 1)))
+                done += nbytes
+                if shard != index:
+                    if sink is not None:
+                        sink.close()
+                        new_entries.append(_entry(sink, split, chunk, settings, dtype))
+                    # samples larger than a shard leave shards empty, number the written ones consecutively
+                    index, chunk = shard, chunk + 1
+                    dtype = storage_dtype if storage_dtype is not None else stored_dtype(sample)
+                    sink = writer(os.path.join(work_dir, f'{split}_{chunk}{extension}'), storage_dtype = dtype)
+                sink.write(_restore_precision(sample))
+            print(f'Resharded {path}')
+        if sink is not None:
+            sink.close()
+            new_entries.append(_entry(sink, split, chunk, settings, dtype))
+
+    if in_place:
+        for entry in entries:
+            for name in list(entry['files']) + [f'{entry["path"]}.timing.json']:
+                if os.path.exists(os.path.join(input_dir, name)):
+                    os.remove(os.path.join(input_dir, name))
+        for entry in new_entries:
+            for name in entry['files']:
+                os.replace(os.path.join(work_dir, name), os.path.join(output_dir, name))
+        shutil.rmtree(work_dir)
+    # precompute_embeddings.py does not add chunks to a resharded directory
+    return update_manifest(output_dir, new_entries, replace = True,
+                           resharded = {'source': os.path.abspath(input_dir), 'shards': len(new_entries)})
+
+
+def _entry(sink, split, chunk, settings, storage_dtype):
+    stats = getattr(sink, 'stats', None)
+    stats = stats if stats is not None else scan_shard(sink.path)
+    settings = dict(settings, storage_dtype = storage_dtype) if settings is not None else None
+    return shard_entry(sink.path, stats, split, chunk, settings)
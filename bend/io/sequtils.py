@@ -4,11 +4,23 @@ sequtils.py
 Utilities for processing genome coordinate-based sequence data to embeddings.
 """
 from tqdm.auto import tqdm
+import os
+import threading
+import queue
+from contextlib import nullcontext
 import pysam
-import pandas as pd
+import torch
+import torch.multiprocessing as mp
 import numpy as np
-import webdataset as wds
-import h5py
+from bend.io.shards import ShardWriter
+from bend.io.flatstore import FlatStoreWriter, FLAT_EXTENSION
+from bend.io.projection import Projection
+from bend.io.leases import claim_chunks
+from bend.io.bedindex import BedIndex
+from bend.io.labels import HDF5LabelReader
+from bend.io.genomestore import GenomeStore
+from bend.io.manifest import shard_settings, shard_entry, scan_shard, update_manifest, read_manifest, remove_stale_shard
+from bend.utils.timing import StageTimer, stage
 
 baseComplement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
 
@@ -112,68 +124,508 @@ def embed_from_bed(bed, reference_fasta, embedder,
                    chunk_size = None, chunk: int = None, 
                    upsample_embeddings = False,
                     read_strand = False, label_column_idx=6, 
-                  label_depth=None, split = None, flank = 0):
-    fasta = Fasta(reference_fasta)
-    f = pd.read_csv(bed, header = 'infer', sep = '\t', low_memory=False)
-    # open hdf5 file 
-    hdf5_file = h5py.File(hdf5_file, mode = "r")['labels'] if hdf5_file else None
-    if split: 
-        mask = (f.iloc[:, -1] == split)
-        f = f[mask]
-        if hdf5_file is not None: 
-            hdf5_file = hdf5_file[mask.to_numpy()] # mask the labels
-
-    label_column_idx = f.columns.get_loc('label') if 'label' in f.columns else label_column_idx
-    strand_column_idx = f.columns.get_loc('strand') if 'strand' in f.columns else 3
-    
-    
-    if chunk is not None:
-        # check if chunk is valid 
-        if chunk * chunk_size > len(f):
-            raise ValueError(f'Requested chunk {chunk}, but chunk ids range from 0-{int(len(f) / chunk_size)}')
-        f = f[chunk*chunk_size:(chunk+1)*chunk_size].reset_index(drop=True)
-
-    buffer_inputs = []
-    buffer_labels = []
-    start_offset = chunk*chunk_size
-    buffer_size=5000
-
-    sink = wds.TarWriter(output_path, compress=True)
-    for n, line in tqdm(f.iterrows(), total=len(f), desc='Embedding sequences'):
-        # get bed row
-        if read_strand:
-            chrom, start, end, strand = line.iloc[0], int(line.iloc[1]), int(line.iloc[2]), line.iloc[strand_column_idx]
+                  label_depth=None, split = None, flank = 0,
+                  batch_size: int = 1, pipeline_depth: int = 0, resume: bool = False,
+                  storage_dtype: str = 'float32', token_level: bool = False,
+                  projection: str = None, timing: bool = False, shuffle_seed: int = None,
+                  manifest: bool = False, genome_store: str = None):
+    """
+    Embed the sequences of a bed file and write them to a webdataset tar file.
+
+    Parameters
+    ----------
+    bed : str
+        Path to the bed file. The split of each sample is taken from the last column.
+    reference_fasta : str
+        Path to the reference genome fasta file.
+    embedder : bend.utils.embedders.BaseEmbedder
+        The embedder to use.
+    output_path : str
+        Path of the output tar file. The extension determines the compression,
+        one of .tar, .tar.gz, .tar.zst and .tar.lz4 (see `bend.io.shards.SHARD_CODECS`).
+        Paths ending in .flat are written as a memory mappable `bend.io.flatstore` store instead.
+    hdf5_file : str, optional
+        Path to a hdf5 file with the labels. If None, labels are read from the bed file.
+    chunk_size : int, optional
+        Number of samples per chunk.
+    chunk : int, optional
+        Which chunk of the (split of the) bed file to embed.
+    upsample_embeddings : bool, optional
+        Passed to the embedder. The default is False.
+    read_strand : bool, optional
+        Whether to read the strand from the bed file. The default is False.
+    label_column_idx : int, optional
+        Column of the labels, if the bed file has no `label` column. The default is 6.
+    label_depth : int, optional
+        Number of labels for multi-hot encoding labels from the bed file.
+    split : str, optional
+        Only embed samples of this split.
+    flank : int, optional
+        Number of bases to add to both sides of each sequence. The default is 0.
+    batch_size : int, optional
+        Number of sequences passed to `embedder.embed` at once, which runs them through the
+        model in one forward pass where the model allows it. The default is 1. If larger than 1,
+        sequences are sorted by length within windows of rows so that each batch contains
+        sequences of similar length. Samples keep their `sample_{n}` keys, but are written
+        in the order in which they were embedded.
+    pipeline_depth : int, optional
+        If larger than 0, sequences and labels are read in a background thread and samples are
+        serialized and compressed in a second background thread, so that the model does not 
+        wait for I/O. The value is the maximum number of samples queued between the stages.
+        The default is 0, which runs all stages one after another on the main thread.
+    resume : bool, optional
+        Whether to keep a journal of the samples that are written to disk. The default is False.
+        If True, the tar file is written to `{output_path}.partial` and committed sample keys are
+        recorded in `{output_path}.journal`. If the run is interrupted, calling the function again
+        continues after the last committed sample. If `output_path` exists without a journal,
+        the chunk is complete and nothing is embedded, unless `manifest` is True and its manifest
+        entry records other settings, in which case it is removed and embedded again.
+    storage_dtype : str, optional
+        Dtype in which embeddings are stored, one of 'float32', 'float16', 'bfloat16' and 'int8'.
+        See `bend.io.shards.encode_embedding`. The default is 'float32'.
+    token_level : bool, optional
+        Whether to store upsampled embeddings at token resolution. If True, upsample_embeddings 
+        is True and the embedder implements `token_lengths`, the embeddings are stored without
+        upsampling, together with the number of nucleotides of each token as `input_lengths.npy`.
+        The dataloaders upsample them when reading. The default is False.
+    projection : str, optional
+        Path to a projection saved with `bend.io.projection.Projection.save`, e.g. by `fit_projection`.
+        If given, embeddings are projected to fewer dimensions before they are written. The default is None.
+    timing : bool, optional
+        Whether to record the wall time spent in each stage (reading the bed file and labels, fetching
+        sequences, tokenization, forward pass, device to host copies, upsampling, serialization and
+        compression) and the throughput in nucleotides per second. The report is written to 
+        `{output_path}.timing.json`, see `bend.utils.timing.StageTimer.report`. The default is False.
+    shuffle_seed : int, optional
+        If given, the samples of the split are permuted with this seed before they are divided
+        into chunks (see `bend.io.bedindex.BedIndex.chunk_positions`), so that every chunk holds
+        a random sample of the split in random order, and training only needs to shuffle the order 
+        of the shards and a small buffer of samples. All chunks of a split need to use the same seed.
+        Samples keep the `sample_{n}` keys of their position in the bed file. The default is None.
+    manifest : bool, optional
+        Whether to add an entry for the finished chunk to the `manifest.json` of its directory,
+        with its number of samples, key range, dtypes, shapes and checksums. See `bend.io.manifest`.
+        Complete chunks that have no entry yet are added without settings, since it is not known
+        what they were embedded with. The default is False.
+    genome_store : str, optional
+        Path to a genome store of the embedder for the reference genome, see `bend.io.genomestore`.
+        If given, the embeddings of the samples are sliced from the store by their coordinates instead
+        of being computed, and embedder is not used. token_level does not apply. The default is None.
+    """
+    settings = shard_settings(chunk_size = chunk_size, shuffle_seed = shuffle_seed, storage_dtype = storage_dtype,
+                              token_level = token_level, upsample_embeddings = upsample_embeddings, flank = flank,
+                              read_strand = read_strand, projection = projection, genome_store = genome_store,
+                              bed = bed, reference_fasta = reference_fasta, hdf5_file = hdf5_file,
+                              label_depth = label_depth, label_column_idx = label_column_idx) if manifest else None
+    if resume and manifest and not os.path.exists(f'{output_path}.journal') and remove_stale_shard(output_path, settings):
+        print(f'{output_path} was embedded with other settings, embedding it again')
+    if resume and os.path.exists(output_path) and not os.path.exists(f'{output_path}.journal'):
+        print(f'{output_path} is complete, skipping')
+        directory = os.path.dirname(output_path)
+        if manifest and os.path.basename(output_path) not in (read_manifest(directory) or {'shards': {}})['shards']:
+            # chunks that were written without a manifest. Their settings are unknown, as in `build_manifest`
+            update_manifest(directory, [shard_entry(output_path, scan_shard(output_path), split, chunk, None)])
+        return
+
+    timer = StageTimer() if timing else None
+    with timer.activate() if timer is not None else nullcontext():
+        fasta = Fasta(reference_fasta)
+        index = BedIndex.load(bed, label_column_idx = label_column_idx)
+        positions = index.chunk_positions(split, chunk, chunk_size, shuffle_seed = shuffle_seed)
+        rows = index.split_rows(split)[positions]
+        # open hdf5 file. Its records share the row numbers of the bed file
+        hdf5_file = HDF5LabelReader(hdf5_file, rows) if hdf5_file else None
+
+        projection = Projection.load(projection) if projection is not None else None
+        genome_store = GenomeStore(genome_store) if genome_store is not None else None
+        writer = FlatStoreWriter if output_path.endswith(FLAT_EXTENSION) else ShardWriter
+        sink = writer(output_path, journal=resume, storage_dtype=storage_dtype)
+        committed = sink.committed
+        stats = getattr(sink, 'stats', None)
+        if committed:
+            print(f'Resuming {output_path} after {len(committed)} committed samples')
+
+        def read_samples():
+            for n, row in zip(positions, rows):
+                if f'sample_{n}' in committed:
+                    continue
+                # get bed row
+                with stage('read'):
+                    chrom, start, end, strand = index.region(row, read_strand = read_strand)
+                    if hdf5_file is not None: 
+                        labels = hdf5_file[row]
+                    else: 
+                        labels = multi_hot(index.labels(row), label_depth)
+                # get sequence
+                with stage('fetch'):
+                    sequence = fasta.fetch(chrom, start, end, strand = strand, flank = flank) # categorical labels
+                yield {'n': n, 'region': (chrom, start, end, strand), 
+                       'sequence': sequence, 'labels': labels}
+
+        samples = read_samples()
+        if pipeline_depth > 0:
+            samples = prefetch(samples, maxsize = pipeline_depth)
+            sink = ThreadedWriter(sink, maxsize = pipeline_depth)
+
+        # embedders that do not tokenize into multi-nucleotide tokens return no token lengths
+        token_level = token_level and genome_store is None and upsample_embeddings and hasattr(embedder, 'token_lengths') and embedder.token_lengths('ACGT') is not None
+        if genome_store is not None:
+            embedded = slice_samples(samples, genome_store, flank = flank)
         else:
-            chrom, start, end, strand = line.iloc[0], int(line.iloc[1]), int(line.iloc[2]), '+' 
-        if hdf5_file is not None: 
-            labels = hdf5_file[n + start_offset]
-        else: 
-            labels = line.iloc[label_column_idx]
-            labels = list(map(int, labels.split(','))) if isinstance(labels, str) else [] # if no label for sample
-            labels = multi_hot(labels, label_depth)
-        # get sequence
-        sequence = fasta.fetch(chrom, start, end, strand = strand, flank = flank) # categorical labels
-        # embed sequence
-        sequence_embed = embedder(sequence, upsample_embeddings = upsample_embeddings)
-        if sequence_embed.shape[1] != len(sequence):
-            print(f'Embedding length does not match sequence length ({sequence_embed.shape[1]} != {len(sequence)} : {n} {chrom}:{start}-{end}{strand})')
-            print(n, chrom, start, end, strand)
-            continue
-        sink.write({
-            "__key__": f"sample_{n + start_offset}",
-            "input.npy": sequence_embed,
-            "output.npy": labels
-        })
-
-    sink.close()
-
-
-
-
-
-def get_splits(bed):
-    #header = 'infer' if has_header(bed) else None
-    f = pd.read_csv(bed, header = 'infer', sep = '\t')
-    splits = f.iloc[:, -1].unique().tolist() # splits should be in last column
-    return splits
+            embedded = embed_samples(samples, embedder, batch_size = batch_size, shuffle_seed = shuffle_seed,
+                                     upsample_embeddings = upsample_embeddings and not token_level)
+
+        for sample, sequence_embed in tqdm(embedded, initial=len(committed), total=len(rows), desc='Embedding sequences'):
+            if projection is not None:
+                sequence_embed = projection(sequence_embed)
+            entry = {
+                "__key__": f"sample_{sample['n']}",
+                "input.npy": sequence_embed,
+                "output.npy": sample['labels']
+            }
+            embed_length = sequence_embed.shape[1]
+            if token_level:
+                with stage('tokenization'):
+                    token_lengths = embedder.token_lengths(sample['sequence'])
+                if len(token_lengths) == sequence_embed.shape[1]:
+                    embed_length = int(token_lengths.sum())
+                entry["input_lengths.npy"] = token_lengths.astype(np.uint16)
+            if embed_length != len(sample['sequence']):
+                n, (chrom, start, end, strand) = sample['n'], sample['region']
+                print(f'Embedding length does not match sequence length ({embed_length} != {len(sample["sequence"])} : {n} {chrom}:{start}-{end}{strand})')
+                print(n, chrom, start, end, strand)
+                continue
+            sink.write(entry)
+            if timer is not None:
+                timer.samples += 1
+                timer.nucleotides += len(sample['sequence'])
+
+        sink.close()
+        if hdf5_file is not None:
+            hdf5_file.close()
+
+        if manifest:
+            with stage('manifest'):
+                # resumed shards and flat stores are scanned, the latter only read their index
+                stats = stats if stats is not None else scan_shard(output_path)
+                update_manifest(os.path.dirname(output_path), [shard_entry(output_path, stats, split, chunk, settings)])
+
+    if timer is not None:
+        timer.save(f'{output_path}.timing.json')
+
+
+def embed_samples(samples, embedder, batch_size: int = 1, buffer_size: int = 5000, shuffle_seed: int = None, **kwargs):
+    """
+    Embed the sequences of a stream of samples.
+
+    Parameters
+    ----------
+    samples : Iterable[dict]
+        Samples with the sequence to embed under the key `sequence`.
+    embedder : bend.utils.embedders.BaseEmbedder
+        The embedder to use.
+    batch_size : int, optional
+        Number of sequences passed to `embedder.embed` at once, and its `batch_size`. The default is 1.
+    buffer_size : int, optional
+        Number of samples that are sorted by sequence length before being split into batches.
+        Only used if batch_size is larger than 1. The default is 5000.
+    shuffle_seed : int, optional
+        If given, the batches of each buffer are embedded in random order rather than in order
+        of length, so that samples that were shuffled before stay shuffled apart from the grouping 
+        into batches. Only used if batch_size is larger than 1. The default is None.
+    **kwargs
+        Keyword arguments passed to the embedder.
+
+    Yields
+    ------
+    Tuple[dict, np.ndarray]
+        Each sample together with the embedding of its sequence. If batch_size is larger 
+        than 1, samples are yielded in order of sequence length within each buffer, unless shuffle_seed is given.
+    """
+    if batch_size is None or batch_size <= 1:
+        for sample in samples:
+            yield sample, embedder(sample['sequence'], **kwargs)
+        return
+
+    rng = np.random.default_rng(shuffle_seed) if shuffle_seed is not None else None
+    buffer = []
+    for sample in samples:
+        buffer.append(sample)
+        if len(buffer) == buffer_size:
+            yield from _embed_buffer(buffer, embedder, batch_size, rng, **kwargs)
+            buffer = []
+    yield from _embed_buffer(buffer, embedder, batch_size, rng, **kwargs)
+
+
+def slice_samples(samples, genome_store: GenomeStore, flank: int = 0):
+    """
+    Get the embeddings of a stream of samples from a genome store.
+
+    Parameters
+    ----------
+    samples : Iterable[dict]
+        Samples with their coordinates under the key `region`, as (chrom, start, end, strand).
+    genome_store : bend.io.genomestore.GenomeStore
+        The store.
+    flank : int, optional
+        Number of bases added to both sides of each interval. The default is 0.
+
+    Yields
+    ------
+    Tuple[dict, np.ndarray]
+        Each sample together with its embedding, in order.
+    """
+    for sample in samples:
+        with stage('slice'):
+            embedding = genome_store.fetch(*sample['region'], flank = flank)
+        yield sample, embedding
+
+
+def _embed_buffer(buffer, embedder, batch_size, rng = None, **kwargs):
+    # sort by length so that each batch holds sequences of similar length
+    buffer = sorted(buffer, key = lambda sample: len(sample['sequence']))
+    batch_starts = np.arange(0, len(buffer), batch_size)
+    if rng is not None:
+        rng.shuffle(batch_starts)
+    for i in batch_starts:
+        batch = buffer[i:i + batch_size]
+        embeddings = embedder.embed([sample['sequence'] for sample in batch], disable_tqdm=True, batch_size=batch_size, **kwargs)
+        yield from zip(batch, embeddings)
+
+
+_end_of_queue = object()
+
+def prefetch(iterable, maxsize: int = 64):
+    """
+    Iterate over an iterable in a background thread.
+
+    Parameters
+    ----------
+    iterable : Iterable
+        The iterable to consume in the background.
+    maxsize : int, optional
+        Maximum number of items that are read ahead. The default is 64.
+
+    Yields
+    ------
+    object
+        The items of the iterable, in order. Exceptions raised while iterating
+        are re-raised in the consuming thread.
+    """
+    items = queue.Queue(maxsize = maxsize)
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except BaseException as e:
+            items.put(e)
+        items.put(_end_of_queue)
+
+    threading.Thread(target = produce, daemon = True).start()
+    while True:
+        item = items.get()
+        if item is _end_of_queue:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+class ThreadedWriter():
+    """Writes samples to a sink from a background thread."""
+    def __init__(self, sink, maxsize: int = 64) -> None:
+        """
+        Wrap a sink so that `write` only queues the sample.
+
+        Parameters
+        ----------
+        sink : bend.io.shards.ShardWriter
+            Any object with a `write` and a `close` method.
+        maxsize : int, optional
+            Maximum number of queued samples. `write` blocks while the queue is full.
+            The default is 64.
+        """
+        self.sink = sink
+        self._error = None
+        self._queue = queue.Queue(maxsize = maxsize)
+        self._thread = threading.Thread(target = self._consume, daemon = True)
+        self._thread.start()
+
+    def _consume(self):
+        while True:
+            sample = self._queue.get()
+            if sample is _end_of_queue:
+                break
+            if self._error is not None:
+                continue # keep draining so that write never blocks
+            try:
+                self.sink.write(sample)
+            except BaseException as e:
+                self._error = e
+
+    def write(self, sample):
+        """Queue a sample for writing. Raises any error that occured in the writer thread."""
+        if self._error is not None:
+            raise self._error
+        self._queue.put(sample)
+
+    def close(self):
+        """Write all queued samples and close the sink."""
+        self._queue.put(_end_of_queue)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        self.sink.close()
+
+
+_worker_embedder = None
+
+def _init_worker(embedder, cpu_slices):
+    global _worker_embedder
+    _worker_embedder = embedder
+    cpus = cpu_slices.get()
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+        torch.set_num_threads(len(cpus))
+
+def _embed_job(job):
+    embed_from_bed(**job, embedder = _worker_embedder)
+    return job['output_path']
+
+def embed_from_bed_parallel(jobs, embedder, workers: int = 2, lease_timeout: float = None):
+    """
+    Run `embed_from_bed` for a list of jobs in a pool of worker processes.
+    The model weights are moved to shared memory once and used by all workers.
+    Each worker is pinned to its own slice of the available CPUs and uses as many
+    torch threads as it has CPUs.
+
+    Parameters
+    ----------
+    jobs : List[dict]
+        Keyword arguments for `embed_from_bed`, one dict per chunk. Without the embedder.
+    embedder : bend.utils.embedders.BaseEmbedder
+        The embedder to use.
+    workers : int, optional
+        Number of worker processes. The default is 2.
+    lease_timeout : float, optional
+        If given, each chunk is claimed with a lease file before it is embedded, so that
+        other processes sharing the output directory work on different chunks.
+        See `bend.io.leases.claim_chunks`. The jobs need `resume=True`. The default is None.
+    """
+    embedder.share_memory()
+    # CUDA does not survive a fork, use spawn when it is in use already
+    ctx = mp.get_context('spawn' if torch.cuda.is_initialized() else 'fork')
+
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+    slice_size = len(cpus) // workers
+    cpu_slices = ctx.Queue()
+    for i in range(workers):
+        cpu_slices.put(cpus[i * slice_size:(i + 1) * slice_size])
+
+    leases = {}
+    if lease_timeout is not None:
+        # only claim a new chunk when a worker is free
+        free_workers = threading.Semaphore(workers)
+        def claimed_jobs(jobs):
+            free_workers.acquire()
+            for job, lease in claim_chunks(jobs, timeout = lease_timeout):
+                leases[job['output_path']] = lease
+                yield job
+                free_workers.acquire()
+        jobs = claimed_jobs(jobs)
+
+    with ctx.Pool(workers, initializer = _init_worker, initargs = (embedder, cpu_slices)) as pool:
+        for output_path in pool.imap_unordered(_embed_job, jobs):
+            print(f'Finished {output_path}')
+            if lease_timeout is not None:
+                leases.pop(output_path).release()
+                free_workers.release()
+
+
+def fit_projection(bed, reference_fasta, embedder, method: str = 'pca', n_components: int = 256,
+                   n_samples: int = 1000, positions_per_sample: int = 64, split: str = 'train', seed: int = 0,
+                   read_strand: bool = False, flank: int = 0, batch_size: int = 1, genome_store: str = None, label_column_idx: int = 6,
+                   **kwargs) -> Projection:
+    """
+    Make a projection that reduces the dimension of the embeddings of a task, 
+    as the first of two passes over the data.
+
+    Parameters
+    ----------
+    bed : str
+        Path to the bed file.
+    reference_fasta : str
+        Path to the reference genome fasta file.
+    embedder : bend.utils.embedders.BaseEmbedder
+        The embedder to use.
+    method : str, optional
+        'pca' to fit a PCA on embeddings of a sample of the split, or 'random'
+        for a seeded random projection. The default is 'pca'.
+    n_components : int, optional
+        Dimension of the projected embeddings. The default is 256.
+    n_samples : int, optional
+        Number of samples of the split that are embedded to fit the PCA. The default is 1000.
+    positions_per_sample : int, optional
+        Number of embedding vectors taken from each sample. The default is 64.
+    split : str, optional
+        The split to sample from. If the bed file has no such split, all rows are used.
+        The default is 'train'.
+    seed : int, optional
+        Random seed for sampling and for the random projection. The default is 0.
+    read_strand : bool, optional
+        Whether to read the strand from the bed file. The default is False.
+    flank : int, optional
+        Flank to add to the sequences. The default is 0.
+    batch_size : int, optional
+        Number of sequences embedded at once. The default is 1.
+    genome_store : str, optional
+        Path to a genome store to take the embeddings from, instead of the embedder. The default is None.
+    label_column_idx : int, optional
+        Column of the labels, as in `embed_from_bed`, so that both use the same index of the bed file. The default is 6.
+    **kwargs
+        Other arguments of `embed_from_bed` are ignored.
+
+    Returns
+    -------
+    Projection
+        The projection.
+    """
+    if method not in ('pca', 'random'):
+        raise ValueError(f'Unknown projection method {method}, choose from pca, random')
+    fasta = Fasta(reference_fasta)
+    index = BedIndex.load(bed, label_column_idx = label_column_idx)
+    rows = index.split_rows(split if split in index.splits else None)
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(rows, size = min(n_samples, len(rows)), replace = False)
+
+    def read_samples():
+        for row in rows:
+            chrom, start, end, strand = index.region(row, read_strand = read_strand)
+            yield {'region': (chrom, start, end, strand), 
+                   'sequence': fasta.fetch(chrom, start, end, strand = strand, flank = flank)}
+
+    genome_store = GenomeStore(genome_store) if genome_store is not None else None
+    if genome_store is not None:
+        embed = lambda samples: slice_samples(samples, genome_store, flank = flank)
+    else:
+        embed = lambda samples: embed_samples(samples, embedder, batch_size = batch_size)
+
+    if method == 'random':
+        dim = next(embed(read_samples()))[1].shape[-1]
+        return Projection.random(dim, n_components, seed = seed)
+
+    def vectors():
+        embedded = embed(read_samples())
+        for _, embedding in tqdm(embedded, total = len(rows), desc = 'Fitting projection'):
+            embedding = embedding.reshape(-1, embedding.shape[-1])
+            yield embedding[rng.choice(len(embedding), size = min(positions_per_sample, len(embedding)), replace = False)]
+
+    return Projection.pca(vectors(), n_components)
+
+
+def get_splits(bed, label_column_idx: int = 6):
+    """Get the names of the splits in a bed file. Splits should be in the last column.
+    label_column_idx is passed to `BedIndex.load`, so that the index is shared with `embed_from_bed`."""
+    return BedIndex.load(bed, label_column_idx = label_column_idx).splits.tolist()
         
\ No newline at end of file
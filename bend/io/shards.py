@@ -0,0 +1,447 @@
+"""
+shards.py
+=========
+Writing embeddings to webdataset tar shards.
+
+Embeddings can be stored with reduced precision. ``float16`` embeddings are stored as is,
+``bfloat16`` embeddings are stored as the upper 16 bits of their float32 representation in
+a ``uint16`` array, and ``int8`` embeddings are quantized per channel, with the float32 scale
+of each channel stored next to them as ``input_scale.npy``. Embeddings can also be stored
+at token resolution, with the number of nucleotides covered by each token in ``input_lengths.npy``.
+:func:`decode_embedding` restores float32 embeddings with one vector per nucleotide when
+reading a sample.
+
+:class:`ShardWriter` writes the same ``tar.gz`` files as ``webdataset.TarWriter``, but can
+additionally keep a journal of the samples that are safely on disk. If the process dies
+while writing a shard, a new ``ShardWriter`` for the same path continues after the last
+committed sample instead of starting from scratch.
+
+Besides gzip, shards can be written as uncompressed tar files, or compressed with zstandard
+or lz4, which decompress several times faster. The codec of a shard follows from its file
+extension (see ``SHARD_CODECS``). zstandard and lz4 are optional dependencies.
+"""
+import io
+import os
+import json
+import time
+import zlib
+import struct
+import tarfile
+import numpy as np
+from webdataset.writer import make_encoder
+from bend.utils.timing import stage
+from bend.io.manifest import ShardStats
+
+
+STORAGE_DTYPES = ['float32', 'float16', 'bfloat16', 'int8']
+
+# file extension of each shard codec
+SHARD_CODECS = {'tar': '.tar', 'gz': '.tar.gz', 'zst': '.tar.zst', 'lz4': '.tar.lz4'}
+
+
+def shard_codec(path: str) -> str:
+    """Get the codec of a shard from its file extension. Returns None if the extension is unknown."""
+    for codec, extension in sorted(SHARD_CODECS.items(), key = lambda x: -len(x[1])):
+        if path.endswith(extension):
+            return codec
+    return None
+
+
+def find_shards(directory: str) -> list:
+    """Get the paths of all shards in a directory, whatever their codec."""
+    return sorted(os.path.join(directory, x) for x in os.listdir(directory) if shard_codec(x) is not None)
+
+
+def _import_codec(codec: str):
+    try:
+        if codec == 'zst':
+            import zstandard
+            return zstandard
+        if codec == 'lz4':
+            import lz4.frame
+            return lz4.frame
+    except ImportError:
+        package = {'zst': 'zstandard', 'lz4': 'lz4'}[codec]
+        raise ImportError(f'{codec} shards require {package}. Install with: pip install {package}')
+    raise ValueError(f'Unknown shard codec {codec}, choose from {list(SHARD_CODECS)}')
+
+
+def _available_cpus() -> int:
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def encode_embedding(embedding: np.ndarray, storage_dtype: str = 'float32') -> dict:
+    """
+    Convert an embedding to its storage dtype.
+
+    Parameters
+    ----------
+    embedding : np.ndarray
+        The embedding. Channels are on the last axis. Embeddings that are not floating point
+        (such as integer encoded sequences) are always stored as they are.
+    storage_dtype : str, optional
+        One of 'float32', 'float16', 'bfloat16' and 'int8'. The default is 'float32'.
+
+    Returns
+    -------
+    dict
+        Sample entries. `input.npy` holds the stored embedding, and for int8 `input_scale.npy` holds
+        the scale of each channel.
+    """
+    if storage_dtype not in STORAGE_DTYPES:
+        raise ValueError(f'Unknown storage dtype {storage_dtype}, choose from {STORAGE_DTYPES}')
+    if not np.issubdtype(embedding.dtype, np.floating) or storage_dtype == 'float32':
+        return {'input.npy': embedding}
+
+    embedding = embedding.astype(np.float32, copy = False)
+    if storage_dtype == 'float16':
+        return {'input.npy': embedding.astype(np.float16)}
+    if storage_dtype == 'bfloat16':
+        # round to nearest even and keep the upper 16 bits
+        bits = embedding.view(np.uint32)
+        bits = bits + np.uint32(0x7FFF) + ((bits >> 16) & np.uint32(1))
+        return {'input.npy': (bits >> 16).astype(np.uint16)}
+    # int8, symmetric per channel
+    scale = np.abs(embedding.reshape(-1, embedding.shape[-1])).max(axis = 0) / 127
+    scale[scale == 0] = 1
+    quantized = np.clip(np.rint(embedding / scale), -127, 127).astype(np.int8)
+    return {'input.npy': quantized, 'input_scale.npy': scale.astype(np.float32)}
+
+
+def decode_embedding(sample: dict) -> dict:
+    """
+    Restore the float32 embedding of a decoded sample that was written with reduced precision
+    or at token resolution.
+
+    Parameters
+    ----------
+    sample : dict
+        Decoded sample with the embedding in `input.npy`.
+
+    Returns
+    -------
+    dict
+        The sample, with a float32 embedding in `input.npy`. If the sample has token lengths,
+        each token vector is repeated for each nucleotide of the token. Embeddings that are 
+        not floating point keep their dtype.
+    """
+    embedding = sample['input.npy']
+    if 'input_scale.npy' in sample:
+        embedding = embedding.astype(np.float32) * sample.pop('input_scale.npy')
+    elif embedding.dtype == np.uint16:
+        embedding = (embedding.astype(np.uint32) << 16).view(np.float32)
+    elif embedding.dtype == np.float16:
+        embedding = embedding.astype(np.float32)
+    if 'input_lengths.npy' in sample:
+        # the sequence axis is second to last, after an optional batch axis
+        embedding = np.repeat(embedding, sample.pop('input_lengths.npy'), axis = -2)
+    sample['input.npy'] = embedding
+    return sample
+
+
+class _RawStream():
+    """Uncompressed output stream."""
+    def __init__(self, fileobj, state: dict = None) -> None:
+        self.fileobj = fileobj
+        self.size = state['size'] if state is not None else 0
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.size += len(data)
+
+    def tell(self):
+        return self.size
+
+    def sync(self) -> dict:
+        self.fileobj.flush()
+        os.fsync(self.fileobj.fileno())
+        return {'offset': self.fileobj.tell(), 'size': self.size}
+
+    def close(self):
+        self.fileobj.flush()
+
+
+class _GzipStream(_RawStream):
+    """
+    Gzip output stream that can be synced to disk and continued after a crash.
+    After a sync, all data written so far can be decompressed from the file.
+    A new stream that starts at the synced offset with the synced checksum
+    continues the same gzip member.
+    """
+    def __init__(self, fileobj, state: dict = None, compresslevel: int = 9) -> None:
+        self.fileobj = fileobj
+        if state is None:
+            self.size, self.crc = 0, 0
+            # gzip header without file name, same compression level flag as tarfile
+            self.fileobj.write(b'\037\213\010\000' + struct.pack('<L', int(time.time())) + b'\002\377')
+        else:
+            self.size, self.crc = state['size'], state['crc']
+        self._compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.fileobj.write(self._compressor.compress(data))
+
+    def sync(self) -> dict:
+        # a sync flush ends on a byte boundary, so that a fresh compressor can append to it
+        self.fileobj.write(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        state = super().sync()
+        state['crc'] = self.crc
+        return state
+
+    def close(self):
+        self.fileobj.write(self._compressor.flush())
+        self.fileobj.write(struct.pack('<LL', self.crc, self.size & 0xffffffff))
+        self.fileobj.flush()
+
+
+class _ZstdStream(_RawStream):
+    """
+    Zstandard output stream, compressed with one thread per available core.
+    Every sync ends a frame, and a stream that is continued after a crash appends
+    new frames. Readers decompress across frame boundaries.
+    """
+    def __init__(self, fileobj, state: dict = None, level: int = 3) -> None:
+        super().__init__(fileobj, state)
+        zstandard = _import_codec('zst')
+        threads = _available_cpus()
+        self._compressor = zstandard.ZstdCompressor(level = level, threads = threads if threads > 1 else 0)
+        self._frame = self._compressor.compressobj()
+
+    def write(self, data):
+        self.size += len(data)
+        self.fileobj.write(self._frame.compress(data))
+
+    def sync(self) -> dict:
+        self.fileobj.write(self._frame.flush())
+        self._frame = self._compressor.compressobj()
+        return super().sync()
+
+    def close(self):
+        self.fileobj.write(self._frame.flush())
+        self.fileobj.flush()
+
+
+class _LZ4Stream(_RawStream):
+    """
+    LZ4 frame output stream. Like the zstandard stream, every sync ends a frame.
+    """
+    def __init__(self, fileobj, state: dict = None) -> None:
+        super().__init__(fileobj, state)
+        self._lz4 = _import_codec('lz4')
+        self._begin_frame()
+
+    def _begin_frame(self):
+        self._frame = self._lz4.LZ4FrameCompressor()
+        self.fileobj.write(self._frame.begin())
+
+    def write(self, data):
+        self.size += len(data)
+        self.fileobj.write(self._frame.compress(data))
+
+    def sync(self) -> dict:
+        self.fileobj.write(self._frame.flush())
+        state = super().sync()
+        self._begin_frame()
+        return state
+
+    def close(self):
+        self.fileobj.write(self._frame.flush())
+        self.fileobj.flush()
+
+
+_STREAMS = {'tar': _RawStream, 'gz': _GzipStream, 'zst': _ZstdStream, 'lz4': _LZ4Stream}
+
+
+def open_shard(fileobj, codec: str):
+    """
+    Get a stream of the uncompressed tar data of a shard.
+
+    Parameters
+    ----------
+    fileobj : file object
+        The shard, opened in binary mode.
+    codec : str
+        Codec of the shard. gzip is left to `tarfile`.
+
+    Returns
+    -------
+    file object
+        Readable stream of the tar file.
+    """
+    if codec == 'zst':
+        return _import_codec('zst').ZstdDecompressor().stream_reader(fileobj, read_across_frames = True, closefd = False)
+    if codec == 'lz4':
+        return _import_codec('lz4').LZ4FrameFile(fileobj, mode = 'rb')
+    return fileobj
+
+
+def shard_opener(data):
+    """
+    Open shards for `webdataset.tariterators.tar_file_expander`, whatever their codec.
+
+    Parameters
+    ----------
+    data : Iterable[dict]
+        Dicts with the path of a shard as `url`.
+
+    Yields
+    ------
+    dict
+        The dict, with the opened tar stream as `stream`.
+    """
+    for source in data:
+        with open(source['url'], 'rb') as f:
+            stream = open_shard(f, shard_codec(source['url']))
+            yield dict(source, stream = stream)
+            stream.close()
+
+
+def read_journal(journal_path: str):
+    """
+    Read a shard journal.
+
+    Parameters
+    ----------
+    journal_path : str
+        Path to the journal file.
+
+    Returns
+    -------
+    state : dict
+        Stream state at the last commit, or None if nothing was committed.
+    committed : set
+        Keys of all committed samples.
+    """
+    state, committed = None, set()
+    with open(journal_path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                break # incomplete last line
+            committed.update(entry.pop('keys'))
+            state = entry
+    return state, committed
+
+
+class ShardWriter():
+    """Write samples to a webdataset tar shard, optionally with a journal for resuming."""
+    def __init__(self, path: str, codec: str = None, journal: bool = False, commit_every: int = 1000,
+                 storage_dtype: str = 'float32') -> None:
+        """
+        Open a shard for writing.
+
+        Parameters
+        ----------
+        path : str
+            Path of the shard.
+        codec : str, optional
+            Compression of the shard, one of 'tar' (uncompressed), 'gz', 'zst' and 'lz4'.
+            The default is the codec of the file extension of path, or 'gz' if the extension is unknown.
+        journal : bool, optional
+            Whether to keep a journal of committed samples. The default is False.
+            If True, the shard is written to `{path}.partial` and journal entries are
+            appended to `{path}.journal`. If both files exist already, writing continues
+            after the last committed sample. The shard is moved to `path` on `close`.
+            Shards that are resumed have no `stats`, see `bend.io.manifest.scan_shard`.
+        commit_every : int, optional
+            Number of samples after which the shard is synced to disk and the written keys
+            are committed to the journal. Only used if journal is True. The default is 1000.
+        storage_dtype : str, optional
+            Dtype in which the `input.npy` embedding of each sample is stored. See `encode_embedding`.
+            The default is 'float32'.
+        """
+        self.path = path
+        self.journal_path = f'{path}.journal' if journal else None
+        self.partial_path = f'{path}.partial' if journal else path
+        self.commit_every = commit_every
+        self.committed = set()
+        if storage_dtype not in STORAGE_DTYPES:
+            raise ValueError(f'Unknown storage dtype {storage_dtype}, choose from {STORAGE_DTYPES}')
+        self.storage_dtype = storage_dtype
+        codec = codec if codec is not None else (shard_codec(path) or 'gz')
+        if codec not in SHARD_CODECS:
+            raise ValueError(f'Unknown shard codec {codec}, choose from {list(SHARD_CODECS)}')
+
+        self._encoder = make_encoder(True)
+        self._pending = []
+
+        state = None
+        if journal and os.path.exists(self.journal_path) and os.path.exists(self.partial_path):
+            state, self.committed = read_journal(self.journal_path)
+        # number of samples, dtypes and shapes for the manifest, unknown for the samples of a previous run
+        self.stats = ShardStats() if state is None else None
+
+        if state is None:
+            self._file = open(self.partial_path, 'wb')
+            if journal:
+                open(self.journal_path, 'w').close()
+        else:
+            # drop everything written after the last commit
+            self._file = open(self.partial_path, 'r+b')
+            self._file.truncate(state['offset'])
+            self._file.seek(state['offset'])
+
+        self._stream = _STREAMS[codec](self._file, state)
+        self._tar = tarfile.TarFile(fileobj = self._stream, mode = 'w', format = tarfile.USTAR_FORMAT)
+
+    def write(self, sample: dict):
+        """
+        Write a sample. Follows the conventions of `webdataset.TarWriter`.
+
+        Parameters
+        ----------
+        sample : dict
+            The sample. Needs a `__key__`, all other entries are encoded based on their extension.
+        """
+        with stage('serialization'):
+            if 'input.npy' in sample and self.storage_dtype != 'float32':
+                sample = {**sample, **encode_embedding(sample['input.npy'], self.storage_dtype)}
+            if self.stats is not None:
+                self.stats.add(sample)
+            sample = self._encoder(sample)
+        key = sample['__key__']
+        now = time.time()
+        # the tar data is compressed as it is written to the stream
+        with stage('compression'):
+            for k in sorted(sample.keys()):
+                if k.startswith('_'):
+                    continue
+                value = sample[k]
+                if isinstance(value, str):
+                    value = value.encode('utf-8')
+                info = tarfile.TarInfo(f'{key}.{k}')
+                info.size = len(value)
+                info.mtime = now
+                info.mode = 0o0444
+                info.uname = info.gname = 'bigdata'
+                self._tar.addfile(info, io.BytesIO(value))
+
+        if self.journal_path is not None:
+            self._pending.append(key)
+            if len(self._pending) >= self.commit_every:
+                self.commit()
+
+    def commit(self):
+        """Sync the shard to disk and add all samples written since the last commit to the journal."""
+        with stage('commit'):
+            state = self._stream.sync()
+        state['keys'] = self._pending
+        with open(self.journal_path, 'a') as f:
+            f.write(json.dumps(state) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.committed.update(self._pending)
+        self._pending = []
+
+    def close(self):
+        """Finish the shard. With a journal, the shard is moved to its final path and the journal is removed."""
+        self._tar.close()
+        self._stream.close()
+        self._file.close()
+        if self.journal_path is not None:
+            os.replace(self.partial_path, self.path)
+            os.remove(self.journal_path)
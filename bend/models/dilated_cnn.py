@@ -246,7 +246,7 @@ class ConvNetModel(ConvNetPreTrainedModel):
         ])
         self.post_init()
 
-    def forward(self, input_ids=None, **kwargs):
+    def forward(self, input_ids=None, attention_mask=None, **kwargs):
         """
         Perform a forward pass through the model.
 
@@ -254,9 +254,18 @@ class ConvNetModel(ConvNetPreTrainedModel):
         ----------
         input_ids: torch.Tensor
             Input tensor of nucleotide tokens.
+        attention_mask: torch.Tensor, optional
+            Mask of the positions that are not padding. Padding is set to zero before each layer,
+            so that the convolutions see the same zeros beyond the end of a padded sequence
+            as beyond the end of an unpadded one.
         """
         x = self.embedding(input_ids)
-        x = self.encoder(x)
+        if attention_mask is None:
+            x = self.encoder(x)
+        else:
+            mask = attention_mask.unsqueeze(-1).to(x.dtype)
+            for layer in self.encoder:
+                x = layer(x * mask)
         return BaseModelOutput(last_hidden_state=x)
 
 
@@ -410,6 +410,7 @@ class BertEncoder(nn.Module):
         attention_mask: torch.Tensor,
         output_all_encoded_layers: Optional[bool] = True,
         subset_mask: Optional[torch.Tensor] = None,
+        unpad_output: Optional[bool] = False,
     ) -> List[torch.Tensor]:
 
         extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
@@ -458,7 +459,10 @@ class BertEncoder(nn.Module):
             # and ntokens_unpad is total number of non-padded tokens.
             # Then padding performs the following de-compression:
             #     hidden_states[ntokens_unpad,hidden] -> hidden_states[ntokens,hidden]
-            hidden_states = pad_input(hidden_states, indices, batch, seqlen)
+            # With unpad_output, the hidden states of the non-padded tokens are returned
+            # as [ntokens_unpad,hidden], in the order of the batch.
+            if not unpad_output:
+                hidden_states = pad_input(hidden_states, indices, batch, seqlen)
         else:
             for i in range(len(self.layer) - 1):
                 layer_module = self.layer[i]
@@ -540,6 +544,8 @@ class BertModel(BertPreTrainedModel):
             input sequence length in the current batch. It's the mask that we typically use for attention when
             a batch has varying length sentences.
         `output_all_encoded_layers`: boolean which controls the content of the `encoded_layers` output as described below. Default: `True`.
+        `unpad_output`: boolean which, when `True`, returns the hidden-states of the non-padded tokens only, concatenated
+            over the batch as a torch.FloatTensor of size [total_tokens, hidden_size], and no pooled_output. Default: `False`.
 
     Outputs: Tuple of (encoded_layers, pooled_output)
         `encoded_layers`: controlled by `output_all_encoded_layers` argument:
@@ -586,6 +592,7 @@ class BertModel(BertPreTrainedModel):
         position_ids: Optional[torch.Tensor] = None,
         output_all_encoded_layers: Optional[bool] = False,
         masked_tokens_mask: Optional[torch.Tensor] = None,
+        unpad_output: Optional[bool] = False,
         **kwargs
     ) -> Tuple[Union[List[torch.Tensor], torch.Tensor], Optional[torch.Tensor]]:
         if attention_mask is None:
@@ -610,12 +617,14 @@ class BertModel(BertPreTrainedModel):
             embedding_output,
             attention_mask,
             output_all_encoded_layers=output_all_encoded_layers,
-            subset_mask=subset_mask)
+            subset_mask=subset_mask,
+            unpad_output=unpad_output)
 
         if masked_tokens_mask is None:
             sequence_output = encoder_outputs[-1]
+            # the first token of each sequence is not at [:, 0] of an unpadded output
             pooled_output = self.pooler(
-                sequence_output) if self.pooler is not None else None
+                sequence_output) if self.pooler is not None and not unpad_output else None
         else:
             # TD [2022-03-01]: the indexing here is very tricky.
             attention_mask_bool = attention_mask.bool()
@@ -3,15 +3,22 @@ data_downstream.py
 ==================
 Data loading and processing utilities for training
 downsteam tasks on embeddings saved in webdataset .tar.gz format.
+Shards compressed with zstandard or lz4 (.tar.zst, .tar.lz4) and uncompressed
+shards (.tar) are read as well. Embeddings saved as memory mapped flat stores
+(.flat, see `bend.io.flatstore`) are read with a map-style dataset instead.
 """
 
 # create torch dataset & dataloader from webdataset
 import torch
+import numpy as np
 from functools import partial
 import os
-import glob
 from typing import List, Tuple, Union
 import webdataset as wds
+from webdataset.tariterators import tar_file_expander, group_by_keys
+from bend.io.shards import decode_embedding, find_shards, shard_opener
+from bend.io.flatstore import FlatStore, find_flat_stores, FLAT_EXTENSION
+from bend.io.manifest import read_manifest, manifest_shards
 
 def pad_to_longest(sequences: List[torch.Tensor], padding_value = -100, batch_first=True):
     '''Pad a list of sequences to the longest sequence in the list.
@@ -79,14 +86,16 @@ def return_dataloader(data : Union[str, list],
                       batch_size : int = 8, 
                       num_workers : int = 0,
                       padding_value = -100, 
-                      shuffle : int = None):
+                      shuffle : int = None,
+                      lengths : List[int] = None):
     """
     Function to return a dataloader from a list of tar files or a single one.
     
     Parameters
     ----------
     data : Union[str, list]
-        Path to single tar file or list of paths to tar files.
+        Path to single tar file or list of paths to tar files. The codec of each
+        file is determined by its extension.
     batch_size : int, optional
         Batch size. The default is 8.
     num_workers : int, optional
@@ -94,16 +103,29 @@ def return_dataloader(data : Union[str, list],
     padding_value : int, optional
         Value to pad with. The default is -100.
     shuffle : int, optional
-        Whether to shuffle the data. The default is None.
+        Size of the buffer in which samples are shuffled. If not None, the order of the shards 
+        is shuffled as well. Shards that were written in shuffled order (see the `shuffle_seed`
+        of `bend.io.sequtils.embed_from_bed`) only need a small buffer. The default is None.
+    lengths : List[int], optional
+        Number of samples of each tar file, e.g. from the manifest of the data directory (see
+        `bend.io.manifest`). If given, the dataloader has a length: the exact number of batches,
+        taking into account that each worker batches the samples of its own shards. The default is None.
     """
 
     # '''Load data to dataloader from a list of paths or a single path'''
     if isinstance(data, str):
         data = [data]
-    dataset = wds.WebDataset(data)
+    dataset = wds.FluidWrapper(wds.SimpleShardList(data)).compose(wds.split_by_worker)
+    if shuffle is not None:
+        # shuffle the order of the shards of each worker, so that workers still read disjoint shards
+        dataset = dataset.shuffle(len(data), initial = len(data))
+    dataset = dataset.compose(shard_opener, # opens .tar, .tar.gz, .tar.zst and .tar.lz4 shards
+                              tar_file_expander,
+                              group_by_keys)
     if shuffle is not None:
         dataset = dataset.shuffle(shuffle)
     dataset = dataset.decode() # iterator over samples - each sample is dict with keys "input.npy" and "output.npy"
+    dataset = dataset.map(decode_embedding) # upcast embeddings stored with reduced precision
     dataset = dataset.to_tuple("input.npy", "output.npy")
     dataset = dataset.map_tuple(torch.from_numpy, torch.from_numpy) # TODO any specific dtype requirements or all handled already?
 
@@ -114,9 +136,93 @@ def return_dataloader(data : Union[str, list],
 
 
     dataloader = wds.WebLoader(dataset, num_workers=num_workers, batch_size=None)
+    if lengths is not None:
+        # wds.split_by_worker gives worker i the shards i, i + num_workers, ...
+        workers = max(num_workers, 1)
+        n_batches = sum(int(np.ceil(sum(lengths[i::workers]) / batch_size)) for i in range(workers))
+        dataloader = dataloader.with_length(n_batches, silent = True)
 
     return dataloader
 
+class FlatEmbeddingDataset(torch.utils.data.Dataset):
+    """
+    Dataset over one or more flat stores. Samples are sliced from memory maps,
+    so only the part of a sample that is returned is read from disk.
+    """
+    def __init__(self, data : List[str], crop : int = None):
+        """
+        Parameters
+        ----------
+        data : List[str]
+            Paths to the flat stores.
+        crop : int, optional
+            If given, samples that are longer than crop are cropped to a random window
+            of this length. The default is None.
+        """
+        self.stores = [FlatStore(x) for x in data]
+        self.offsets = np.cumsum([0] + [len(x) for x in self.stores])
+        self.crop = crop
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def _locate(self, idx):
+        store = int(np.searchsorted(self.offsets, idx, side = 'right')) - 1
+        return self.stores[store], idx - int(self.offsets[store])
+
+    def window(self, idx : int, start : int = None, end : int = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Get the window [start:end] of a sample along the sequence axis.
+        Labels with one entry per position are cropped to the same window.
+        """
+        store, idx = self._locate(idx)
+        embedding, labels = store.read(idx, start, end)
+        return torch.squeeze(torch.from_numpy(embedding)), torch.squeeze(torch.from_numpy(labels))
+
+    def __getitem__(self, idx):
+        if self.crop is not None:
+            store, i = self._locate(idx)
+            length = store.length(i)
+            if length > self.crop:
+                start = np.random.randint(0, length - self.crop + 1)
+                return self.window(idx, start, start + self.crop)
+        return self.window(idx)
+
+
+def return_flat_dataloader(data : Union[str, list], 
+                           batch_size : int = 8, 
+                           num_workers : int = 0,
+                           padding_value = -100, 
+                           shuffle : int = None, 
+                           crop : int = None):
+    """
+    Function to return a dataloader from a list of flat stores or a single one.
+    
+    Parameters
+    ----------
+    data : Union[str, list]
+        Path to single flat store or list of paths to flat stores.
+    batch_size : int, optional
+        Batch size. The default is 8.
+    num_workers : int, optional
+        Number of workers for data loading. The default is 0.
+    padding_value : int, optional
+        Value to pad with. The default is -100.
+    shuffle : int, optional
+        Whether to shuffle the data. Samples are shuffled globally if not None. The default is None.
+    crop : int, optional
+        If given, train on random windows of this length. The default is None.
+    """
+    if isinstance(data, str):
+        data = [data]
+    dataset = FlatEmbeddingDataset(data, crop = crop)
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size = batch_size, 
+                                             shuffle = shuffle is not None, 
+                                             num_workers = num_workers, 
+                                             collate_fn = partial(collate_fn_pad_to_longest, padding_value = padding_value))
+    return dataloader
+
+
 def get_data(data_dir : str, 
             train_data : List[str] = None, 
              valid_data : List[str] = None, 
@@ -126,6 +232,8 @@ def get_data(data_dir : str,
              num_workers : int = 32,
              padding_value = -100, 
              shuffle : int = None, 
+             backend : str = None,
+             crop : int = None,
              **kwargs):
 
     """
@@ -153,6 +261,15 @@ def get_data(data_dir : str,
         Value to pad with. The default is -100.
     shuffle : int, optional
         Whether to shuffle the data. The default is None.
+    backend : str, optional
+        'webdataset' for tar shards or 'flat' for memory mapped flat stores. By default,
+        tar shards are used if the data directory contains any, and flat stores otherwise.
+        If the data directory has a manifest (see `bend.io.manifest`), the complete shards and
+        their splits are taken from it, and the tar shard dataloaders know their exact length.
+        Otherwise, the directory is listed and the split is taken from the start of each file name.
+    crop : int, optional
+        Crop training samples to random windows of this length. Only supported by the 'flat' backend.
+        The default is None.
 
     Returns
     -------
@@ -167,11 +284,29 @@ def get_data(data_dir : str,
     if not os.path.exists(data_dir):
         print(data_dir)
         raise SystemExit(f'The data directory {data_dir} does not exist\nExiting script')
+    if backend is None:
+        backend = 'webdataset' if find_shards(data_dir) else 'flat'
+    if backend == 'webdataset':
+        if crop is not None:
+            raise ValueError('crop is only supported by the flat backend')
+        find_data, dataloader, train_kwargs = find_shards, return_dataloader, {}
+    elif backend == 'flat':
+        find_data, dataloader, train_kwargs = find_flat_stores, return_flat_dataloader, {'crop': crop}
+    else:
+        raise ValueError(f'Unknown backend {backend}, choose from webdataset, flat')
+    manifest = read_manifest(data_dir)
+    if manifest is not None:
+        shards = {path: x for path, x in manifest_shards(manifest, data_dir).items() 
+                  if path.endswith(FLAT_EXTENSION) == (backend == 'flat')}
+        find_data = lambda data_dir: list(shards)
+        split_of = {path: str(split) for path, (split, _) in shards.items()}
+    length_kwargs = lambda data: ({'lengths': [shards[x][1] for x in ([data] if isinstance(data, str) else data)]} 
+                                  if manifest is not None and backend == 'webdataset' else {})
     if cross_validation is not False:
         cross_validation = int(cross_validation) -1 
         # get basepath of data directory
-        # get all tar.gz in data directory
-        tars = glob.glob(f'{data_dir}/*.tar.gz')
+        # get all shards in data directory
+        tars = find_data(data_dir)
         # sort tar files
         tars = sorted(tars, key=lambda x: int(x.split('/')[-1].split('.')[0][4:]))
         test_data = tars[cross_validation]
@@ -187,10 +322,12 @@ def get_data(data_dir : str,
 
     # TODO chunking loading done right - need to support both this and the commented out block.
     else:
-        tars = glob.glob(f'{data_dir}/*.tar.gz')
-        train_data = [x for x in tars if os.path.split(x)[-1].startswith('train')]
-        valid_data = [x for x in tars if os.path.split(x)[-1].startswith('valid')]
-        test_data = [x for x in tars if os.path.split(x)[-1].startswith('test')]
+        tars = find_data(data_dir)
+        if manifest is None:
+            split_of = {x: os.path.split(x)[-1] for x in tars}
+        train_data = [x for x in tars if split_of[x].startswith('train')]
+        valid_data = [x for x in tars if split_of[x].startswith('valid')]
+        test_data = [x for x in tars if split_of[x].startswith('test')]
 
     # else: 
     #     # join data_dir with each item in train_data, valid_data and test_data 
@@ -201,15 +338,15 @@ def get_data(data_dir : str,
 
     # get dataloaders
     # import ipdb; ipdb.set_trace()
-    train_dataloader = return_dataloader(train_data, batch_size = batch_size, 
-                                         num_workers = num_workers, 
-                                         padding_value=padding_value, 
-                                         shuffle = shuffle) if train_data else None
-    valid_dataloader = return_dataloader(valid_data, batch_size = batch_size, 
-                                         num_workers = num_workers, 
-                                         padding_value=padding_value, ) if valid_data else None
-    test_dataloader = return_dataloader(test_data, batch_size = batch_size, 
-                                        num_workers = num_workers, 
-                                        padding_value=padding_value, ) if test_data else None
+    train_dataloader = dataloader(train_data, batch_size = batch_size, 
+                                  num_workers = num_workers, 
+                                  padding_value=padding_value, 
+                                  shuffle = shuffle, **train_kwargs, **length_kwargs(train_data)) if train_data else None
+    valid_dataloader = dataloader(valid_data, batch_size = batch_size, 
+                                  num_workers = num_workers, 
+                                  padding_value=padding_value, **length_kwargs(valid_data)) if valid_data else None
+    test_dataloader = dataloader(test_data, batch_size = batch_size, 
+                                 num_workers = num_workers, 
+                                 padding_value=padding_value, **length_kwargs(test_data)) if test_data else None
 
     return train_dataloader, valid_dataloader, test_dataloader
\ No newline at end of file
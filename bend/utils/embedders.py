@@ -20,6 +20,7 @@ import torch
 import numpy as np
 from typing import List, Iterable
 from functools import partial
+import itertools
 import os
 
 from bend.models.awd_lstm import AWDLSTMModelForInference
@@ -29,6 +30,9 @@ from bend.models.hyena_dna import HyenaDNAPreTrainedModel, CharacterTokenizer
 from bend.models.dnabert2 import BertModel as DNABert2BertModel
 from bend.models.dnabert2 import BertForMaskedLM as DNABert2BertForMaskedLM
 from bend.utils.download import download_model, download_model_zenodo
+from bend.utils.embedding_cache import EmbeddingCache, cached_embed
+from bend.utils.max_match import MaxMatchTokenizer
+from bend.utils.timing import stage, timed, time_forward
 
 from tqdm.auto import tqdm
 from transformers import logging, BertModel, BertConfig, BertTokenizer, AutoModel, AutoTokenizer, BigBirdModel, AutoModelForMaskedLM
@@ -42,6 +46,12 @@ logging.set_verbosity_error()
 
 device =  torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+
+def _to_numpy(tensor: torch.Tensor) -> np.ndarray:
+    """Copy a model output to the host as a numpy array."""
+    with stage('device_to_host'):
+        return tensor.detach().cpu().numpy()
+
 ##
 ## GPN https://www.biorxiv.org/content/10.1101/2022.08.22.504706v1
 ##
@@ -50,6 +60,12 @@ class BaseEmbedder():
     """Base class for embedders.
     All embedders should inherit from this class.
     """
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # look up embeddings in the cache, if the embedder has one
+        if 'embed' in cls.__dict__:
+            cls.embed = cached_embed(cls.__dict__['embed'])
+
     def __init__(self, *args, **kwargs):
         """Initialize the embedder. Calls `load_model` with the given arguments.
 
@@ -60,7 +76,11 @@ class BaseEmbedder():
         **kwargs
             Keyword arguments. Passed to `load_model`.
         """
+        self._load_args = [args, kwargs] # identifies the checkpoint and configuration in cache keys
         self.load_model(*args, **kwargs)
+        for value in vars(self).values():
+            if isinstance(value, torch.nn.Module):
+                time_forward(value)
 
     def load_model(self, *args, **kwargs):
         """Load the model. Should be implemented by the inheriting class."""
@@ -95,6 +115,201 @@ class BaseEmbedder():
         """
         return self.embed([sequence], *args, disable_tqdm=True, **kwargs)[0]
 
+    def token_lengths(self, sequence: str, remove_special_tokens: bool = True):
+        """Get the number of nucleotides covered by each vector of the embedding of a sequence.
+        `upsample_embeddings=True` repeats each vector this many times. Embedders that tokenize
+        sequences into multi-nucleotide tokens implement this, for all others it returns None.
+
+        Parameters
+        ----------
+        sequence : str
+            The sequence.
+        remove_special_tokens : bool, optional
+            Whether the special tokens are removed from the embedding. Defaults to True.
+
+        Returns
+        -------
+        np.ndarray
+            The length of each token, or None if the embedder does not support it.
+        """
+        return None
+
+    def share_memory(self):
+        """Move the weights of all models of the embedder to shared memory, so that
+        worker processes can use them without making a copy.
+
+        Returns
+        -------
+        BaseEmbedder
+            The embedder itself.
+        """
+        for value in vars(self).values():
+            if isinstance(value, torch.nn.Module):
+                value.share_memory()
+        return self
+
+    def enable_cache(self, cache_dir: str, max_size_gb: float = 100):
+        """Cache embeddings on disk. `embed` then only runs the model for sequences 
+        that this embedder, with the same arguments, has not embedded before.
+
+        Parameters
+        ----------
+        cache_dir : str
+            Directory of the cache. Can be shared by different embedders.
+        max_size_gb : float, optional
+            Maximum size of the cache in GiB. Least recently used embeddings are removed
+            when it is exceeded. Defaults to 100.
+
+        Returns
+        -------
+        BaseEmbedder
+            The embedder itself.
+        """
+        self.embedding_cache = EmbeddingCache(cache_dir, max_bytes = int(max_size_gb * 2**30))
+        return self
+
+    @staticmethod
+    def _forward_batches(inputs: List[List[int]], forward, batch_size: int = 1, pad_token_id: int = None, progress = None) -> List[torch.Tensor]:
+        """Run a model on tokenized sequences in batches, and split its output back into one tensor per sequence.
+
+        Inputs are sorted by length, so that each batch holds inputs of similar length, and padded on the
+        right. Models that do not mask padding can pass `pad_token_id=None`, in which case only inputs
+        of the same length share a batch and nothing is padded.
+
+        Parameters
+        ----------
+        inputs : List[List[int]]
+            Token ids of each input.
+        forward : Callable
+            Called with the `input_ids` and the `attention_mask` of a batch, both of shape (batch, length),
+            returns the output of shape (batch, length, ...), or a list with the output of each input of the
+            batch, of shape (1, length, ...) without padding.
+        batch_size : int, optional
+            Maximum number of inputs per forward. Defaults to 1.
+        pad_token_id : int, optional
+            Token id to pad with. Defaults to None.
+        progress : tqdm.tqdm, optional
+            Progress bar that is updated with the number of inputs of each batch.
+
+        Returns
+        -------
+        List[torch.Tensor]
+            The output of each input, of shape (1, length, ...) without padding.
+        """
+        order = sorted(range(len(inputs)), key = lambda i: len(inputs[i]), reverse = True)
+        if pad_token_id is None:
+            groups = [list(group) for _, group in itertools.groupby(order, key = lambda i: len(inputs[i]))]
+        else:
+            groups = [order]
+
+        outputs = [None] * len(inputs)
+        for group in groups:
+            for start in range(0, len(group), batch_size):
+                batch = group[start:start + batch_size]
+                length = len(inputs[batch[0]]) # the longest input of the batch
+                input_ids = torch.full((len(batch), length), pad_token_id if pad_token_id is not None else 0, dtype = torch.long)
+                attention_mask = torch.zeros((len(batch), length), dtype = torch.long)
+                for row, i in enumerate(batch):
+                    input_ids[row, :len(inputs[i])] = torch.as_tensor(inputs[i], dtype = torch.long)
+                    attention_mask[row, :len(inputs[i])] = 1
+                output = forward(input_ids.to(device), attention_mask.to(device))
+                for row, i in enumerate(batch):
+                    outputs[i] = output[row] if isinstance(output, list) else output[row:row + 1, :len(inputs[i])]
+                if progress is not None:
+                    progress.update(len(batch))
+        return outputs
+
+    @staticmethod
+    def _split_chunks(items, chunk_length: int):
+        """Split a sequence, or a list of tokens, into chunks of chunk_length items and a shorter last chunk."""
+        return [items[chunk : chunk + chunk_length] for chunk in range(0, len(items), chunk_length)]
+
+    def _tokenize_chunks(self, sequences: List[str], chunk_length: int, **kwargs) -> List[List[List[int]]]:
+        """Split sequences into chunks of chunk_length nucleotides and tokenize the chunks of all sequences together.
+        Keyword arguments are passed to the tokenizer. Returns the token ids of each chunk of each sequence."""
+        chunks = [self._split_chunks(sequence, chunk_length) for sequence in sequences]
+        flat = [chunk for sequence_chunks in chunks for chunk in sequence_chunks]
+        with stage('tokenization'):
+            input_ids = self.tokenizer(flat, return_attention_mask=False, **kwargs)['input_ids'] if len(flat) > 0 else []
+        offsets = np.cumsum([0] + [len(sequence_chunks) for sequence_chunks in chunks])
+        return [input_ids[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def _forward_chunks(self, chunks: List[List[List[int]]], forward, batch_size: int = 1, pad_token_id: int = None, progress = None) -> List[List[torch.Tensor]]:
+        """Run a model on the chunks of several sequences, with all chunks of a sequence in the same forward.
+
+        All chunks but the last one of a sequence have the same length, so they are stacked without padding.
+        Sequences are sorted by length and grouped `batch_size` at a time, and the chunks of each group are
+        passed to `_forward_batches` as one batch, so that a forward never holds more than `batch_size` sequences.
+
+        Parameters
+        ----------
+        chunks : List[List[List[int]]]
+            Token ids of each chunk of each sequence.
+        forward : Callable
+            See `_forward_batches`.
+        batch_size : int, optional
+            Number of sequences per forward. Defaults to 1.
+        pad_token_id : int, optional
+            See `_forward_batches`.
+        progress : tqdm.tqdm, optional
+            Progress bar that is updated with the number of chunks of each batch.
+
+        Returns
+        -------
+        List[List[torch.Tensor]]
+            The output of each chunk of each sequence, of shape (1, length, ...).
+        """
+        order = sorted(range(len(chunks)), key = lambda i: sum(map(len, chunks[i])), reverse = True)
+        outputs = [None] * len(chunks)
+        for start in range(0, len(order), batch_size):
+            group = order[start:start + batch_size]
+            flat = [chunk for i in group for chunk in chunks[i]]
+            group_outputs = self._forward_batches(flat, forward, batch_size = max(len(flat), 1),
+                                                  pad_token_id = pad_token_id, progress = progress)
+            offsets = np.cumsum([0] + [len(chunks[i]) for i in group])
+            for i, first, last in zip(group, offsets[:-1], offsets[1:]):
+                outputs[i] = group_outputs[first:last]
+        return outputs
+
+    @staticmethod
+    def _join_chunks(outputs: List[np.ndarray]) -> np.ndarray:
+        """Concatenate the embeddings of the chunks of a sequence, each of which starts with a CLS token
+        and ends with a SEP token. Only the CLS token of the first chunk and the SEP token of the last chunk are kept."""
+        if len(outputs) == 1:
+            return outputs[0]
+        # for intermediate chunks the special tokens need to go.
+        outputs = [outputs[0][:,:-1]] + [output[:,1:-1] for output in outputs[1:-1]] + [outputs[-1][:,1:]]
+        return np.concatenate(outputs, axis=1)
+
+    def _token_length_table(self) -> np.ndarray:
+        """Get the number of nucleotides covered by each token id of the tokenizer. Special tokens,
+        including unknown tokens, cover one nucleotide. The table is built once per embedder."""
+        if getattr(self, '_token_lengths', None) is None:
+            special_ids = set(self.tokenizer.all_special_ids)
+            tokens = self.tokenizer.convert_ids_to_tokens(list(range(len(self.tokenizer))))
+            self._token_lengths = np.array([1 if i in special_ids or not token else len(token) for i, token in enumerate(tokens)], dtype=np.int64)
+        return self._token_lengths
+
+    @timed('upsampling')
+    def _repeat_token_vectors(self, input_ids: Iterable[int], embeddings: np.ndarray) -> np.ndarray:
+        """Repeat the vector of each token of an embedding once for each nucleotide that the token covers.
+
+        Parameters
+        ----------
+        input_ids : Iterable[int]
+            Token ids of the embedding.
+        embeddings : np.ndarray
+            Embedding of shape (1, len(input_ids), ...).
+
+        Returns
+        -------
+        np.ndarray
+            Embedding of shape (1, number of nucleotides, ...).
+        """
+        lengths = self._token_length_table()[np.asarray(input_ids, dtype=np.int64)]
+        assert len(lengths) == embeddings.shape[1], 'Number of tokens and embeddings must match.'
+        return np.repeat(embeddings, lengths, axis=1)
+
 
 class GPNEmbedder(BaseEmbedder):
     '''Embed using the GPN model https://www.biorxiv.org/content/10.1101/2022.08.22.504706v1'''
@@ -130,10 +345,10 @@ class GPNEmbedder(BaseEmbedder):
         self.model.to(device)
         self.model.eval()
 
-    def embed(self, sequences: List[str], disable_tqdm: bool = False, upsample_embeddings: bool = False) -> List[np.ndarray]:
+    def embed(self, sequences: List[str], disable_tqdm: bool = False, upsample_embeddings: bool = False, batch_size: int = 1) -> List[np.ndarray]:
         """
         Embed a list of sequences.
-        
+
         Parameters
         ----------
         sequences : List[str]
@@ -143,6 +358,9 @@ class GPNEmbedder(BaseEmbedder):
         upsample_embeddings : bool, optional
             Whether to upsample the embeddings to the length of the input sequence. Defaults to False.
             Only provided for compatibility with other embedders. GPN embeddings are already the same length as the input sequence.
+        batch_size : int, optional
+            Number of sequences per forward. GPN is convolutional and does not mask padding,
+            so only sequences of the same length share a batch. Defaults to 1.
 
         Returns
         -------
@@ -151,16 +369,14 @@ class GPNEmbedder(BaseEmbedder):
         """
         # '''Run the GPN model https://www.biorxiv.org/content/10.1101/2022.08.22.504706v1'''
 
-        embeddings = []
         with torch.no_grad():
-            for seq in tqdm(sequences, disable=disable_tqdm):
-                input_ids = self.tokenizer(seq, return_tensors="pt", return_attention_mask=False, return_token_type_ids=False)["input_ids"]
-                input_ids = input_ids.to(device)
-                embedding = self.model(input_ids=input_ids).last_hidden_state
-                
-                embeddings.append(embedding.detach().cpu().numpy())
+            with stage('tokenization'):
+                input_ids = self.tokenizer(sequences, return_attention_mask=False, return_token_type_ids=False)["input_ids"]
+            with tqdm(total=len(sequences), disable=disable_tqdm) as progress:
+                outputs = self._forward_batches(input_ids, lambda ids, mask: self.model(input_ids=ids).last_hidden_state,
+                                                batch_size=batch_size, progress=progress)
 
-        return embeddings
+        return [_to_numpy(embedding) for embedding in outputs]
 
 
 
@@ -203,7 +419,7 @@ class DNABertEmbedder(BaseEmbedder):
 
         self.kmer = kmer
 
-    def embed(self, sequences: List[str], disable_tqdm: bool = False, remove_special_tokens: bool = True, upsample_embeddings: bool = False):
+    def embed(self, sequences: List[str], disable_tqdm: bool = False, remove_special_tokens: bool = True, upsample_embeddings: bool = False, batch_size: int = 1):
         """
         Embed a list of sequences.
 
@@ -217,36 +433,38 @@ class DNABertEmbedder(BaseEmbedder):
             Whether to remove the special tokens from the embeddings. Defaults to True.
         upsample_embeddings : bool, optional
             Whether to upsample the embeddings to the length of the input sequence. Defaults to False.
-        
+        batch_size : int, optional
+            Number of sequences per forward. Sequences of more than 512 tokens are split into chunks
+            of 512 tokens, which are embedded in the same forward. Defaults to 1.
+
         Returns
         -------
         List[np.ndarray]
             The embeddings of the sequences.
         """
-        embeddings = []
         with torch.no_grad():
-            for sequence in tqdm(sequences, disable=disable_tqdm):
-                sequence = [sequence]
-                kmers = self._seq2kmer_batch(sequence, self.kmer)
-                model_input = self.tokenizer.batch_encode_plus(kmers, 
-                                                               add_special_tokens=True,
-                                                               return_tensors='pt', 
-                                                               )["input_ids"]
-                
-                if model_input.shape[1] > 512:
-                    model_input = torch.split(model_input, 512, dim=1)
-                    output = []
-                    for chunk in model_input: 
-                        output.append(self.bert_model(chunk.to(device))[0].detach().cpu())
-                    output = torch.cat(output, dim=1).numpy()
-                else:
-                    output = self.bert_model(model_input.to(device))[0].detach().cpu().numpy()
-                embedding = output
+            with stage('tokenization'):
+                kmers = self._seq2kmer_batch(sequences, self.kmer)
+                model_inputs = self.tokenizer.batch_encode_plus(kmers,
+                                                                add_special_tokens=True,
+                                                                return_attention_mask=False,
+                                                                return_token_type_ids=False,
+                                                                )["input_ids"]
+                chunks = [self._split_chunks(model_input, 512) for model_input in model_inputs]
+
+            with tqdm(total=sum(map(len, chunks)), disable=disable_tqdm) as progress:
+                outputs = self._forward_chunks(chunks, lambda ids, mask: self.bert_model(ids, attention_mask=mask)[0],
+                                               batch_size=batch_size, pad_token_id=self.tokenizer.pad_token_id, progress=progress)
+            outputs = [np.concatenate([_to_numpy(output) for output in sequence_outputs], axis=1) for sequence_outputs in outputs]
+
+        embeddings = []
+        for n in range(len(sequences)):
+            embedding = outputs[n]
 
-                if upsample_embeddings:
-                    embedding = self._repeat_embedding_vectors(embedding)
+            if upsample_embeddings:
+                embedding = self._repeat_embedding_vectors(embedding)
 
-                embeddings.append(embedding[:,1:-1] if remove_special_tokens else embedding)
+            embeddings.append(embedding[:,1:-1] if remove_special_tokens else embedding)
 
         return embeddings
 
@@ -282,6 +500,7 @@ class DNABertEmbedder(BaseEmbedder):
     # kmer=5 input = 32 --> embedding = 28 --> repeat first twice and last twice.
 
     # kmer=6 input = 31 --> embedding = 26 --> repeat first twice and last three times.
+    @timed('upsampling')
     def _repeat_embedding_vectors(self, embeddings: np.ndarray, has_special_tokens: bool = True):
         '''Repeat embeddings at sequence edges to match input length'''
         if has_special_tokens:
@@ -355,7 +574,7 @@ class NucleotideTransformerEmbedder(BaseEmbedder):
         self.return_logits = return_logits
         self.return_loss = return_loss
 
-    def embed(self, sequences: List[str], disable_tqdm: bool = False, remove_special_tokens: bool = True, upsample_embeddings: bool = False):
+    def embed(self, sequences: List[str], disable_tqdm: bool = False, remove_special_tokens: bool = True, upsample_embeddings: bool = False, batch_size: int = 1):
         """
         Embed sequences using the Nuclieotide Transformer (NT) model.
         
@@ -369,91 +588,94 @@ class NucleotideTransformerEmbedder(BaseEmbedder):
              Whether to remove the special tokens from the embeddings. Defaults to True.
         upsample_embeddings : bool, optional
             Whether to upsample the embeddings to the length of the input sequence. Defaults to False.
+        batch_size : int, optional
+            Number of sequences per forward. Long sequences are split into chunks, all of which are embedded
+            in the same forward. Defaults to 1.
 
         Returns
         -------
         List[np.ndarray]
             List of embeddings.
         """
-        cls_tokens = []
         embeddings = []
         
         with torch.no_grad():
-            for n, s in enumerate(tqdm(sequences, disable=disable_tqdm)):
-                #print('sequence', n)
-                s_chunks = [s[chunk : chunk + self.max_seq_len] for chunk in  range(0, len(s), self.max_seq_len)] # split into chunks 
+            tokens_ids = self._tokenize_chunks(sequences, self.max_seq_len) # split into chunks
+            # chunks with too many tokens to fit into the model are split again, only the first piece has a CLS token
+            pieces = [[piece for ids in seq_ids for piece in self._split_chunks(ids, self.max_tokens)] for seq_ids in tokens_ids]
+
+            with tqdm(total=sum(map(len, pieces)), disable=disable_tqdm) as progress:
+                outputs = self._forward_chunks(pieces, self._forward, batch_size=batch_size,
+                                               pad_token_id=self.tokenizer.pad_token_id, progress=progress)
+
+            for seq_ids, seq_outputs in zip(tokens_ids, outputs):
                 embedded_seq = []
-                for n_chunk, chunk in enumerate(s_chunks): # embed each chunk
-                    tokens_ids = self.tokenizer(chunk, return_tensors = 'pt')['input_ids'].int().to(device)
-                    if len(tokens_ids[0]) > self.max_tokens: # too long to fit into the model
-                        split = torch.split(tokens_ids, self.max_tokens, dim=-1)
-                        if self.return_logits:
-                            outs = [self.model(item)['logits'].detach().cpu().numpy() for item in split]
-                        elif self.return_loss:
-                            outs = []
-                            for item in split:
-                                out = self.model(item)['logits'].detach()
+                for ids in seq_ids: # each chunk
+                    chunk_ids = torch.tensor([ids])
+                    n_pieces = len(self._split_chunks(ids, self.max_tokens))
+                    chunk_outputs, seq_outputs = seq_outputs[:n_pieces], seq_outputs[n_pieces:]
+                    if n_pieces == 1:
+                        outs = self._loss(chunk_outputs[0], chunk_ids, remove_special_tokens) if self.return_loss else chunk_outputs[0]
+                        outs = _to_numpy(outs)
+                    else:
+                        outs = []
+                        for out, item in zip(chunk_outputs, torch.split(chunk_ids, self.max_tokens, dim=-1)):
+                            if self.return_loss:
                                 out = out[:,1:,4:-2 ] if remove_special_tokens else out # unk, pad, mask,cls , ... actual tokens ... eos, bos
                                 item_subset = item[:,1:] - 4 if remove_special_tokens else item # remove special tokens
-                                out = torch.nn.functional.cross_entropy(out.view(-1, out.shape[-1]), item_subset.view(-1).to(torch.long), reduction='none')
-                                out = out.unsqueeze(0).detach().cpu().numpy()
-                                outs.append(out)
-                        else:
-                            outs = [self.model(item, output_hidden_states=True)['hidden_states'][-1].detach().cpu().numpy() for item in split]
+                                out = torch.nn.functional.cross_entropy(out.reshape(-1, out.shape[-1]), item_subset.reshape(-1).to(torch.long).to(out.device), reduction='none')
+                                out = out.unsqueeze(0)
+                            outs.append(_to_numpy(out))
                         outs = np.concatenate(outs, axis=1)
-                    else:
-                        if self.return_logits:
-                            outs = self.model(tokens_ids)['logits'].detach().cpu().numpy()
-                        elif self.return_loss:
-                            outs = self.model(tokens_ids)['logits'].detach() # NOTE  in V1 only is shape 4105, even though vocab_size is 4107. Correct in V2.
-                            # NOTE order in V1: unk, pad, mask,cls , ... actual tokens ... eos, bos  --> last 2 tokens are not used in the model.
-                            # in V2: unk, pad, mask,cls , eos, bos, ... actual tokens
-                            if self.is_v2:
-                                outs = outs[:,1:,6:] if remove_special_tokens else outs
-                                tokens_ids_subset = tokens_ids[:,1:] - 6 if remove_special_tokens else tokens_ids
-                            else:
-                                outs = outs[:,1:,4:] if remove_special_tokens else outs # unk, pad, mask,cls , ... actual tokens ... ( eos, bos)
-                                tokens_ids_subset = tokens_ids[:,1:] - 4 if remove_special_tokens else tokens_ids # token 4104 needs to be preseverd
-
-                            outs = torch.nn.functional.cross_entropy(outs.view(-1, outs.shape[-1]), tokens_ids_subset.view(-1).to(torch.long), reduction='none')
-                            outs = outs.unsqueeze(0).detach().cpu().numpy()
-                        else:
-                            outs = self.model(tokens_ids, output_hidden_states=True)['hidden_states'][-1].detach().cpu().numpy()
-
-                    if upsample_embeddings and not (self.return_loss and remove_special_tokens):
-                        outs = self._repeat_embedding_vectors(self.tokenizer.convert_ids_to_tokens(tokens_ids[0]), outs)
-                    elif upsample_embeddings and (self.return_loss and remove_special_tokens):
-                        # special case - we already had to remove special tokens before when computing outs.
-                        outs = self._repeat_embedding_vectors(self.tokenizer.convert_ids_to_tokens(tokens_ids[0,1:]), outs, has_special_tokens=False)
-                    
-                    if self.return_loss and remove_special_tokens:
-                        # again, cls is already removed.
-                        embedded_seq.append(outs)
-                    else:
-                        embedded_seq.append(outs[:,1:] if remove_special_tokens else outs)
 
-                embeddings.append(np.concatenate(embedded_seq, axis=1)) 
+                    embedded_seq.append(self._finish_chunk(outs, chunk_ids, remove_special_tokens, upsample_embeddings))
 
-        return embeddings
-    
-    @staticmethod
-    def _repeat_embedding_vectors(tokens: Iterable[str], embeddings: np.ndarray, has_special_tokens: bool = True):
-        '''
-        Nucleotide transformer uses 6-mer embedding, but single-embedding for remaining nucleotides.
-        '''
-        assert len(tokens) == embeddings.shape[1], 'Number of tokens and embeddings must match.'
-        new_embeddings = []
-        for idx, token in enumerate(tokens):
+                embeddings.append(np.concatenate(embedded_seq, axis=1))
 
-            if has_special_tokens and idx == 0:
-                new_embeddings.append(embeddings[:, [idx]]) # (1, hidden_dim)
-                continue
-            token_embedding = embeddings[:, [idx]] # (1, hidden_dim)
-            new_embeddings.extend([token_embedding] * len(token))
+        return embeddings
 
-        # list of (1,1, 768) arrays
-        new_embeddings = np.concatenate(new_embeddings, axis=1)
-        return new_embeddings
+    def _forward(self, tokens_ids: torch.Tensor, attention_mask: torch.Tensor = None) -> torch.Tensor:
+        """Get the logits or the last hidden states of a batch of token ids."""
+        if self.return_logits or self.return_loss:
+            return self.model(tokens_ids, attention_mask=attention_mask)['logits']
+        return self.model(tokens_ids, attention_mask=attention_mask, output_hidden_states=True)['hidden_states'][-1]
+
+    def _loss(self, outs: torch.Tensor, tokens_ids: torch.Tensor, remove_special_tokens: bool = True) -> torch.Tensor:
+        """Get the unreduced loss of the tokens of one chunk from its logits."""
+        # NOTE  in V1 only is shape 4105, even though vocab_size is 4107. Correct in V2.
+        # NOTE order in V1: unk, pad, mask,cls , ... actual tokens ... eos, bos  --> last 2 tokens are not used in the model.
+        # in V2: unk, pad, mask,cls , eos, bos, ... actual tokens
+        if self.is_v2:
+            outs = outs[:,1:,6:] if remove_special_tokens else outs
+            tokens_ids_subset = tokens_ids[:,1:] - 6 if remove_special_tokens else tokens_ids
+        else:
+            outs = outs[:,1:,4:] if remove_special_tokens else outs # unk, pad, mask,cls , ... actual tokens ... ( eos, bos)
+            tokens_ids_subset = tokens_ids[:,1:] - 4 if remove_special_tokens else tokens_ids # token 4104 needs to be preseverd
+
+        outs = torch.nn.functional.cross_entropy(outs.reshape(-1, outs.shape[-1]), tokens_ids_subset.reshape(-1).to(torch.long).to(outs.device), reduction='none')
+        return outs.unsqueeze(0)
+
+    def _finish_chunk(self, outs: np.ndarray, tokens_ids: torch.Tensor, remove_special_tokens: bool = True, upsample_embeddings: bool = False) -> np.ndarray:
+        """Upsample the embedding of one chunk and remove its CLS token."""
+        if upsample_embeddings and not (self.return_loss and remove_special_tokens):
+            outs = self._repeat_token_vectors(tokens_ids[0], outs)
+        elif upsample_embeddings and (self.return_loss and remove_special_tokens):
+            # special case - we already had to remove special tokens before when computing outs.
+            outs = self._repeat_token_vectors(tokens_ids[0,1:], outs)
+
+        if self.return_loss and remove_special_tokens:
+            # again, cls is already removed.
+            return outs
+        return outs[:,1:] if remove_special_tokens else outs
+    
+    def token_lengths(self, sequence: str, remove_special_tokens: bool = True):
+        """Get the number of nucleotides covered by each token of the embedding of a sequence.
+        See `BaseEmbedder.token_lengths`."""
+        lengths = []
+        for chunk in range(0, len(sequence), self.max_seq_len):
+            chunk_lengths = self._token_length_table()[self.tokenizer(sequence[chunk : chunk + self.max_seq_len])['input_ids']]
+            lengths.extend(chunk_lengths[1:] if remove_special_tokens else chunk_lengths) # the first token is CLS
+        return np.array(lengths, dtype=np.int64)
 
 
 
@@ -486,7 +708,7 @@ class AWDLSTMEmbedder(BaseEmbedder):
 
         self.tokenizer = AutoTokenizer.from_pretrained(model_path)
 
-    def embed(self, sequences: List[str], disable_tqdm: bool = False, upsample_embeddings: bool = False):
+    def embed(self, sequences: List[str], disable_tqdm: bool = False, upsample_embeddings: bool = False, batch_size: int = 1):
         """
         Embed sequences using the AWD-LSTM baseline LM trained in BEND.
 
@@ -499,24 +721,25 @@ class AWDLSTMEmbedder(BaseEmbedder):
         upsample_embeddings : bool, optional
             Whether to upsample the embeddings to the length of the input sequence. Defaults to False.
             Only provided for compatibility with other embedders. GPN embeddings are already the same length as the input sequence.
+        batch_size : int, optional
+            Number of sequences per forward. Defaults to 1.
 
         Returns
         -------
         List[np.ndarray]
             List of embeddings.
         """
-        embeddings = []
+        # the LSTM reads left to right, so padding on the right does not change the embedding of a sequence.
+        # a bidirectional LSTM would read the padding first, so then only sequences of the same length share a batch.
+        pad_token_id = None if self.model.config.bidirectional else self.tokenizer.pad_token_id
         with torch.no_grad():
-            for s in tqdm(sequences, disable=disable_tqdm):
-
-                input_ids = self.tokenizer(s, return_tensors="pt", return_attention_mask=False, return_token_type_ids=False)["input_ids"]
-                input_ids = input_ids.to(device)
-                embedding = self.model(input_ids=input_ids).last_hidden_state
-                
-                embeddings.append(embedding.detach().cpu().numpy())
-                # embeddings.append(embedding.detach().cpu().numpy()[:,1:])
-            
-        return embeddings
+            with stage('tokenization'):
+                input_ids = self.tokenizer(sequences, return_attention_mask=False, return_token_type_ids=False)["input_ids"]
+            with tqdm(total=len(sequences), disable=disable_tqdm) as progress:
+                outputs = self._forward_batches(input_ids, lambda ids, mask: self.model(input_ids=ids).last_hidden_state,
+                                                batch_size=batch_size, pad_token_id=pad_token_id, progress=progress)
+
+        return [_to_numpy(embedding) for embedding in outputs]
 
 class ConvNetEmbedder(BaseEmbedder):
     """
@@ -543,7 +766,7 @@ class ConvNetEmbedder(BaseEmbedder):
         # load model        
         self.model = ConvNetModel.from_pretrained(model_path).to(device).eval()
     
-    def embed(self, sequences: List[str], disable_tqdm: bool = False, upsample_embeddings: bool = False):
+    def embed(self, sequences: List[str], disable_tqdm: bool = False, upsample_embeddings: bool = False, batch_size: int = 1):
         """
         Embed sequences using the GPN-inspired ConvNet baseline LM trained in BEND.
 
@@ -556,21 +779,24 @@ class ConvNetEmbedder(BaseEmbedder):
         upsample_embeddings : bool, optional
             Whether to upsample the embeddings to the length of the input sequence. Defaults to False.
             Only provided for compatibility with other embedders. GPN embeddings are already the same length as the input sequence.
+        batch_size : int, optional
+            Number of sequences per forward. Defaults to 1.
 
         Returns
         -------
         List[np.ndarray]
             List of embeddings.
         """
-        embeddings = [] 
+        # the model zeroes the padding before each convolution, see `ConvNetModel.forward`
+        pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else 0
         with torch.no_grad():
-            for s in tqdm(sequences, disable=disable_tqdm):
-                input_ids = self.tokenizer(s, return_tensors="pt", return_attention_mask=False, return_token_type_ids=False)["input_ids"]
-                input_ids = input_ids.to(device)
-                embedding = self.model(input_ids=input_ids).last_hidden_state
-                embeddings.append(embedding.detach().cpu().numpy())
+            with stage('tokenization'):
+                input_ids = self.tokenizer(sequences, return_attention_mask=False, return_token_type_ids=False)["input_ids"]
+            with tqdm(total=len(sequences), disable=disable_tqdm) as progress:
+                outputs = self._forward_batches(input_ids, lambda ids, mask: self.model(input_ids=ids, attention_mask=mask).last_hidden_state,
+                                                batch_size=batch_size, pad_token_id=pad_token_id, progress=progress)
 
-        return embeddings
+        return [_to_numpy(embedding) for embedding in outputs]
     
         
 
@@ -605,7 +831,7 @@ class GENALMEmbedder(BaseEmbedder):
         # or 512 BPE tokens (bert)
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
 
-    def embed(self, sequences: List[str], disable_tqdm: bool = False, remove_special_tokens: bool = True, upsample_embeddings: bool = False):
+    def embed(self, sequences: List[str], disable_tqdm: bool = False, remove_special_tokens: bool = True, upsample_embeddings: bool = False, batch_size: int = 1):
         """
         Embed sequences using the GENA-LM model.
 
@@ -619,6 +845,10 @@ class GENALMEmbedder(BaseEmbedder):
             Whether to remove the [CLS] and [SEP] tokens from the output. Defaults to True.
         upsample_embeddings : bool, optional
             Whether to upsample the embeddings to the length of the input sequence. Defaults to False.
+        batch_size : int, optional
+            Number of sequences per forward. Long sequences are split into chunks, all of which are embedded
+            in the same forward. The block sparse attention of the BigBird models also attends to the padding
+            at the end of a sequence, so for these only chunks of the same length share a batch. Defaults to 1.
 
         Returns
         -------
@@ -631,74 +861,44 @@ class GENALMEmbedder(BaseEmbedder):
 
         # TODO The handling of gaps in upsample_embeddings is not tested extensively.
         # The second tokenizer, trained on T2T+1000G SNPs+Multispieces, includes a preprocessing step for long gaps: more than 10 consecutive N are replaced by a single - token.
-        embeddings = [] 
+        outputs = []
         with torch.no_grad():
-            for s in tqdm(sequences, disable=disable_tqdm):
-                input_ids = self.tokenizer(s, return_tensors="pt", return_attention_mask=False, return_token_type_ids=False)["input_ids"]
-                input_ids_nospecial = input_ids[:,1:-1] # remove the special tokens. we add them to each chunk ourselves
-
-                id_chunks = [input_ids_nospecial[:, chunk : chunk + self.max_length] for chunk in  range(0, input_ids_nospecial.shape[1], self.max_length)] # split into chunks 
-                embedded_seq = []
-                for n_chunk, chunk in enumerate(id_chunks): # embed each chunk  
+            with stage('tokenization'):
+                all_input_ids = self.tokenizer(sequences, return_attention_mask=False, return_token_type_ids=False)["input_ids"]
+            # remove the special tokens, split into chunks and add the special tokens to each chunk ourselves
+            chunks = [[[self.tokenizer.cls_token_id] + chunk + [self.tokenizer.sep_token_id] for chunk in self._split_chunks(input_ids[1:-1], self.max_length)]
+                      for input_ids in all_input_ids]
+
+            with tqdm(total=sum(map(len, chunks)), disable=disable_tqdm) as progress:
+                pad_token_id = None if isinstance(self.model, BigBirdModel) else self.tokenizer.pad_token_id
+                chunk_outputs = self._forward_chunks(chunks, lambda ids, mask: self.model(ids, attention_mask=mask)['last_hidden_state'],
+                                                     batch_size=batch_size, pad_token_id=pad_token_id, progress=progress)
+            for sequence_outputs in chunk_outputs:
+                outputs.append(self._join_chunks([_to_numpy(outs) for outs in sequence_outputs]))
 
-                    # add the special tokens
-                    chunk = torch.cat([torch.ones((chunk.shape[0], 1), dtype=torch.long) * self.tokenizer.cls_token_id, 
-                                       chunk, 
-                                       torch.ones((chunk.shape[0], 1), dtype=torch.long) * self.tokenizer.sep_token_id], dim=1)     
-                    chunk = chunk.to(device)
-
-                    outs = self.model(chunk)['last_hidden_state'].detach().cpu().numpy()
-                    # print(outs.shape)
-
-                    # for intermediate chunks the special tokens need to go.
-                    # if we only have 1 chunk, keep them for now.
-                    if len(id_chunks) != 1:
-                        if n_chunk == 0:
-                            outs = outs[:,:-1] # no SEP
-                        elif n_chunk == len(id_chunks) - 1:
-                            outs = outs[:,1:] # no CLS
-                        else:
-                            outs = outs[:,1:-1] # no CLS and no SEP
-
-                    embedded_seq.append(outs)
-
-                embedding = np.concatenate(embedded_seq, axis=1)
+        embeddings = [] 
+        for n, input_ids in enumerate(all_input_ids):
+            embedding = outputs[n]
 
-                if upsample_embeddings:
-                    embedding = self._repeat_embedding_vectors(self.tokenizer.convert_ids_to_tokens(input_ids[0]), embedding)
+            if upsample_embeddings:
+                embedding = self._repeat_token_vectors(input_ids, embedding)
 
-                if remove_special_tokens:
-                    embedding = embedding[:,1:-1]
+            if remove_special_tokens:
+                embedding = embedding[:,1:-1]
 
-                embeddings.append(embedding)
+            embeddings.append(embedding)
 
-                #extended token_ids
-                # ext_token_ids = [[x] * len(self.tokenizer.convert_ids_to_tokens([x])[0]) for x in input_ids[0,1:-1]]
-                # ext_token_ids = [item for sublist in ext_token_ids for item in sublist]
+            #extended token_ids
+            # ext_token_ids = [[x] * len(self.tokenizer.convert_ids_to_tokens([x])[0]) for x in input_ids[0,1:-1]]
+            # ext_token_ids = [item for sublist in ext_token_ids for item in sublist]
 
         return embeddings
 
-    # GATTTATTAGGGGAGATTTTATATATCCCGA
-    # ['[CLS]', 'G', 'ATTTATT', 'AGGGG', 'AGATT', 'TTATAT', 'ATCCCG', 'A', '[SEP]']
-    @staticmethod
-    def _repeat_embedding_vectors(tokens: Iterable[str], embeddings: np.ndarray, has_special_tokens: bool = True):
-        '''
-        Byte-pair encoding merges a variable number of letters into one token.
-        We need to repeat each token's embedding vector for each letter in the token.
-        '''
-        assert len(tokens) == embeddings.shape[1], 'Number of tokens and embeddings must match.'
-        new_embeddings = []
-        for idx, token in enumerate(tokens):
-
-            if has_special_tokens and (idx == 0 or idx == len(tokens) - 1):
-                new_embeddings.append(embeddings[:, [idx]]) # (1, 768)
-                continue
-            token_embedding = embeddings[:, [idx]] # (1, 768)
-            new_embeddings.extend([token_embedding] * len(token))
-
-        # list of (1,1, 768) arrays
-        new_embeddings = np.concatenate(new_embeddings, axis=1)
-        return new_embeddings
+    def token_lengths(self, sequence: str, remove_special_tokens: bool = True):
+        """Get the number of nucleotides covered by each token of the embedding of a sequence.
+        See `BaseEmbedder.token_lengths`."""
+        lengths = self._token_length_table()[self.tokenizer(sequence)['input_ids']]
+        return lengths[1:-1] if remove_special_tokens else lengths
 
 
 
@@ -801,7 +1001,7 @@ class HyenaDNAEmbedder(BaseEmbedder):
             padding_side='left', # since HyenaDNA is causal, we pad on the left
         )
 
-    def embed(self, sequences: List[str], disable_tqdm: bool = False, remove_special_tokens: bool = True, upsample_embeddings: bool = False):
+    def embed(self, sequences: List[str], disable_tqdm: bool = False, remove_special_tokens: bool = True, upsample_embeddings: bool = False, batch_size: int = 1):
         '''Embeds a list of sequences using the HyenaDNA model.
         Parameters
         ----------
@@ -815,58 +1015,50 @@ class HyenaDNAEmbedder(BaseEmbedder):
         upsample_embeddings : bool, optional
             Whether to upsample the embeddings to match the length of the input sequences. Defaults to False.
             Only provided for compatibility with other embedders. HyenaDNA embeddings are already the same length as the input sequence.
+        batch_size : int, optional
+            Number of sequences per forward. Long sequences are split into chunks, all of which are embedded in the same forward.
+            HyenaDNA is causal, so padding at the end of a chunk does not change its embedding. Defaults to 1.
         Returns
         -------
 
         embeddings : List[np.ndarray]
             List of embeddings.
         '''
+        if self.return_loss and not remove_special_tokens:
+            raise ValueError('return_loss is incompatible with remove_special_tokens=False. We always remove EOS and BOS tokens to calculate the loss.')
 
-        embeddings = [] 
+        embeddings = []
         with torch.inference_mode():
-            for s in tqdm(sequences, disable=disable_tqdm):
-                chunks = [s[chunk : chunk + self.max_length] for chunk in  range(0, len(s), self.max_length)] # split into chunks
-                embedded_chunks = []
-                for n_chunk, chunk in enumerate(chunks):
-                    # reference: https://colab.research.google.com/drive/1wyVEQd4R3HYLTUOXEEQmp_I8aNC_aLhL?usp=sharing#scrollTo=-1wq2uwUctPV
-                    #### Single embedding example ####
-
-                    # create a sample 450k long, prepare
-                    # sequence = 'ACTG' * int(self.max_length/4)
-                    tok_seq = self.tokenizer(chunk) # adds CLS and SEP tokens (0=CLS, 1=EOS)
-                    tok_seq = tok_seq["input_ids"]  # grab ids
-
-                    # place on device, convert to tensor
-                    tok_seq = torch.LongTensor(tok_seq).unsqueeze(0)  # unsqueeze for batch dim
-                    tok_seq = tok_seq.to(device)
-
-                    output = self.model(tok_seq)
-
+            # reference: https://colab.research.google.com/drive/1wyVEQd4R3HYLTUOXEEQmp_I8aNC_aLhL?usp=sharing#scrollTo=-1wq2uwUctPV
+            tok_seqs = self._tokenize_chunks(sequences, self.max_length) # adds CLS and SEP tokens (0=CLS, 1=EOS) to each chunk
 
-                    if self.return_loss and remove_special_tokens:
-                        # vocab:
-                        # {0: '[CLS]', 1: '[SEP]', 2: '[BOS]', 3: '[MASK]', 4: '[PAD]', 5: '[RESERVED]', 6: '[UNK]', 7: 'A', 8: 'C', 9: 'G', 10: 'T', 11: 'N'}
-                        output = output[:, :,7: 12]
-                        shift_logits = output[..., :-2, :].contiguous() # remove EOS and last AA
-                        shift_labels = tok_seq[..., 1:-1] # remove BOS and EOS
-                        shift_labels = shift_labels - 7 # shift to 0-indexed
-                        loss = torch.nn.functional.cross_entropy(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1), reduction='none')
-                        output = loss.unsqueeze(0) # dim 0 gets lost because of view
+            with tqdm(total=sum(map(len, tok_seqs)), disable=disable_tqdm) as progress:
+                outputs = self._forward_chunks(tok_seqs, lambda ids, mask: self.model(ids), batch_size=batch_size,
+                                               pad_token_id=self.tokenizer.pad_token_id, progress=progress)
 
+            for chunks, chunk_outputs in zip(tok_seqs, outputs):
+                embedded_chunks = [self._finish_chunk(output, torch.LongTensor([tok_seq]).to(device), remove_special_tokens)
+                                   for tok_seq, output in zip(chunks, chunk_outputs)]
+                embeddings.append(np.concatenate(embedded_chunks, axis=1))
 
-                    elif self.return_loss and not remove_special_tokens:
-                        raise ValueError('return_loss is incompatible with remove_special_tokens=False. We always remove EOS and BOS tokens to calculate the loss.')
-                    
-                    elif remove_special_tokens:
-                        output = output[:,1:-1]
+        return embeddings
 
-                    embedded_chunks.append(output.detach().cpu().numpy())
+    def _finish_chunk(self, output: torch.Tensor, tok_seq: torch.Tensor, remove_special_tokens: bool = True) -> np.ndarray:
+        '''Compute the loss of one chunk from its logits, or remove its special tokens.'''
+        if self.return_loss:
+            # vocab:
+            # {0: '[CLS]', 1: '[SEP]', 2: '[BOS]', 3: '[MASK]', 4: '[PAD]', 5: '[RESERVED]', 6: '[UNK]', 7: 'A', 8: 'C', 9: 'G', 10: 'T', 11: 'N'}
+            output = output[:, :,7: 12]
+            shift_logits = output[..., :-2, :].contiguous() # remove EOS and last AA
+            shift_labels = tok_seq[..., 1:-1] # remove BOS and EOS
+            shift_labels = shift_labels - 7 # shift to 0-indexed
+            loss = torch.nn.functional.cross_entropy(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.reshape(-1), reduction='none')
+            output = loss.unsqueeze(0) # dim 0 gets lost because of view
 
-                embedding = np.concatenate(embedded_chunks, axis=1)
-                
-                embeddings.append(embedding)
+        elif remove_special_tokens:
+            output = output[:,1:-1]
 
-        return embeddings
+        return _to_numpy(output)
 
 
 
@@ -906,7 +1098,7 @@ class DNABert2Embedder(BaseEmbedder):
         self.return_loss = return_loss
 
 
-    def embed(self, sequences: List[str], disable_tqdm: bool = False, remove_special_tokens: bool = True, upsample_embeddings: bool = False):
+    def embed(self, sequences: List[str], disable_tqdm: bool = False, remove_special_tokens: bool = True, upsample_embeddings: bool = False, batch_size: int = 1):
         '''Embeds a list sequences using the DNABERT2 model.
         
         Parameters
@@ -919,6 +1111,9 @@ class DNABert2Embedder(BaseEmbedder):
             Whether to remove the CLS and SEP tokens from the embeddings. Defaults to True.
         upsample_embeddings : bool, optional
             Whether to upsample the embeddings to match the length of the input sequences. Defaults to False.
+        batch_size : int, optional
+            Number of sequences per forward. Long sequences are split into chunks, all of which are embedded
+            in the same forward. Defaults to 1.
 
         Returns
         -------
@@ -932,90 +1127,84 @@ class DNABert2Embedder(BaseEmbedder):
         # '''
         embeddings = []
         with torch.no_grad():
-            for sequence in tqdm(sequences, disable=disable_tqdm):
+            all_input_ids = self._tokenize_chunks(sequences, self.max_length, return_token_type_ids=False) # split into chunks
 
-                chunks = [sequence[chunk : chunk + self.max_length] for chunk in  range(0, len(sequence), self.max_length)] # split into chunks
+            with tqdm(total=sum(map(len, all_input_ids)), disable=disable_tqdm) as progress:
+                outputs = self._forward_chunks(all_input_ids, self._forward, batch_size=batch_size,
+                                               pad_token_id=self.tokenizer.pad_token_id, progress=progress)
 
-                embedded_chunks = []
-                for n_chunk, chunk in enumerate(chunks):
-
-                    input_ids = self.tokenizer(chunk, return_tensors="pt", return_attention_mask=False, return_token_type_ids=False)["input_ids"]
-                    
-                    if self.return_logits:
-                        output = self.model(input_ids.to(device))['logits'].detach().cpu().numpy()
-                    elif self.return_loss:
-                        output = self.model(input_ids.to(device))['logits'].detach() # (1, len, 4096)
-                        dim_to_remove = [1, 2, 3, 4]  # indices for '[CLS]', '[SEP]', '[PAD]', '[MASK]'. We preserve UNK at 0.
-                        mask = torch.ones(output.shape[2], dtype=bool)  # create a mask of True values
-                        mask[dim_to_remove] = False  # set the dimensions you want to remove to False
-                        output = output[:,1:-1,mask] if remove_special_tokens else output # remove CLS and SEP, cut dimensions ['[CLS]', '[SEP]', '[PAD]', '[MASK]', ...
-                        
-                        # shift and offset input_ids
-                        greater_than_4 = input_ids > 4
-                        input_ids_shifted = input_ids - 4 * greater_than_4 # Subtract 4 from the tokens that are greater than 4
-                        input_ids_shifted = input_ids_shifted[:,1:-1] if remove_special_tokens else input_ids # remove CLS and SEP, shift to 0-indexed
-                        output = torch.nn.functional.cross_entropy(output.view(-1, output.shape[-1]), input_ids_shifted.view(-1).to(torch.long).to(device), reduction='none').cpu().unsqueeze(0).numpy()
-                    else:
-                        output = self.model(input_ids.to(device), output_hidden_states=True)['hidden_states'][-1].detach().cpu().numpy()
-                    if upsample_embeddings and not (self.return_loss and remove_special_tokens):
-                        output = self._repeat_embedding_vectors(self.tokenizer.convert_ids_to_tokens(input_ids[0]), output)
-                    elif upsample_embeddings and (self.return_loss and remove_special_tokens):
-                        output = self._repeat_embedding_vectors(self.tokenizer.convert_ids_to_tokens(input_ids[0,1:-1]), output, has_special_tokens=False)
-
-                    # for intermediate chunks the special tokens need to go.
-                    # if we only have 1 chunk, keep them for now.
-                    if len(chunks) != 1:
-                        if n_chunk == 0:
-                            output = output[:,:-1] # no SEP
-                        elif n_chunk == len(chunks) - 1:
-                            output = output[:,1:] # no CLS
-                        else:
-                            output = output[:,1:-1] # no CLS and no SEP
+            for chunks, chunk_outputs in zip(all_input_ids, outputs):
+                embedded_chunks = [self._finish_chunk(output, torch.LongTensor([input_ids]), remove_special_tokens, upsample_embeddings)
+                                   for input_ids, output in zip(chunks, chunk_outputs)]
+                embeddings.append(self._join_chunks(embedded_chunks))
 
-                    embedded_chunks.append(output)
+        if remove_special_tokens and not self.return_loss:
+            embeddings = [embedding[:,1:-1] for embedding in embeddings]
 
-                embedding = np.concatenate(embedded_chunks, axis=1)
-
-                if remove_special_tokens and not self.return_loss:
-                    embedding = embedding[:,1:-1]
-
-                embeddings.append(embedding)
+        return embeddings
 
+    def _forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor = None) -> List[torch.Tensor]:
+        '''Get the logits or the last hidden states of each sequence of a batch of token ids.
 
-        return embeddings
+        The encoder already drops padding before its layers. Its output is kept unpadded, so that
+        the MLM head only runs on real tokens, and is split back into one (1, length, dim) tensor per sequence.
+        '''
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        # calls the submodules directly, which the hooks of `time_forward` on self.model do not see
+        with stage('forward', synchronize=True):
+            # (total_tokens, dim) hidden states of the non-padded tokens, sequence after sequence
+            output = self.model.bert(input_ids, attention_mask=attention_mask, unpad_output=True)[0]
+            if self.return_logits or self.return_loss:
+                output = self.model.cls(output)
+        return [x.unsqueeze(0) for x in torch.split(output, attention_mask.sum(dim=1).tolist())]
+
+    def _finish_chunk(self, output: torch.Tensor, input_ids: torch.Tensor, remove_special_tokens: bool = True, upsample_embeddings: bool = False) -> np.ndarray:
+        '''Compute the loss of one chunk from its logits, and upsample its embedding.'''
+        if self.return_loss:
+            dim_to_remove = [1, 2, 3, 4]  # indices for '[CLS]', '[SEP]', '[PAD]', '[MASK]'. We preserve UNK at 0.
+            mask = torch.ones(output.shape[2], dtype=bool)  # create a mask of True values
+            mask[dim_to_remove] = False  # set the dimensions you want to remove to False
+            output = output[:,1:-1,mask] if remove_special_tokens else output # remove CLS and SEP, cut dimensions ['[CLS]', '[SEP]', '[PAD]', '[MASK]', ...
+            
+            # shift and offset input_ids
+            greater_than_4 = input_ids > 4
+            input_ids_shifted = input_ids - 4 * greater_than_4 # Subtract 4 from the tokens that are greater than 4
+            input_ids_shifted = input_ids_shifted[:,1:-1] if remove_special_tokens else input_ids # remove CLS and SEP, shift to 0-indexed
+            output = torch.nn.functional.cross_entropy(output.reshape(-1, output.shape[-1]), input_ids_shifted.reshape(-1).to(torch.long).to(device), reduction='none').unsqueeze(0)
+        output = _to_numpy(output)
+
+        if upsample_embeddings and not (self.return_loss and remove_special_tokens):
+            output = self._repeat_token_vectors(input_ids[0], output)
+        elif upsample_embeddings and (self.return_loss and remove_special_tokens):
+            output = self._repeat_token_vectors(input_ids[0,1:-1], output)
+        return output
     
     
 
-    # GATTTATTAGGGGAGATTTTATATATCCCGA
-    # ['[CLS]', 'G', 'ATTTATT', 'AGGGG', 'AGATT', 'TTATAT', 'ATCCCG', 'A', '[SEP]']
-    @staticmethod
-    def _repeat_embedding_vectors(tokens: Iterable[str], embeddings: np.ndarray, has_special_tokens: bool = True):
-        '''
-        Byte-pair encoding merges a variable number of letters into one token.
-        We need to repeat each token's embedding vector for each letter in the token.
-        '''
-        assert len(tokens) == embeddings.shape[1], 'Number of tokens and embeddings must match.'
-        new_embeddings = []
-        for idx, token in enumerate(tokens):
-
-            if has_special_tokens and (idx == 0 or idx == len(tokens) - 1):
-                new_embeddings.append(embeddings[:, [idx]]) # (1, 768)
-                continue
-            token_embedding = embeddings[:, [idx]] # (1, 768)
-            if token == '[UNK]':
-                new_embeddings.extend([token_embedding])
-            else:
-                new_embeddings.extend([token_embedding] * len(token))
-
-        # list of (1,1, 768) arrays
-        new_embeddings = np.concatenate(new_embeddings, axis=1)
-        return new_embeddings
+    def token_lengths(self, sequence: str, remove_special_tokens: bool = True):
+        """Get the number of nucleotides covered by each token of the embedding of a sequence.
+        See `BaseEmbedder.token_lengths`."""
+        chunks = [sequence[chunk : chunk + self.max_length] for chunk in  range(0, len(sequence), self.max_length)]
+        lengths = []
+        for n_chunk, chunk in enumerate(chunks):
+            chunk_lengths = list(self._token_length_table()[self.tokenizer(chunk)['input_ids']])
+            # special tokens between chunks are removed, as in `embed`
+            if len(chunks) != 1:
+                if n_chunk == 0:
+                    chunk_lengths = chunk_lengths[:-1]
+                elif n_chunk == len(chunks) - 1:
+                    chunk_lengths = chunk_lengths[1:]
+                else:
+                    chunk_lengths = chunk_lengths[1:-1]
+            lengths.extend(chunk_lengths)
+        return np.array(lengths[1:-1] if remove_special_tokens else lengths, dtype=np.int64)
 
 
 class GROVEREmbedder(BaseEmbedder):
     '''Embed using the GROVER model https://www.biorxiv.org/content/10.1101/2023.07.19.549677v2'''
 
-    def load_model(self, model_path: str = "pretrained_models/grover" , **kwargs):
+    def load_model(self, model_path: str = "pretrained_models/grover" , tokenizer_cache_size: int = 128, **kwargs):
         """Load the GROVER model.
 
         Parameters
@@ -1023,6 +1212,9 @@ class GROVEREmbedder(BaseEmbedder):
         model_path : str
             The path to the model directory.
             If the model path does not exist, it will be downloaded from https://zenodo.org/records/8373117
+        tokenizer_cache_size : int, optional
+            Number of tokenized sequences that are kept, so that `token_lengths` does not tokenize a sequence
+            that was just embedded again. Defaults to 128.
         """
         # download model if not exists
         if not os.path.exists(model_path):
@@ -1041,7 +1233,7 @@ class GROVEREmbedder(BaseEmbedder):
 
         self.max_length = 510 # NOTE this is BPE tokens, not bp.
 
-        self.max_token_length = max([len(token) for token in self.tokenizer.vocab.keys()])
+        self.max_match = MaxMatchTokenizer(self.tokenizer.vocab, self.tokenizer.unk_token_id, cache_size = tokenizer_cache_size)
 
 
     def max_match_tokenize(self, sequence: str) -> List[str]:
@@ -1059,29 +1251,12 @@ class GROVEREmbedder(BaseEmbedder):
         Returns
         -------
         List[str]
-            The tokenized sequence.
+            The tokenized sequence. Characters that cannot be tokenized are unknown tokens.
         """
-        tokens = []
-        i = 0
-        while i < len(sequence):
-            max_token = None
-            for j in range(i + self.max_token_length, i, -1):
-            # for j in range(len(sequence), i, -1):
-                candidate = sequence[i:j]
-                if candidate in self.tokenizer.vocab:
-                    max_token = candidate
-                    break
-            if max_token is None:
-                # If a subsequence cannot be tokenized, add each individual character as an unknown token
-                tokens.extend([self.tokenizer.unk_token for _ in sequence[i]])
-                i += 1
-            else:
-                tokens.append(max_token)
-                i += len(max_token)
-        return tokens
-
-
-    def embed(self, sequences: List[str], disable_tqdm: bool = False, remove_special_tokens: bool = True, upsample_embeddings: bool = False):
+        return self.tokenizer.convert_ids_to_tokens(self.max_match(sequence))
+
+
+    def embed(self, sequences: List[str], disable_tqdm: bool = False, remove_special_tokens: bool = True, upsample_embeddings: bool = False, batch_size: int = 1):
         '''Embeds a list sequences using the GROVER model.
         Note that the BPE tokenizer that GROVER used is not provided, we only
         have access to the vocabulary used for tokenization. Instead,
@@ -1099,6 +1274,9 @@ class GROVEREmbedder(BaseEmbedder):
             Whether to remove the CLS and SEP tokens from the embeddings. Defaults to True.
         upsample_embeddings : bool, optional
             Whether to upsample the embeddings to match the length of the input sequences. Defaults to False.
+        batch_size : int, optional
+            Number of sequences per forward. Long sequences are split into chunks, all of which are embedded
+            in the same forward. Defaults to 1.
 
         Returns
         -------
@@ -1112,70 +1290,45 @@ class GROVEREmbedder(BaseEmbedder):
         # '''
         embeddings = []
         with torch.no_grad():
-            for sequence in tqdm(sequences, disable=disable_tqdm):
+            # max match tokenize to BPE token ids, split into chunks and add the special tokens to each chunk
+            with stage('tokenization'):
+                all_input_ids = [[[self.tokenizer.cls_token_id] + chunk + [self.tokenizer.sep_token_id] for chunk in self._split_chunks(input_ids, self.max_length)]
+                                 for input_ids in self.max_match.batch(sequences)]
 
-                # pre-tokenize to BPE words
-                sequence_toks = self.max_match_tokenize(sequence)
-                chunks = [sequence_toks[chunk : chunk + self.max_length] for chunk in  range(0, len(sequence_toks), self.max_length)] # split bpe tokens into chunks
-                embedded_chunks = []
-                for n_chunk, chunk in enumerate(chunks):
-
-                    input_ids = self.tokenizer(' '.join(chunk), return_tensors="pt", return_attention_mask=False, return_token_type_ids=False)["input_ids"]
-                    output = self.model(input_ids.to(device))[0].detach().cpu().numpy()
+            with tqdm(total=sum(map(len, all_input_ids)), disable=disable_tqdm) as progress:
+                outputs = self._forward_chunks(all_input_ids, lambda ids, mask: self.model(ids, attention_mask=mask)[0],
+                                               batch_size=batch_size, pad_token_id=self.tokenizer.pad_token_id, progress=progress)
 
+            for sequence_input_ids, chunk_outputs in zip(all_input_ids, outputs):
+                embedded_chunks = []
+                for input_ids, output in zip(sequence_input_ids, chunk_outputs):
+                    output = _to_numpy(output)
                     if upsample_embeddings:
-                        output = self._repeat_embedding_vectors(self.tokenizer.convert_ids_to_tokens(input_ids[0]), output)
-
-                    # for intermediate chunks the special tokens need to go.
-                    # if we only have 1 chunk, keep them for now.
-                    if len(chunks) != 1:
-                        if n_chunk == 0:
-                            output = output[:,:-1] # no SEP
-                        elif n_chunk == len(chunks) - 1:
-                            output = output[:,1:] # no CLS
-                        else:
-                            output = output[:,1:-1] # no CLS and no SEP
-
+                        output = self._repeat_token_vectors(input_ids, output)
                     embedded_chunks.append(output)
+                embeddings.append(self._join_chunks(embedded_chunks))
 
-                embedding = np.concatenate(embedded_chunks, axis=1)
+        for n, sequence in enumerate(sequences):
+            embedding = embeddings[n]
 
-                if remove_special_tokens:
-                    embedding = embedding[:,1:-1]
+            if remove_special_tokens:
+                embedding = embedding[:,1:-1]
 
-                if upsample_embeddings and remove_special_tokens:
-                    assert len(sequence) == embedding.shape[1], f'Number of tokens and embeddings must match. {len(sequence)} != {embedding.shape[1]}'
-                elif upsample_embeddings:
-                    assert len(sequence)+ 2 == embedding.shape[1], f'Number of tokens and embeddings must match. {len(sequence)+ 2} != {embedding.shape[1]}'
+            if upsample_embeddings and remove_special_tokens:
+                assert len(sequence) == embedding.shape[1], f'Number of tokens and embeddings must match. {len(sequence)} != {embedding.shape[1]}'
+            elif upsample_embeddings:
+                assert len(sequence)+ 2 == embedding.shape[1], f'Number of tokens and embeddings must match. {len(sequence)+ 2} != {embedding.shape[1]}'
 
-                embeddings.append(embedding)
+            embeddings[n] = embedding
 
         return embeddings
     
-    # GATTTATTAGGGGAGATTTTATATATCCCGA
-    # ['[CLS]', 'G', 'ATTTATT', 'AGGGG', 'AGATT', 'TTATAT', 'ATCCCG', 'A', '[SEP]']
-    @staticmethod
-    def _repeat_embedding_vectors(tokens: Iterable[str], embeddings: np.ndarray, has_special_tokens: bool = True):
-        '''
-        Byte-pair encoding merges a variable number of letters into one token.
-        We need to repeat each token's embedding vector for each letter in the token.
-        '''
-        assert len(tokens) == embeddings.shape[1], 'Number of tokens and embeddings must match.'
-        new_embeddings = []
-        for idx, token in enumerate(tokens):
-
-            if has_special_tokens and (idx == 0 or idx == len(tokens) - 1):
-                new_embeddings.append(embeddings[:, [idx]]) # (1, 768)
-                continue
-            token_embedding = embeddings[:, [idx]] # (1, 768)
-            if token == '[UNK]':
-                new_embeddings.extend([token_embedding])
-            else:
-                new_embeddings.extend([token_embedding] * len(token))
-
-        # list of (1,1, 768) arrays
-        new_embeddings = np.concatenate(new_embeddings, axis=1)
-        return new_embeddings
+    def token_lengths(self, sequence: str, remove_special_tokens: bool = True):
+        """Get the number of nucleotides covered by each token of the embedding of a sequence.
+        See `BaseEmbedder.token_lengths`."""
+        # special tokens between chunks are removed in `embed`, only the first CLS and the last SEP are kept
+        lengths = self._token_length_table()[self.max_match(sequence)]
+        return lengths if remove_special_tokens else np.concatenate([[1], lengths, [1]]).astype(np.int64)
 
 
 class CaduceusEmbedder(BaseEmbedder):
@@ -1220,7 +1373,7 @@ class CaduceusEmbedder(BaseEmbedder):
         self.return_logits = return_logits
         self.return_loss = return_loss
 
-    def embed(self, sequences: List[str], disable_tqdm: bool = False, remove_special_tokens: bool = True, upsample_embeddings: bool = False):
+    def embed(self, sequences: List[str], disable_tqdm: bool = False, remove_special_tokens: bool = True, upsample_embeddings: bool = False, batch_size: int = 1):
         """
         Embed sequences using the Caduceus model.
 
@@ -1235,46 +1388,43 @@ class CaduceusEmbedder(BaseEmbedder):
         upsample_embeddings : bool, optional
             Whether to upsample the embeddings to match the length of the input sequences. Defaults to False. 
             Only provided for compatibility with other embedders. Caduceus embeddings are already the same length as the input sequence.
+        batch_size : int, optional
+            Number of sequences per forward. Long sequences are split into chunks, all of which are embedded in the same
+            forward. Caduceus reads sequences in both directions and does not mask padding, so only chunks of the same
+            length share a batch. Defaults to 1.
 
         Returns
         -------
         List[np.ndarray]
             List of embeddings.
         """
-        ref_tokenized = self.tokenizer.batch_encode_plus(
-        sequences,
-        add_special_tokens=False,
-        return_attention_mask=False,
-        max_length=self.max_length,
-        truncation=True,
-        )
         embeddings = []
         with torch.no_grad():
-            for sequence in tqdm(sequences, disable=disable_tqdm):
-                chunks = [sequence[chunk : chunk + self.max_length] for chunk in  range(0, len(sequence), self.max_length)]
-                embedded_chunks = []
-                for n_chunk, chunk in enumerate(chunks):
-                    input_ids = self.tokenizer(chunk, return_tensors="pt", return_attention_mask=False, return_token_type_ids=False, add_special_tokens=False)["input_ids"]
+            all_input_ids = self._tokenize_chunks(sequences, self.max_length, return_token_type_ids=False, add_special_tokens=False)
 
-                    if self.return_logits:
-                        out = self.model(input_ids=input_ids.to(device), output_hidden_states=False, return_dict=True)['logits'].detach().cpu().numpy()
+            with tqdm(total=sum(map(len, all_input_ids)), disable=disable_tqdm) as progress:
+                outputs = self._forward_chunks(all_input_ids, lambda ids, mask: self._forward(ids), batch_size=batch_size, progress=progress)
 
-                    elif self.return_loss:
-                        out = self.model(input_ids=input_ids.to(device), output_hidden_states=False, return_dict=True)['logits'] # (1, seq_len, 16)
-                        out = out[:, :, 7: 12] # 0-6 are special tokens. vocab_size is only 12 so last 4 dimensions are dead.
-                        targets = input_ids - 7 # shift to 0-indexed
-                        out = torch.nn.functional.cross_entropy(out.view(-1, out.size(-1)), targets.view(-1).to(device), reduction='none')
-                        out = out.unsqueeze(0).detach().cpu().numpy() # dim 0 gets lost because of view
+            for chunks, chunk_outputs in zip(all_input_ids, outputs):
+                embedded_chunks = [self._finish_chunk(out, torch.LongTensor([input_ids])) for input_ids, out in zip(chunks, chunk_outputs)]
+                embeddings.append(np.concatenate(embedded_chunks, axis=1))
 
-                    else:
-                        out = self.model(input_ids = input_ids.to(device), output_hidden_states=True)['hidden_states'][-1].detach().cpu().numpy()
-                    
-                    embedded_chunks.append(out)
+        return embeddings
 
-                embedding = np.concatenate(embedded_chunks, axis=1)
-                embeddings.append(embedding)
+    def _forward(self, input_ids: torch.Tensor) -> torch.Tensor:
+        """Get the logits or the last hidden states of a batch of token ids."""
+        if self.return_logits or self.return_loss:
+            return self.model(input_ids=input_ids, output_hidden_states=False, return_dict=True)['logits']
+        return self.model(input_ids = input_ids, output_hidden_states=True)['hidden_states'][-1]
 
-        return embeddings
+    def _finish_chunk(self, out: torch.Tensor, input_ids: torch.Tensor) -> np.ndarray:
+        """Compute the loss of one chunk from its logits."""
+        if self.return_loss:
+            out = out[:, :, 7: 12] # 0-6 are special tokens. vocab_size is only 12 so last 4 dimensions are dead. (1, seq_len, 16)
+            targets = input_ids - 7 # shift to 0-indexed
+            out = torch.nn.functional.cross_entropy(out.reshape(-1, out.size(-1)), targets.view(-1).to(device), reduction='none')
+            out = out.unsqueeze(0) # dim 0 gets lost because of view
+        return _to_numpy(out)
 
 
 # Class for one-hot encoding.
@@ -1296,7 +1446,7 @@ class OneHotEmbedder(BaseEmbedder):
         
         self.label_encoder = LabelEncoder().fit(self.nucleotide_categories)
     
-    def embed(self, sequences: List[str], disable_tqdm: bool = False, return_onehot: bool = False, upsample_embeddings: bool = False):
+    def embed(self, sequences: List[str], disable_tqdm: bool = False, return_onehot: bool = False, upsample_embeddings: bool = False, batch_size: int = 1):
         """Onehot encode sequences.
 
         Parameters
@@ -1310,6 +1460,8 @@ class OneHotEmbedder(BaseEmbedder):
             If false, returns integer encoded sequences.
         upsample_embeddings : bool, optional
             Whether to upsample the embeddings to match the length of the input sequences. Defaults to False.
+        batch_size : int, optional
+            Only provided for compatibility with other embedders, sequences are encoded one by one.
 
         Returns
         -------
@@ -0,0 +1,130 @@
+"""
+embedding_cache.py
+==================
+A content-addressed on-disk cache of embeddings.
+
+Embeddings are stored as ``.npy`` files named by the hash of the embedder configuration
+and the sequence, so that any task, split or run that asks the same embedder for the same
+sequence reuses the embedding. The cache is bounded in size. When it grows too large,
+the least recently used embeddings are removed.
+"""
+import os
+import json
+import hashlib
+import inspect
+import functools
+import numpy as np
+
+
+class EmbeddingCache():
+    """On-disk cache of embeddings with least recently used eviction."""
+    def __init__(self, cache_dir: str, max_bytes: int = 100 * 2**30) -> None:
+        """
+        Open a cache directory. Several processes can share the same directory.
+
+        Parameters
+        ----------
+        cache_dir : str
+            Directory of the cache. Created if it does not exist.
+        max_bytes : int, optional
+            Maximum size of the cache. The default is 100 GiB.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok = True)
+        self.size = sum(size for _, size, _ in self._entries())
+
+    @staticmethod
+    def key(namespace: str, sequence: str) -> str:
+        """Get the key of a sequence embedded by the embedder configuration described by namespace."""
+        return hashlib.sha256(f'{namespace}\0{sequence}'.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f'{key}.npy')
+
+    def _entries(self):
+        """Get (last use, size, path) of all cached embeddings."""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith('.npy'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue # evicted by another process
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def get(self, key: str) -> np.ndarray:
+        """Get a cached embedding. Returns None if it is not in the cache."""
+        path = self._path(key)
+        try:
+            embedding = np.load(path)
+            os.utime(path) # mark as recently used
+        except (FileNotFoundError, ValueError, EOFError):
+            return None
+        return embedding
+
+    def put(self, key: str, embedding: np.ndarray):
+        """Add an embedding to the cache, evicting old embeddings if the cache is full."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, embedding)
+            size = f.tell()
+        os.replace(tmp_path, path)
+        self.size += size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self, fraction: float = 0.9):
+        """Remove least recently used embeddings until the cache is at most fraction of its maximum size."""
+        entries = sorted(self._entries())
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= self.max_bytes * fraction:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+
+def cached_embed(embed):
+    """
+    Decorate the `embed` method of an embedder, so that it looks up sequences in the embedder's
+    cache before running the model, and adds the embeddings of the remaining sequences to it afterwards.
+    If the embedder has no cache, `embed` is called as is.
+
+    The cache key covers the embedder class, the arguments it was loaded with, the arguments
+    of `embed` (except `disable_tqdm` and `batch_size`) and the sequence.
+    """
+    signature = inspect.signature(embed)
+
+    @functools.wraps(embed)
+    def wrapper(self, sequences, *args, **kwargs):
+        cache = getattr(self, 'embedding_cache', None)
+        if cache is None:
+            return embed(self, sequences, *args, **kwargs)
+
+        arguments = signature.bind(self, sequences, *args, **kwargs)
+        arguments.apply_defaults()
+        options = {k: v for k, v in arguments.arguments.items() if k not in ('self', 'sequences', 'disable_tqdm', 'batch_size')}
+        namespace = json.dumps([type(self).__name__, getattr(self, '_load_args', None), options],
+                               sort_keys = True, default = str)
+
+        keys = [cache.key(namespace, s) for s in sequences]
+        embeddings = [cache.get(key) for key in keys]
+        missing = [i for i, x in enumerate(embeddings) if x is None]
+        if len(missing) > 0:
+            computed = embed(self, [sequences[i] for i in missing], *args, **kwargs)
+            for i, embedding in zip(missing, computed):
+                cache.put(keys[i], embedding)
+                embeddings[i] = embedding
+        return embeddings
+
+    return wrapper
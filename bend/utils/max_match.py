@@ -0,0 +1,103 @@
+"""
+max_match.py
+============
+Greedy longest-match (MaxMatch) tokenization over a fixed vocabulary.
+
+GROVER only ships the vocabulary of its tokenizer, so sequences are tokenized by
+repeatedly taking the longest vocabulary token that starts at the current position.
+Characters that start no token become one unknown token each.
+
+The vocabulary is compiled once into a trie, which is written as a regular expression
+in which each node's children are alternatives and the children of a node that ends a
+token are optional. Greedy matching then returns the longest token at each position,
+and the whole sequence is scanned by the regular expression engine instead of testing
+every candidate substring in Python.
+"""
+import re
+import functools
+from typing import Dict, List
+
+
+def _trie_pattern(node: dict) -> str:
+    """Write the subtrie below a node as a regular expression. The key None marks the end of a token."""
+    branches = []
+    for char in sorted(key for key in node if key is not None):
+        child = node[char]
+        pattern = _trie_pattern(child)
+        if not pattern:
+            branches.append(re.escape(char))
+        elif None in child:
+            # the child ends a token, so a longer token is optional
+            branches.append(f'{re.escape(char)}(?:{pattern})?')
+        else:
+            branches.append(f'{re.escape(char)}(?:{pattern})')
+    return '|'.join(branches)
+
+
+class MaxMatchTokenizer():
+    """Tokenize sequences into the ids of the longest matching vocabulary tokens."""
+    def __init__(self, vocab: Dict[str, int], unk_token_id: int, cache_size: int = 0):
+        """
+        Compile the vocabulary.
+
+        Parameters
+        ----------
+        vocab : Dict[str, int]
+            Token of each id.
+        unk_token_id : int
+            Id of the unknown token, used for each character that starts no token.
+        cache_size : int, optional
+            Number of tokenized sequences to keep, so that tokenizing the same sequence
+            again is free. Defaults to 0, no cache.
+        """
+        self.vocab = vocab
+        self.unk_token_id = unk_token_id
+
+        trie = {}
+        for token in vocab:
+            if not token:
+                continue
+            node = trie
+            for char in token:
+                node = node.setdefault(char, {})
+            node[None] = True
+        # characters that start no token are matched one at a time by the last alternative
+        self._pattern = re.compile(f'(?:{_trie_pattern(trie)})|.', re.DOTALL)
+
+        if cache_size > 0:
+            self._token_ids = functools.lru_cache(maxsize=cache_size)(self._token_ids)
+
+    def _token_ids(self, sequence: str) -> tuple:
+        return tuple(self.vocab.get(token, self.unk_token_id) for token in self._pattern.findall(sequence))
+
+    def __call__(self, sequence: str) -> List[int]:
+        """
+        Tokenize a sequence.
+
+        Parameters
+        ----------
+        sequence : str
+            The sequence to tokenize.
+
+        Returns
+        -------
+        List[int]
+            The token ids of the sequence, without special tokens.
+        """
+        return list(self._token_ids(sequence))
+
+    def batch(self, sequences: List[str]) -> List[List[int]]:
+        """
+        Tokenize a list of sequences.
+
+        Parameters
+        ----------
+        sequences : List[str]
+            The sequences to tokenize.
+
+        Returns
+        -------
+        List[List[int]]
+            The token ids of each sequence, without special tokens.
+        """
+        return [self(sequence) for sequence in sequences]
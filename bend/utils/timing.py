@@ -0,0 +1,153 @@
+"""
+timing.py
+=========
+Cumulative wall time per stage of the embedding pipeline.
+
+Code marks its stages with :func:`stage` (or the :func:`timed` decorator). While a
+:class:`StageTimer` is active, the time spent in each stage is added to it; otherwise
+marking a stage does nothing. Forward passes of models are timed with module hooks,
+see :func:`time_forward`.
+"""
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from collections import defaultdict
+import torch
+
+_active_timer = None
+_forward_starts = threading.local()
+
+
+class StageTimer():
+    """Collects the wall time and number of calls of each stage."""
+    def __init__(self) -> None:
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.nucleotides = 0
+        self.samples = 0
+        self._lock = threading.Lock()
+        self._start = None
+        self._wall = 0.0
+
+    def add(self, name: str, seconds: float, count: int = 1):
+        """Add time to a stage."""
+        with self._lock:
+            self.seconds[name] += seconds
+            self.counts[name] += count
+
+    @contextmanager
+    def activate(self):
+        """Make this the timer that stages are added to, for all threads of the process."""
+        global _active_timer
+        previous, _active_timer = _active_timer, self
+        self._start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self._wall += time.perf_counter() - self._start
+            _active_timer = previous
+
+    def report(self) -> dict:
+        """
+        Get the timings as a dict.
+
+        Returns
+        -------
+        dict
+            Total wall time, number of samples and nucleotides, nucleotides per second, and the
+            seconds and calls of each stage. Stages can run in parallel threads, so their sum
+            can exceed the wall time.
+        """
+        return {'wall_seconds': self._wall,
+                'samples': self.samples,
+                'nucleotides': self.nucleotides,
+                'nucleotides_per_second': self.nucleotides / self._wall if self._wall > 0 else 0.0,
+                'stages': {name: {'seconds': self.seconds[name], 'count': self.counts[name]} for name in self.seconds}}
+
+    def save(self, path: str):
+        """Write the report to a JSON file."""
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent = 2)
+
+
+@contextmanager
+def stage(name: str, count: int = 1, synchronize: bool = False):
+    """Time a stage on the active timer, if there is one. With synchronize, the stage waits
+    for the kernels it launched on the GPU, as the forward hooks of `time_forward` do."""
+    timer = _active_timer
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if synchronize and torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+        timer.add(name, time.perf_counter() - start, count)
+
+
+def timed(name: str):
+    """Decorate a function, so that its calls are timed as a stage."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _forward_pre_hook(module, args):
+    if _active_timer is not None:
+        if not hasattr(_forward_starts, 'starts'):
+            _forward_starts.starts = {}
+        _forward_starts.starts[id(module)] = time.perf_counter()
+
+
+def _forward_hook(module, args, output):
+    starts = getattr(_forward_starts, 'starts', {})
+    start = starts.pop(id(module), None)
+    if _active_timer is not None and start is not None:
+        # kernels run asynchronously, wait for them so that the time is not counted as copying
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+        _active_timer.add('forward', time.perf_counter() - start)
+
+
+def time_forward(module: torch.nn.Module):
+    """Time the forward passes of a module as the stage 'forward'."""
+    module.register_forward_pre_hook(_forward_pre_hook)
+    module.register_forward_hook(_forward_hook)
+
+
+def summarize(reports) -> str:
+    """
+    Summarize timing reports, e.g. of all chunks of a run, as a table.
+
+    Parameters
+    ----------
+    reports : List[dict]
+        Reports from `StageTimer.report`.
+
+    Returns
+    -------
+    str
+        Table of the total seconds and share of the wall time of each stage, and the throughput.
+    """
+    wall = sum(r['wall_seconds'] for r in reports)
+    nucleotides = sum(r['nucleotides'] for r in reports)
+    seconds, counts = defaultdict(float), defaultdict(int)
+    for r in reports:
+        for name, s in r['stages'].items():
+            seconds[name] += s['seconds']
+            counts[name] += s['count']
+    lines = [f'{"stage":<16}{"seconds":>12}{"calls":>10}{"% wall":>9}']
+    for name in sorted(seconds, key = lambda x: -seconds[x]):
+        share = 100 * seconds[name] / wall if wall > 0 else 0.0
+        lines.append(f'{name:<16}{seconds[name]:>12.2f}{counts[name]:>10}{share:>8.1f}%')
+    lines.append(f'{len(reports)} chunks, {sum(r["samples"] for r in reports)} samples, {nucleotides} nucleotides in {wall:.2f} s '
+                 f'({nucleotides / wall if wall > 0 else 0.0:.0f} nt/s)')
+    return '\n'.join(lines)
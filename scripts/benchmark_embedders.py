@@ -0,0 +1,50 @@
+'''
+Benchmark the embedders on random DNA sequences, with randomly initialized weights
+so that nothing needs to be downloaded. Writes the results as JSON, and optionally compares
+them to the results of a previous run, e.g. of another commit.
+'''
+import argparse
+import json
+import sys
+from bend.bench import BENCH_EMBEDDERS, run_benchmarks, compare_reports
+
+
+def main():
+
+    parser = argparse.ArgumentParser('Benchmark embedders')
+    parser.add_argument('--embedders', nargs='+', choices=BENCH_EMBEDDERS, default=BENCH_EMBEDDERS, help='Embedders to benchmark')
+    parser.add_argument('--lengths', nargs='+', type=int, default=[512, 12000, 100000], help='Sequence lengths')
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 8], help='Number of sequences per call of embed')
+    parser.add_argument('--n_batches', type=int, default=10, help='Number of timed batches per length and batch size')
+    parser.add_argument('--warmup', type=int, default=1, help='Number of untimed batches before the timed ones')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the weights and sequences')
+    parser.add_argument('--model_dir', type=str, default=None, help='Directory in which the random checkpoints are kept. Temporary if not given')
+    parser.add_argument('--no_isolate', action='store_true', help='Benchmark all embedders in this process instead of one process each')
+    parser.add_argument('--output', type=str, default='benchmark.json', help='Path of the JSON results')
+    parser.add_argument('--compare', type=str, default=None, help='JSON results of a previous run to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Relative drop in throughput that counts as a regression')
+
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.embedders, model_dir = args.model_dir, isolate = not args.no_isolate,
+                            lengths = args.lengths, batch_sizes = args.batch_sizes,
+                            n_batches = args.n_batches, warmup = args.warmup, seed = args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent = 2)
+    print(f'Results written to {args.output}')
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f'Compared to {args.compare} (commit {baseline.get("commit")}):')
+        comparison = compare_reports(baseline, report, tolerance = args.tolerance)
+        for c in comparison:
+            flag = 'REGRESSION' if c['regression'] else ''
+            print(f'{c["embedder"]:<10} length {c["length"]:>7} batch {c["batch_size"]:>3}: '
+                  f'{c["baseline"]:>12.0f} -> {c["current"]:>12.0f} nt/s ({100 * c["change"]:+.1f}%) {flag}')
+        if any(c['regression'] for c in comparison):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
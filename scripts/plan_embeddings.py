@@ -0,0 +1,96 @@
+'''
+Dry run of precompute_embeddings.py: estimate the disk space and compute time of embedding
+every task with every model of the sweep in conf/embedding/embed.yaml, without embedding anything.
+Sizes are estimated from the bed files and conf/datadims/embedding_dims.yaml. With --calibrate,
+each model is loaded and timed on a random sequence of the median sample length of each task,
+which also measures the number of nucleotides per stored vector of tokenizing models.
+
+Settings of the config can be overridden as with hydra, e.g.
+    python scripts/plan_embeddings.py storage_dtype=float16 chunk_size=10000 --models dnabert2 onehot
+'''
+import argparse
+import json
+import os
+import numpy as np
+import hydra
+from hydra import compose, initialize
+from omegaconf import OmegaConf
+from bend.io.bedindex import BedIndex
+from bend.io.planner import calibrate, plan_task, free_bytes, format_bytes
+
+
+def sweep_values(cfg, key):
+    """Get the values of a parameter of the multirun sweep of the config."""
+    return [x.strip() for x in str(cfg.hydra.sweeper.params[key]).split(',') if x.strip()]
+
+
+def main():
+
+    parser = argparse.ArgumentParser('Plan embeddings')
+    parser.add_argument('overrides', nargs='*', help='Overrides of conf/embedding/embed.yaml, e.g. storage_dtype=float16')
+    parser.add_argument('--models', nargs='+', default=None, help='Models to plan. The default is the sweep of the config')
+    parser.add_argument('--tasks', nargs='+', default=None, help='Tasks to plan. The default is the sweep of the config')
+    parser.add_argument('--calibrate', action='store_true', help='Load and time each model to estimate compute time and token compression')
+    parser.add_argument('--calibration_runs', type=int, default=3, help='Number of timed runs per model and task')
+    parser.add_argument('--max_calibration_length', type=int, default=None, help='Limit the length of the calibration sequence')
+    parser.add_argument('--output', type=str, default=None, help='Path of a JSON file for the full plan')
+
+    args = parser.parse_args()
+
+    with initialize(version_base=None, config_path='../conf/embedding'):
+        cfg = compose(config_name='embed', overrides=args.overrides, return_hydra_config=True)
+    models = args.models if args.models is not None else sweep_values(cfg, 'model')
+    tasks = args.tasks if args.tasks is not None else sweep_values(cfg, 'task')
+
+    storage_dtype = cfg.storage_dtype if 'storage_dtype' in cfg else 'float32'
+    token_level = cfg.token_level if 'token_level' in cfg else False
+    projection = cfg.projection if 'projection' in cfg else None
+    projected_dim = projection.n_components if projection is not None and projection.method is not None else None
+
+    plans = []
+    for model in models:
+        model_cfg = cfg[model]
+        upsample_embeddings = model_cfg['upsample_embeddings'] if 'upsample_embeddings' in model_cfg else False
+        embedder = hydra.utils.instantiate(model_cfg) if args.calibrate else None
+        for task in tasks:
+            task_cfg = OmegaConf.to_container(cfg[task], resolve=True)
+            if not os.path.exists(task_cfg['bed']):
+                print(f'{task_cfg["bed"]} does not exist, skipping {task}')
+                continue
+            settings = {'embedding_dim': cfg.datadims[model], 'nucleotides_per_vector': 1.0,
+                        'token_level': False, 'seconds_per_nucleotide': None}
+            if embedder is not None:
+                index = BedIndex.load(task_cfg['bed'], label_column_idx=task_cfg.get('label_column_idx', 6))
+                length = int(np.median(index.end - index.start)) + 2 * task_cfg.get('flank', 0)
+                if args.max_calibration_length is not None:
+                    length = min(length, args.max_calibration_length)
+                print(f'Calibrating {model} on {task} ({length} nt)')
+                settings.update(calibrate(embedder, length, n_runs=args.calibration_runs,
+                                          upsample_embeddings=upsample_embeddings, token_level=token_level))
+            if projected_dim is not None:
+                settings['embedding_dim'] = projected_dim
+            plan = plan_task(**task_cfg, **settings, chunk_size=cfg.chunk_size, splits=cfg.splits,
+                             storage_dtype=storage_dtype)
+            plans.append({'model': model, 'task': task, **settings, **plan})
+
+    print(f'{"model":<28}{"task":<26}{"samples":>10}{"size":>14}{"largest chunk":>16}{"hours":>10}')
+    for p in plans:
+        samples = sum(s['samples'] for s in p['splits'].values())
+        largest = max((b for s in p['splits'].values() for b in s['chunk_bytes']), default=0)
+        hours = f'{p["seconds"] / 3600:.1f}' if p['seconds'] is not None else '-'
+        print(f'{p["model"]:<28}{p["task"]:<26}{samples:>10}{format_bytes(p["bytes"]):>14}{format_bytes(largest):>16}{hours:>10}')
+    total_bytes = sum(p['bytes'] for p in plans)
+    free = free_bytes(cfg.data_dir)
+    print(f'Total: {format_bytes(total_bytes)} ({format_bytes(free)} free in {cfg.data_dir})')
+    if all(p['seconds'] is not None for p in plans):
+        print(f'Total compute: {sum(p["seconds"] for p in plans) / 3600:.1f} hours')
+    if total_bytes > free:
+        print(f'WARNING: the embeddings need {format_bytes(total_bytes - free)} more than is free')
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'total_bytes': total_bytes, 'free_bytes': free, 'plans': plans}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,15 @@ import hydra
 from omegaconf import DictConfig, OmegaConf
 import torch
 import os
+import json
 import bend.io.sequtils as sequtils
-import pandas as pd
+from bend.io.leases import claim_chunks
+from bend.io.bedindex import BedIndex
+from bend.io.shards import SHARD_CODECS
+from bend.io.flatstore import FLAT_EXTENSION
+from bend.io.manifest import read_manifest, is_complete, shard_settings, remove_stale_shard
+from bend.io.genomestore import merge_regions, build_genome_store, GENOME_EXTENSION
+from bend.utils.timing import summarize
 import numpy as np
 import sys
 # load config 
@@ -18,40 +25,129 @@ def run_experiment(cfg: DictConfig) -> None:
         Hydra configuration object.
     """
     print('Embedding data for', cfg.task)
+    # the index of the bed file is cached per label column, use the same one as embed_from_bed
+    label_column_idx = cfg[cfg.task].label_column_idx if 'label_column_idx' in cfg[cfg.task] else 6
     # read the bed file and get the splits :  
     if not 'splits' in cfg or cfg.splits is None:
-        splits = sequtils.get_splits(cfg[cfg.task].bed) 
+        splits = sequtils.get_splits(cfg[cfg.task].bed, label_column_idx = label_column_idx) 
     else:
         splits = cfg.splits
     print('Embedding with', cfg.model) 
     # instatiante model
     embedder = hydra.utils.instantiate(cfg[cfg.model])
+    if 'cache_dir' in cfg and cfg.cache_dir is not None:
+        embedder.enable_cache(cfg.cache_dir, max_size_gb = cfg.cache_size_gb if 'cache_size_gb' in cfg else 100)
+    output_dir = f'{cfg.data_dir}/{cfg.task}/{cfg.model}/'
+    os.makedirs(output_dir, exist_ok=True)
+    task_cfg = OmegaConf.to_container(cfg[cfg.task], resolve=True)
+    index = BedIndex.load(cfg[cfg.task].bed, label_column_idx = label_column_idx)
+    shard_extension = SHARD_CODECS[cfg.shard_codec if 'shard_codec' in cfg else 'gz']
+    if 'backend' in cfg and cfg.backend == 'flat':
+        shard_extension = FLAT_EXTENSION
+    jobs = []
     for split in splits:
-        print(f'Embedding split: {split}')
-        output_dir = f'{cfg.data_dir}/{cfg.task}/{cfg.model}/'
-        
-        os.makedirs(output_dir, exist_ok=True)
-
         # embed in chunks 
         # get length of bed file and divide by chunk size, if a spcific chunk is not set 
-        df = pd.read_csv(cfg[cfg.task].bed, sep = '\t', low_memory=False)
-        df = df[df.iloc[:, -1] == split] if split is not None else df
-        possible_chunks = list(range(int(len(df) /cfg.chunk_size)+1))
-        if cfg.chunk is None: 
-            cfg.chunk = possible_chunks
-        cfg.chunk = [cfg.chunk] if isinstance(cfg.chunk, int) else cfg.chunk
-        # embed in chunks
-        for n, chunk in enumerate(cfg.chunk): 
+        n_samples = len(index.split_rows(split))
+        possible_chunks = list(range(int(n_samples /cfg.chunk_size)+1))
+        chunks = possible_chunks if cfg.chunk is None else cfg.chunk
+        chunks = [chunks] if isinstance(chunks, int) else chunks
+        for chunk in chunks: 
             if chunk not in possible_chunks:
                 print(f'{chunk} is not a valid chunk id. {split} chunk ids are {possible_chunks}')
                 continue
-            print(f'\t Embedding chunk {chunk} ({chunk +1}/{len(possible_chunks)})')
-            sequtils.embed_from_bed(**cfg[cfg.task], embedder = embedder, 
-                                        output_path = f'{output_dir}/{split}_{chunk}.tar.gz',
-                                        split = split, chunk = chunk, chunk_size = cfg.chunk_size,   
-                                        upsample_embeddings = cfg[cfg.model]['upsample_embeddings'] if 'upsample_embeddings' in cfg[cfg.model] else False)
-            
-            
+            jobs.append(dict(**task_cfg, 
+                             output_path = f'{output_dir}/{split}_{chunk}{shard_extension}',
+                             split = split, chunk = chunk, chunk_size = cfg.chunk_size,   
+                             batch_size = cfg.batch_size if 'batch_size' in cfg else 1,
+                             pipeline_depth = cfg.pipeline_depth if 'pipeline_depth' in cfg else 0,
+                             resume = cfg.resume if 'resume' in cfg else False,
+                             storage_dtype = cfg.storage_dtype if 'storage_dtype' in cfg else 'float32',
+                             token_level = cfg.token_level if 'token_level' in cfg else False,
+                             timing = cfg.timing if 'timing' in cfg else False,
+                             shuffle_seed = cfg.shuffle_seed if 'shuffle_seed' in cfg else None,
+                             manifest = cfg.manifest if 'manifest' in cfg else True,
+                             upsample_embeddings = cfg[cfg.model]['upsample_embeddings'] if 'upsample_embeddings' in cfg[cfg.model] else False))
+
+    # embed the regions of all tasks on the same reference genome once, and slice the chunks from them
+    genome_store = cfg.genome_store if 'genome_store' in cfg else None
+    genome_store_path = None
+    if genome_store is not None and genome_store.tile_length is not None:
+        reference = task_cfg['reference_fasta']
+        genome_store_path = f'{cfg.data_dir}/genome_stores/{cfg.model}/{os.path.basename(reference)}{GENOME_EXTENSION}'
+        if not os.path.exists(genome_store_path):
+            tasks = [OmegaConf.to_container(cfg[x], resolve=True) for x in cfg 
+                     if isinstance(cfg[x], DictConfig) and 'bed' in cfg[x] and 'reference_fasta' in cfg[x]]
+            tasks = [x for x in tasks if x['reference_fasta'] == reference and os.path.exists(x['bed'])]
+            print(f'Embedding the regions of {len(tasks)} tasks into {genome_store_path}')
+            regions = merge_regions([x['bed'] for x in tasks], reference, flank = [x.get('flank', 0) for x in tasks],
+                                    label_column_idx = [x.get('label_column_idx', 6) for x in tasks],
+                                    whole_chromosomes = genome_store.whole_chromosomes)
+            os.makedirs(os.path.dirname(genome_store_path), exist_ok=True)
+            build_genome_store(regions, reference, embedder, genome_store_path, 
+                               tile_length = genome_store.tile_length, overlap = genome_store.overlap,
+                               batch_size = cfg.batch_size if 'batch_size' in cfg else 1,
+                               storage_dtype = genome_store.storage_dtype,
+                               reverse_complement = any(x.get('read_strand', False) for x in tasks))
+        for job in jobs:
+            job['genome_store'] = genome_store_path
+
+    # first pass: fit a projection to reduce the dimension of the embeddings
+    projection = cfg.projection if 'projection' in cfg else None
+    if projection is not None and projection.method is not None:
+        projection_path = f'{output_dir}/projection.npz'
+        if not os.path.exists(projection_path):
+            print(f'Fitting {projection.method} projection to {projection.n_components} dimensions')
+            sequtils.fit_projection(**task_cfg, embedder = embedder, genome_store = genome_store_path,
+                                    method = projection.method, n_components = projection.n_components,
+                                    n_samples = projection.n_samples, seed = projection.seed,
+                                    batch_size = cfg.batch_size if 'batch_size' in cfg else 1).save(projection_path)
+        for job in jobs:
+            job['projection'] = projection_path
+
+    # with resume, skip chunks that the manifest marks as complete, if they were embedded with the same settings.
+    # Without it, all chunks are embedded again
+    resume = cfg.resume if 'resume' in cfg else False
+    if 'manifest' not in cfg or cfg.manifest:
+        manifest = read_manifest(output_dir)
+        if manifest is not None and 'resharded' in manifest:
+            print(f'{output_dir} has been resharded, its chunks no longer match chunk_size. Embed into another data_dir')
+            return
+    if resume and ('manifest' not in cfg or cfg.manifest):
+        complete = [job for job in jobs if is_complete(manifest, job['output_path'], shard_settings(**job))]
+        if complete:
+            print(f'Skipping {len(complete)} chunks that are complete according to {output_dir}manifest.json')
+        jobs = [job for job in jobs if job not in complete]
+        # chunks embedded with other settings would be skipped as complete by resume and leases
+        stale = [job for job in jobs if remove_stale_shard(job['output_path'], shard_settings(**job))]
+        if stale:
+            print(f'Removed {len(stale)} chunks that were embedded with other settings')
+
+    # embed in chunks
+    workers = cfg.workers if 'workers' in cfg else 1
+    lease_timeout = cfg.lease_timeout if 'lease_timeout' in cfg else None
+    if lease_timeout is not None and not resume:
+        raise ValueError('lease_timeout requires resume=true, so that incomplete chunks can be told apart from complete ones')
+    if workers > 1:
+        print(f'Embedding {len(jobs)} chunks with {workers} workers')
+        sequtils.embed_from_bed_parallel(jobs, embedder, workers = workers, lease_timeout = lease_timeout)
+    elif lease_timeout is not None:
+        for job, lease in claim_chunks(jobs, timeout = lease_timeout):
+            with lease:
+                print(f'\t Embedding {job["split"]} chunk {job["chunk"]}')
+                sequtils.embed_from_bed(**job, embedder = embedder)
+    else:
+        for job in jobs:
+            print(f'\t Embedding {job["split"]} chunk {job["chunk"]}')
+            sequtils.embed_from_bed(**job, embedder = embedder)
+
+    if 'timing' in cfg and cfg.timing:
+        reports = []
+        for job in jobs:
+            if os.path.exists(f'{job["output_path"]}.timing.json'):
+                with open(f'{job["output_path"]}.timing.json') as f:
+                    reports.append(json.load(f))
+        print(summarize(reports))
         
 
 if __name__ == '__main__':
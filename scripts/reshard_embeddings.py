@@ -0,0 +1,36 @@
+'''
+Rewrite the shards of an embedding directory, e.g. data/enhancer_annotation/dnabert2, into shards
+of about equal size, optionally with another codec or storage dtype. The number of shards
+limits how many dataloader workers can read a split in parallel, so choose at least as many
+shards per split as workers.
+
+    python scripts/reshard_embeddings.py data/enhancer_annotation/dnabert2 --n_shards 64 --codec zst
+'''
+import argparse
+from bend.io.reshard import reshard
+from bend.io.shards import SHARD_CODECS, STORAGE_DTYPES
+from bend.io.planner import format_bytes
+
+
+def main():
+
+    parser = argparse.ArgumentParser('Reshard embeddings')
+    parser.add_argument('input_dir', type=str, help='Directory of the shards of a task and model')
+    parser.add_argument('--output_dir', type=str, default=None, help='Directory of the new shards. By default, the shards are replaced in place')
+    parser.add_argument('--n_shards', type=int, default=None, help='Total number of shards, divided between the splits by size')
+    parser.add_argument('--shard_gb', type=float, default=None, help='Uncompressed size of each shard in GiB, instead of --n_shards')
+    parser.add_argument('--codec', type=str, default=None, choices=list(SHARD_CODECS) + ['flat'], help='Codec of the new shards. The default is the codec of the old ones')
+    parser.add_argument('--storage_dtype', type=str, default=None, choices=STORAGE_DTYPES, help='Storage dtype of the new shards. The default is the dtype of the old ones')
+
+    args = parser.parse_args()
+
+    manifest = reshard(args.input_dir, output_dir = args.output_dir, n_shards = args.n_shards,
+                       shard_bytes = int(args.shard_gb * 2**30) if args.shard_gb is not None else None,
+                       codec = args.codec, storage_dtype = args.storage_dtype)
+    for name, entry in manifest['shards'].items():
+        size = sum(f['bytes'] for f in entry['files'].values())
+        print(f'{name:<24}{entry["samples"]:>10} samples{format_bytes(size):>14}{format_bytes(entry["nbytes"]):>14} of arrays')
+
+
+if __name__ == '__main__':
+    main()